@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A command line batch driver for the plotting functions: it expands a job spec
+(stations, date ranges and products) into a task graph, runs the graph on a
+pool of processes, and keeps a checkpoint file, so that an interrupted run
+picks up where it left off.
+
+Usage:
+    python batch.py run jobs.json [--workers N] [--checkpoint FILE]
+                                  [--restart] [--force]
+    python batch.py plan jobs.json   (prints the task graph without running)
+
+The job spec is a JSON file with a list of jobs, e.g.:
+    {"jobs": [
+        {"products": ["meteorogram"], "stations": ["ORD", "MSP"],
+         "start": "2010102300", "end": "2010102700", "window_hours": 48},
+        {"products": ["sounding"], "stations": ["KILX", "KGRB"],
+         "start": "2010102300", "end": "2010102600", "every_hours": 12},
+        {"products": ["olr", "t2m_mslp"], "start": "2010102500",
+         "end": "2010102521", "around": ["ORD"]}
+    ]}
+Each job makes its products for each of its stations:
+    meteorogram --> one per station and window of [window_hours] (default:
+                    one window from start to end)
+    sounding -----> one per station, every [every_hours] (default: 12) from
+                    start through end
+    olr, t2m_mslp > the NARR maps from start through end, of the region
+                    [bbox] ([south, north, west, east]) or [around] (a list
+                    of stations), or of the whole grid
+Times are "YYYYMMDDHH" or ISO strings.
+
+The task graph has two kinds of tasks: data loads (a station's ASOS or RAOB
+file, or a range of NARR data) and plots, where each plot depends on the one
+load that it needs. Identical tasks from different jobs are only run once.
+Each load is run with its plots (at most --unit plots at a time) in one
+process, so the loaded data is shared by those plots. The ASOS files are
+cached in sidecar files by their first load (see ut.load_asos), so later
+loads of the same station, in any process, don't parse the file again.
+
+Every finished plot is appended to the checkpoint file (one line of JSON per
+plot). A rerun with the same checkpoint skips the plots that finished (use
+--restart to start over); figures that are still up to date are also
+skipped by the plotting functions themselves (see ut.RenderManifest).
+
+@author: njweber2
+"""
+from datetime import timedelta
+import json
+import os
+import sys
+import time
+
+# The products that each job can make, and the data load each one needs
+_PRODUCTS = {'meteorogram':'asos', 'sounding':'soundings', 'olr':'narr',
+             't2m_mslp':'narr'}
+
+
+
+######################################################################
+### TASK GRAPH #######################################################
+######################################################################
+
+def read_spec(specfile):
+    """
+    Reads the jobs from the JSON job spec [specfile] (see the module
+    docstring).
+    """
+    try:
+        with open(specfile, 'r') as f:
+            spec = json.load(f)
+    except (OSError, ValueError) as err:
+        raise ValueError('ERROR: could not read the job spec "{}" ({})!'.format(
+                         specfile, err))
+    jobs = spec.get('jobs') if isinstance(spec, dict) else spec
+    if not isinstance(jobs, list):
+        raise ValueError('ERROR: the job spec has no list of "jobs"!')
+    return jobs
+
+
+
+def build_graph(jobs):
+    """
+    Expands [jobs] into a task graph: the deduplicated data loads, each with
+    the deduplicated plots that depend on it.
+
+    Requires:
+        jobs ---> a list of job dictionaries (see the module docstring)
+
+    Returns:
+        graph --> an ordered list of (load, plots) pairs, where a load is a
+                  task {'id', 'kind', 'args'} and plots is a list of the plot
+                  tasks {'id', 'kind', 'args', 'load'} that need that load
+    """
+    import utilities as ut
+    loads = {}  # {load id: (load task, {plot id: plot task})}
+    for n, job in enumerate(jobs):
+        products = job.get('products', [job.get('product')])
+        for product in products:
+            if product not in _PRODUCTS:
+                raise ValueError('ERROR: unknown product "{}" in job '
+                                 '{}!'.format(product, n + 1))
+        try:
+            dt1 = ut.parse_time(job['start'])
+            dt2 = ut.parse_time(job['end'])
+        except KeyError as err:
+            raise ValueError('ERROR: job {} has no "{}" time!'.format(n + 1,
+                             err.args[0]))
+        if dt2 < dt1:
+            raise ValueError('ERROR: job {} ends before it starts!'.format(
+                             n + 1))
+        stations = job.get('stations', [])
+
+        for product in products:
+            for load, plot in _expand(product, job, stations, dt1, dt2):
+                if load['id'] not in loads:
+                    loads[load['id']] = (load, {})
+                plot['load'] = load['id']
+                loads[load['id']][1].setdefault(plot['id'], plot)
+    return [(load, list(plots.values())) for load, plots in loads.values()]
+
+
+
+def _expand(product, job, stations, dt1, dt2):
+    """
+    Yields the (load task, plot task) pairs of one [product] of a job.
+    """
+    if product in ('meteorogram', 'sounding') and not stations:
+        raise ValueError('ERROR: a {} job needs "stations"!'.format(product))
+    if product == 'meteorogram':
+        hours = job.get('window_hours')
+        step = dt2 - dt1 if hours is None else timedelta(hours=hours)
+        windows = []
+        start = dt1
+        while True:
+            windows.append((start, min(start + step, dt2)))
+            start += step
+            if start >= dt2 or step <= timedelta(0):
+                break
+        for stid in stations:
+            load = _task('asos', stid=stid)
+            for w1, w2 in windows:
+                yield load, _task('meteorogram', stid=stid, dt1=w1, dt2=w2)
+    elif product == 'sounding':
+        step = timedelta(hours=job.get('every_hours', 12))
+        if step <= timedelta(0):
+            raise ValueError('ERROR: "every_hours" must be positive!')
+        for stid in stations:
+            load = _task('soundings', stid=stid)
+            date = dt1
+            while date <= dt2:
+                yield load, _task('sounding', stid=stid, date=date)
+                date += step
+    else:
+        region = {}
+        if job.get('bbox') is not None:
+            region['bbox'] = [float(b) for b in job['bbox']]
+        elif job.get('around') is not None:
+            region['stations'] = list(job['around'])
+        load = _task('narr', dt1=dt1, dt2=dt2, **region)
+        yield load, _task(product, dt1=dt1, dt2=dt2, **region)
+
+
+
+def _task(kind, **args):
+    """
+    Returns a task of [kind] with the arguments [args]. Its ID is built from
+    its kind and arguments, so identical tasks have the same ID.
+    """
+    args = {k:(v.strftime('%Y%m%d%H') if hasattr(v, 'strftime') else v) for
+            k, v in args.items()}
+    tid = ':'.join([kind] + ['{}={}'.format(k, args[k] if isinstance(args[k],
+                             str) else json.dumps(args[k], separators=(',', 
+                             ':'))) for k in sorted(args)])
+    return {'id':tid, 'kind':kind, 'args':args}
+
+
+
+def make_units(graph, size=8):
+    """
+    Splits the task graph into units of work: a load and (up to [size]) of
+    its plots, which are run together in one process.
+
+    Returns:
+        units --> a list of (load task, plot tasks) pairs
+    """
+    size = max(int(size), 1)
+    units = []
+    for load, plots in graph:
+        for i in range(0, len(plots), size):
+            units.append((load, plots[i:i+size]))
+    return units
+
+
+
+######################################################################
+### RUNNING TASKS ####################################################
+######################################################################
+
+def _load(task):
+    """
+    Runs a load task and returns the loaded data.
+    """
+    import utilities as ut
+    args = _parse_args(task['args'])
+    if task['kind'] == 'asos':
+        # (the first load of a station writes the sidecar that later loads,
+        # in any process, memory-map)
+        return ut.load_asos(args['stid'])
+    if task['kind'] == 'soundings':
+        return ut.load_soundings(args['stid'])
+    return ut.load_narr_data(args['dt1'], args['dt2'], bbox=args.get('bbox'),
+                             stations=args.get('stations'))
+
+
+
+def _plot(task, data, force=False, figure=None):
+    """
+    Runs a plot task with the [data] of its load task (drawing meteorograms
+    on [figure], a pf.MeteorogramFigure, if one is given).
+
+    Returns:
+        records --> the (figure file, manifest key) of each figure to record
+                    in the render manifest (see ut.RenderManifest)
+    """
+    import plotting_functions as pf
+    args = _parse_args(task['args'])
+    if task['kind'] == 'meteorogram':
+        windows = [(0, args['dt1'], args['dt2'])]
+        [(_, timing, record)] = pf.plot_meteorogram_group(
+                                    args['stid'], windows, force, figure)
+        if timing['error'] is not None:
+            raise ValueError(timing['error'])
+        return [] if record is None else [record]
+    if task['kind'] == 'sounding':
+        pf.plot_sounding(args['stid'], args['date'], force=force)
+    else:
+        # (the maps are drawn from the NARR data of the load task, so that a
+        # map's olr and t2m_mslp versions share one loaded dataset)
+        pf.plot_narr_maps(task['kind'], data, force=force)
+    return []
+
+
+
+def _parse_args(args):
+    """
+    Converts the times in task arguments back to datetime objects.
+    """
+    import utilities as ut
+    return {k:(ut.parse_time(v) if k in ('dt1', 'dt2', 'date') else v) for \
+            k, v in args.items()}
+
+
+
+def _run_unit(unit, force=False, instrumented=False, pool=True):
+    """
+    Runs one unit of work (see make_units): the load, then each plot. In a
+    worker process ([pool]), the instrumentation is reset (and turned on if
+    [instrumented]) first.
+
+    Returns:
+        results ----> a list of (plot ID, error message or None, seconds,
+                      manifest records) tuples, one per plot
+        collected --> the instrumentation data collected in this process
+                      (see instrument.drain()), if [pool]
+    """
+    import instrument
+    if pool:
+        instrument.reset() # (drop any data inherited from the parent process)
+        if instrumented:
+            instrument.enable()
+    load, plots = unit
+    results = []
+    try:
+        with instrument.stage('batch.load', task=load['id']):
+            data = _load(load)
+    except Exception as err:
+        error = 'load {} failed: {}'.format(load['id'], _message(err))
+        results = [(plot['id'], error, 0., []) for plot in plots]
+    else:
+        # (like plot_meteorograms, the unit's meteorograms share one figure)
+        import plotting_functions as pf
+        figure = pf.MeteorogramFigure()
+        try:
+            for plot in plots:
+                start = time.perf_counter()
+                try:
+                    with instrument.stage('batch.plot', task=plot['id']):
+                        records = _plot(plot, data, force=force, figure=figure)
+                    error = None
+                except Exception as err:
+                    error, records = _message(err), []
+                results.append((plot['id'], error,
+                                time.perf_counter() - start, records))
+        finally:
+            figure.close()
+    return results, (instrument.drain() if pool else None)
+
+
+
+def _message(err):
+    """
+    Returns the message of an exception (with its type, unless it is one of
+    our "ERROR: ..." ValueErrors).
+    """
+    if isinstance(err, ValueError):
+        return str(err)
+    return '{}: {}'.format(type(err).__name__, err)
+
+
+
+######################################################################
+### CHECKPOINT #######################################################
+######################################################################
+
+class Checkpoint(object):
+    """
+    The record of the plots that finished in earlier (or interrupted) runs:
+    a file with one line of JSON per plot, {'id', 'error', 'seconds'}, that
+    is appended to (and flushed) as each plot finishes.
+
+    Requires:
+        path ----> the checkpoint file
+        restart -> if True, the file's earlier records are discarded
+    """
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.done = set()
+        if restart and os.path.exists(path):
+            os.remove(path)
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # (a line cut off by an interruption)
+                        continue
+                    if entry.get('error') is None:
+                        self.done.add(entry['id'])
+                    else:
+                        self.done.discard(entry['id'])
+        except OSError:
+            pass
+        self._file = open(path, 'a')
+
+    def record(self, tid, error, seconds):
+        """
+        Records that plot [tid] finished (successfully if [error] is None).
+        """
+        self._file.write(json.dumps({'id':tid, 'error':error,
+                                     'seconds':round(seconds, 3)}) + '\n')
+        self._file.flush()
+        if error is None:
+            self.done.add(tid)
+
+    def close(self):
+        self._file.close()
+
+
+
+def run_graph(graph, checkpoint, workers=None, unit=8, force=False,
+              verbose=True):
+    """
+    Runs the plots of a task graph (see build_graph) that are not done yet in
+    [checkpoint] (a Checkpoint), on a pool of [workers] processes (or in this
+    process, if [workers] <= 1).
+
+    Returns:
+        summary --> a dictionary with the keys 'done', 'skipped' (done in an
+                    earlier run) and 'failed' (a list of (plot ID, error)
+                    pairs), and 'interrupted' (True if the run was stopped)
+    """
+    import instrument
+    import utilities as ut
+
+    pending = [(load, [p for p in plots if p['id'] not in checkpoint.done])
+               for load, plots in graph]
+    nplots = sum(len(plots) for load, plots in graph)
+    todo = [(load, plots) for load, plots in pending if plots]
+    units = make_units(todo, unit)
+    summary = {'done':0, 'skipped':nplots - sum(len(p) for l, p in todo),
+               'failed':[], 'interrupted':False}
+    if verbose:
+        print('{} plots ({} already done), in {} units'.format(nplots,
+              summary['skipped'], len(units)))
+
+    manifest = ut.RenderManifest()
+    def finish(results):
+        for tid, error, seconds, records in results:
+            checkpoint.record(tid, error, seconds)
+            for record in records:
+                manifest.record(*record)
+            if error is None:
+                summary['done'] += 1
+            else:
+                summary['failed'].append((tid, error))
+            if verbose:
+                print('  {} {} ({:.2f} s)'.format('FAILED' if error else 
+                                                 'done  ', tid, seconds))
+        manifest.save()
+
+    try:
+        if workers is None or workers <= 1:
+            for u in units:
+                finish(_run_unit(u, force=force, pool=False)[0])
+        else:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_run_unit, u, force,
+                                       instrument.is_enabled()) for u in units]
+                try:
+                    for future in as_completed(futures):
+                        results, collected = future.result()
+                        instrument.merge(collected)
+                        finish(results)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+    except KeyboardInterrupt:
+        summary['interrupted'] = True
+    finally:
+        manifest.save()
+    return summary
+
+
+
+def main(argv=None):
+    """
+    The command line interface (see the module docstring).
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='Runs batches of plots from '
+                                     'a job spec, resuming interrupted runs.')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='run the plots of a job spec')
+    plan = commands.add_parser('plan', help='print the task graph of a job '
+                               'spec')
+    for command in (run, plan):
+        command.add_argument('spec', help='the job spec (JSON file)')
+    run.add_argument('--workers', type=int, default=os.cpu_count(),
+                     help='number of processes (default: %(default)s)')
+    run.add_argument('--unit', type=int, default=8,
+                     help='most plots run with one data load (default: 8)')
+    run.add_argument('--checkpoint', help='the checkpoint file (default: the '
+                     'spec file + ".checkpoint")')
+    run.add_argument('--restart', action='store_true',
+                     help='discard the checkpoint and redo every plot')
+    run.add_argument('--force', action='store_true',
+                     help='re-render figures that are up to date')
+    run.add_argument('-q', '--quiet', action='store_true',
+                     help="don't print each plot as it finishes")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 0
+
+    try:
+        graph = build_graph(read_spec(args.spec))
+    except ValueError as err:
+        print(err)
+        return 1
+    if args.command == 'plan':
+        for load, plots in graph:
+            print(load['id'])
+            for plot in plots:
+                print('    ' + plot['id'])
+        print('{} loads, {} plots'.format(len(graph), sum(len(plots) for
+                                          load, plots in graph)))
+        return 0
+
+    checkpoint = Checkpoint(args.checkpoint or args.spec + '.checkpoint',
+                            restart=args.restart)
+    start = time.perf_counter()
+    try:
+        summary = run_graph(graph, checkpoint, workers=args.workers,
+                            unit=args.unit, force=args.force,
+                            verbose=not args.quiet)
+    finally:
+        checkpoint.close()
+    print('{} done, {} already done, {} failed in {:.1f} s'.format(
+          summary['done'], summary['skipped'], len(summary['failed']),
+          time.perf_counter() - start))
+    if summary['interrupted']:
+        print('Interrupted! Run the same command again to resume.')
+        return 130
+    for tid, error in summary['failed']:
+        print('FAILED {}: {}'.format(tid, error))
+    return 1 if summary['failed'] else 0
+
+
+
+# Any code within the following block with be executed when this module is
+# run as a script (e.g., "python batch.py run jobs.json")
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the data loaders (utilities.py) and the plotting
+functions (plotting_functions.py).
+
+Synthetic inputs are generated offline at several sizes (NARR-shaped netCDF
+files with 10 to 10,000 time steps, and ASOS/RAOB CSV exports with 1k to 10M
+rows), and the parse, subset and render stages of each are timed separately,
+as is the startup of a short plot command (with and without the persistent
+plot worker in plotserver.py).
+Every benchmark case runs in a fresh process, so that no data is cached in
+memory between cases and the peak memory use (RSS) of each case can be
+measured. The results are saved as JSON, and two result files can be
+compared to find regressions.
+
+Usage:
+    python benchmarks.py run [--sizes small|medium|large] [-o results.json]
+    python benchmarks.py compare old.json new.json [--threshold 0.2]
+(run "python benchmarks.py run -h" for all of the options)
+
+@author: njweber2
+"""
+import numpy as np
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# The benchmark sizes: the numbers of NARR time steps, and the numbers of
+# ASOS and RAOB CSV rows
+SIZES = {'small':{'narr':[10, 100], 'csv':[1000, 10000]},
+         'medium':{'narr':[10, 100, 1000],
+                   'csv':[1000, 10000, 100000, 1000000]},
+         'large':{'narr':[10, 100, 1000, 10000],
+                  'csv':[1000, 10000, 100000, 1000000, 10000000]}}
+
+# The variables in the synthetic NARR files: (mean, amplitude)
+_NARR_VARIABLES = {'t2m':(10., 15.), 'mslp':(1010., 20.), 'u10m':(0., 20.),
+                   'v10m':(0., 20.), 'olr':(220., 60.)}
+
+# The synthetic CSV files hold this many stations (one after the other, like
+# a multi-station Iowa State export); the benchmarks read the last one
+_NSTATIONS = 4
+_LEVELS = 50 # levels per synthetic sounding
+_START = datetime(2010, 10, 1)
+
+# The directory of this module (and of the modules it benchmarks)
+_THISDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+
+######################################################################
+### SYNTHETIC DATA ###################################################
+######################################################################
+
+def make_narr_file(ncpath, ntimes, ny=60, nx=80, seed=0):
+    """
+    Writes a synthetic NARR netCDF file in the same layout as
+    data/narr_oct2010.nc: 3-hourly (time, y, x) fields of 't2m', 'mslp',
+    'u10m', 'v10m' and 'olr' on a curvilinear (lat, lon) grid over North
+    America.
+
+    Requires:
+        ncpath --> full path to the new file (string)
+        ntimes --> number of time steps (int)
+        ny, nx --> grid size (ints)
+        seed ----> random seed (int)
+    """
+    from netCDF4 import Dataset, date2num
+
+    rng = np.random.default_rng(seed)
+    jj, ii = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+    with Dataset(ncpath, 'w') as nc:
+        nc.createDimension('time', None)
+        nc.createDimension('y', ny)
+        nc.createDimension('x', nx)
+        times = nc.createVariable('time', 'f8', ('time',))
+        times.units = 'hours since 1800-01-01'
+        times[:] = date2num([_START + timedelta(hours=3*d) for d in \
+                             range(ntimes)], times.units)
+        lat = nc.createVariable('lat', 'f4', ('y', 'x'))
+        lat[:] = 15. + 50. * (jj / max(ny-1, 1)) + 5. * (ii / max(nx-1, 1))
+        lon = nc.createVariable('lon', 'f4', ('y', 'x'))
+        lon[:] = -140. + 80. * (ii / max(nx-1, 1)) - 8. * (jj / max(ny-1, 1))
+        for name, (mean, amp) in _NARR_VARIABLES.items():
+            var = nc.createVariable(name, 'f4', ('time', 'y', 'x'))
+            # write in blocks of time steps to bound the memory use
+            for d in range(0, ntimes, 100):
+                k = np.arange(d, min(d+100, ntimes))[:,None,None]
+                var[d:d+len(k)] = mean + amp * np.sin(ii/9. + jj/7. + k/5.) \
+                                  + rng.normal(0., 1., (len(k), ny, nx))
+
+
+
+def make_asos_file(csvpath, nrows, seed=0):
+    """
+    Writes a synthetic ASOS CSV export (in the same layout as the
+    data/asos_*.txt files) with [nrows] rows of 5-minute observations, split
+    evenly among _NSTATIONS stations. About 80% of the precipitation values
+    and 2% of the other values are missing ('M').
+    """
+    rng = np.random.default_rng(seed)
+    header = 'station,valid, tmpc ,  dwpc ,  drct ,  sknt ,  mslp ,  p01m\n'
+    layout = (('%.2f', 10., 10.), ('%.2f', 0., 10.), ('%.2f', 180., 180.),
+              ('%.2f', 10., 10.), ('%.2f', 1010., 20.), ('%.2f', 1., 1.))
+    missing = (0.02,) * 5 + (0.8,)
+
+    def columns(i, n):
+        k = np.arange(i, i+n) % per_station
+        dates = np.datetime64(_START, 'm') + 5 * k
+        cols = [np.char.replace(np.datetime_as_string(dates), 'T', ' ')]
+        for (fmt, mean, amp), frac in zip(layout, missing):
+            values = np.char.mod(fmt, mean + amp * np.sin(k / 97.) +
+                                 rng.normal(0., 1., n))
+            values[rng.random(n) < frac] = 'M'
+            cols.append(values)
+        return cols
+    per_station = -(-nrows // _NSTATIONS)
+    _write_csv(csvpath, header, nrows, per_station, columns)
+
+
+
+def make_sounding_file(csvpath, nrows, seed=0):
+    """
+    Writes a synthetic RAOB CSV export (in the same layout as the
+    data/soundings_*.txt files) with [nrows] rows, split evenly among
+    _NSTATIONS stations: 12-hourly launches of _LEVELS levels each, with
+    about 5% of the temperatures/dewpoints missing ('M').
+    """
+    rng = np.random.default_rng(seed)
+    header = 'station,validUTC,levelcode,pressure_mb,height_m,tmpc,dwpc,' + \
+             'drct,speed_kts,bearing,range_sm\n'
+
+    def columns(i, n):
+        k = np.arange(i, i+n) % per_station
+        launch, level = np.divmod(k, _LEVELS)
+        dates = np.datetime64(_START, 's') + 43200 * launch
+        p = 1000. * (1. - 0.9 * level / _LEVELS)
+        z = 44330. * (1. - (p / 1013.25)**0.19)
+        t = 15. - 0.0065 * z + rng.normal(0., 1., n)
+        td = t - rng.uniform(0., 15., n)
+        cols = [np.char.replace(np.datetime_as_string(dates), 'T', ' '),
+                np.full(n, '4'), np.char.mod('%.1f', p),
+                np.char.mod('%.1f', z)]
+        for values in (t, td):
+            values = np.char.mod('%.1f', values)
+            values[rng.random(n) < 0.05] = 'M'
+            cols.append(values)
+        cols += [np.full(n, 'M')] * 4
+        return cols
+    per_station = -(-nrows // _NSTATIONS)
+    _write_csv(csvpath, header, nrows, per_station, columns)
+
+
+
+def _write_csv(csvpath, header, nrows, per_station, columns, block=100000):
+    """
+    Writes [nrows] rows of a synthetic CSV file, [block] rows at a time: the
+    station ID, then the (string array) columns returned by columns(i, n)
+    for rows i through i+n. Each station has [per_station] rows.
+    """
+    with open(csvpath, 'w') as f:
+        f.write(header)
+        for i in range(0, nrows, block):
+            n = min(block, nrows - i)
+            stids = np.char.add('BN', (np.arange(i, i+n) // per_station
+                                       ).astype(str))
+            rows = zip(stids, *columns(i, n))
+            f.write('\n'.join(map(','.join, rows)) + '\n')
+
+
+
+def _last_station(nrows):
+    """
+    Returns the station ID of the last station in a synthetic CSV file.
+    """
+    per_station = -(-nrows // _NSTATIONS)
+    return 'BN{}'.format((nrows - 1) // per_station)
+
+
+
+######################################################################
+### BENCHMARK CASES ##################################################
+######################################################################
+
+def bench_narr(spec):
+    """
+    Benchmarks load_narr_data on a synthetic NARR file:
+        parse ---> opening the file and decoding its times/coordinates
+        subset --> reading every variable over one day in the middle
+        scan ----> reading one variable over every time step, one at a time
+                   (as the map-plotting functions do)
+    """
+    import utilities as ut
+
+    stages = {}
+    ntimes = spec['ntimes']
+    start = time.perf_counter()
+    narr = ut.load_narr_data(_START, _START + timedelta(hours=3*ntimes),
+                             ncfile=spec['path'])
+    stages['parse'] = time.perf_counter() - start
+
+    mid = _START + timedelta(hours=3*(ntimes//2))
+    start = time.perf_counter()
+    window = ut.load_narr_data(mid, mid + timedelta(hours=21),
+                               ncfile=spec['path'])
+    for var in _NARR_VARIABLES:
+        window[var][:]
+    stages['subset'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for d in range(narr.ntimes):
+        narr['olr'][d,:,:]
+    stages['scan'] = time.perf_counter() - start
+    return stages
+
+
+
+def bench_asos(spec):
+    """
+    Benchmarks the ASOS loaders on a synthetic multi-station CSV export:
+        parse ---> loading one station's rows (load_asos, with no cache)
+        reload --> loading them again from the sidecar files (in a new
+                   session)
+        subset --> get_meteorogram over a 2-day window (from memory)
+        stream --> get_meteorogram over a 2-day window near the start of the
+                   file, with nothing cached in memory (this reads the cache
+                   files, or streams the CSV if it is large)
+    """
+    import utilities as ut
+
+    stages = {}
+    stid = _last_station(spec['nrows'])
+    ut.clear_caches(spec['path'])
+    start = time.perf_counter()
+    asos = ut.load_asos(stid, csvfile=spec['path'])
+    stages['parse'] = time.perf_counter() - start
+
+    ut.clear_caches()
+    start = time.perf_counter()
+    asos = ut.load_asos(stid, csvfile=spec['path'])
+    stages['reload'] = time.perf_counter() - start
+
+    dates = asos['dates']
+    dt1 = dates[len(dates)//2].astype(datetime)
+    start = time.perf_counter()
+    ut.get_meteorogram(stid, dt1, dt1 + timedelta(days=2), csvfile=spec['path'])
+    stages['subset'] = time.perf_counter() - start
+
+    ut.clear_caches()
+    dt1 = dates[0].astype(datetime) + timedelta(days=1)
+    start = time.perf_counter()
+    ut.get_meteorogram(stid, dt1, dt1 + timedelta(days=2), csvfile=spec['path'])
+    stages['stream'] = time.perf_counter() - start
+    ut.clear_caches(spec['path'])
+    return stages
+
+
+
+def bench_sounding(spec):
+    """
+    Benchmarks the RAOB loaders on a synthetic multi-station CSV export:
+        parse ---> loading one station's rows (load_soundings, with no cache)
+        reload --> loading them again from the sidecar files (in a new
+                   session)
+        subset --> get_soundings for 10 launch times (from memory)
+    """
+    import utilities as ut
+
+    stages = {}
+    stid = _last_station(spec['nrows'])
+    ut.clear_caches(spec['path'])
+    start = time.perf_counter()
+    store = ut.load_soundings(stid, csvfile=spec['path'])
+    stages['parse'] = time.perf_counter() - start
+
+    ut.clear_caches()
+    start = time.perf_counter()
+    store = ut.load_soundings(stid, csvfile=spec['path'])
+    stages['reload'] = time.perf_counter() - start
+
+    launches = store['launches'].astype(datetime)
+    dates = launches[np.linspace(0, len(launches)-1, 10).astype(int)]
+    start = time.perf_counter()
+    ut.get_soundings(stid, list(dates), csvfile=spec['path'])
+    stages['subset'] = time.perf_counter() - start
+    ut.clear_caches(spec['path'])
+    return stages
+
+
+
+def bench_render(spec):
+    """
+    Benchmarks the rendering of NARR maps (the 'olr' product):
+        setup ---> projecting the grid and drawing the static map layers (the
+                   map template; see plotting_functions.preload)
+        render --> drawing and saving spec['frames'] maps as .png files (with
+                   plot_narr_maps)
+    """
+    import utilities as ut
+    import plotting_functions as pf
+
+    stages = {}
+    nframes = spec['frames']
+    narr = ut.load_narr_data(_START, _START + timedelta(hours=3*(nframes-1)),
+                             ncfile=spec['path'])
+    pf.preload(narr=False)
+    start = time.perf_counter()
+    pf.preload(ncfile=spec['path'])
+    stages['setup'] = time.perf_counter() - start
+
+    # Save the maps (and the render manifest) in a temporary directory; this
+    # case has a process of its own, so nothing else sees the change
+    with tempfile.TemporaryDirectory() as figdir:
+        ut.get_figdir = lambda: figdir
+        ut.get_manifest_file = lambda: os.path.join(figdir, 'manifest.json')
+        start = time.perf_counter()
+        pf.plot_narr_maps('olr', narr, force=True)
+        stages['render'] = time.perf_counter() - start
+    return stages
+
+
+
+def bench_startup(spec):
+    """
+    Benchmarks the startup of a short plot command: the fastest of 
+    spec['runs'] runs of each of these, in new Python processes,
+        python ----------> starting Python (the baseline)
+        import ----------> also importing plotting_functions
+        figure ----------> also importing matplotlib and saving a figure
+        client ----------> a (ping) command through a running plot worker
+    and, in this process,
+        template --------> preloading the NARR map template (the first time)
+        template_warm ---> preloading it again (the template is cached)
+    """
+    import plotting_functions as pf
+
+    stages = {}
+    runs = spec['runs']
+    python = [sys.executable, '-c']
+    stages['python'] = _time_command(python + ['pass'], runs)
+    stages['import'] = _time_command(python + ['import plotting_functions'],
+                                     runs)
+    stages['figure'] = _time_command(python + ['import plotting_functions; '
+                                     'plotting_functions.preload(narr=False)'],
+                                     runs)
+
+    # Start a plot worker, wait for it to be ready, and time the client
+    import plotserver
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sock = os.path.join(tmpdir, 'plot.sock')
+        worker = subprocess.Popen([sys.executable, 'plotserver.py', 'serve',
+                                   '--no-narr', '--socket', sock],
+                                  cwd=_THISDIR, stdout=subprocess.DEVNULL)
+        try:
+            for attempt in range(600):
+                try:
+                    with plotserver.PlotClient(sock) as client:
+                        client.ping()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            stages['client'] = _time_command([sys.executable, 'plotserver.py',
+                                              'ping', '--no-local', '--socket',
+                                              sock], runs)
+        finally:
+            worker.terminate()
+            worker.wait()
+
+    pf.preload(narr=False)
+    for stage in ('template', 'template_warm'):
+        start = time.perf_counter()
+        pf.preload(ncfile=spec['path'])
+        stages[stage] = time.perf_counter() - start
+    return stages
+
+
+
+_BENCHMARKS = {'narr':bench_narr, 'asos':bench_asos,
+               'sounding':bench_sounding, 'render':bench_render,
+               'startup':bench_startup}
+
+
+
+def _time_command(command, runs):
+    """
+    Runs [command] (a list of arguments) [runs] times, in this module's 
+    directory, and returns the fastest wall time (in seconds).
+    """
+    times = []
+    for r in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=_THISDIR, check=True,
+                       stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+
+def _peak_rss_mb():
+    """
+    Returns the peak resident memory (RSS) of this process so far, in MB
+    (or None where it can't be measured).
+    """
+    # On Linux, read the high-water mark of this process's memory (unlike
+    # ru_maxrss, it doesn't include the memory used by the parent process
+    # before this process was started)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return float(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError: # (e.g., on Windows)
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, but in kilobytes on Linux
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+
+def _run_case(spec):
+    """
+    Runs one benchmark case (in this process) and returns its result.
+    """
+    # Import everything the benchmark needs first, so that the baseline
+    # memory use doesn't count as part of the benchmark
+    import utilities
+    if spec['kind'] in ('render', 'startup'):
+        import plotting_functions
+    base = _peak_rss_mb()
+    stages = _BENCHMARKS[spec['kind']](spec)
+    return {'kind':spec['kind'], 'size':spec['size'], 'stages':stages,
+            'base_rss_mb':base, 'peak_rss_mb':_peak_rss_mb()}
+
+
+
+def _run_in_subprocess(spec):
+    """
+    Runs one benchmark case in a new Python process and returns its result.
+    """
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), 'case',
+                           json.dumps(spec)], stdout=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        raise ValueError('ERROR: benchmark case "{}" failed!'.format(
+                         spec['name']))
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+
+######################################################################
+### COMMANDS #########################################################
+######################################################################
+
+def run_benchmarks(narr_steps, csv_rows, workdir, grid=(60, 80), frames=3,
+                   repeat=1, kinds=None, startup_runs=5, verbose=True):
+    """
+    Generates the synthetic inputs (if they don't exist in [workdir] yet) and
+    runs every benchmark case.
+
+    Requires:
+        narr_steps -> the numbers of time steps of the NARR files (list)
+        csv_rows ---> the numbers of rows of the ASOS/RAOB files (list)
+        workdir ----> directory for the synthetic inputs (string)
+        grid -------> the (ny, nx) size of the NARR grids (tuple)
+        frames -----> number of maps rendered by the render benchmark (int)
+        repeat -----> number of runs of each case; the fastest time of each
+                      stage and the largest memory use are kept (int)
+        kinds ------> (optional) only run these benchmarks (list of 'narr',
+                      'asos', 'sounding', 'render' and/or 'startup')
+        startup_runs -> number of runs of each command timed by the startup
+                      benchmark (int)
+        verbose ----> if True, prints the results as they are measured
+
+    Returns:
+        results ----> a dictionary with the keys 'meta' (a description of
+                      this machine and run) and 'cases': {case name: result},
+                      where each result has the keys 'kind', 'size', 'stages'
+                      ({stage: seconds}), 'base_rss_mb' (the memory use after
+                      importing the modules) and 'peak_rss_mb'
+    """
+    if kinds is None:
+        kinds = list(_BENCHMARKS.keys())
+    os.makedirs(workdir, exist_ok=True)
+    ny, nx = grid
+
+    # Build the list of cases, generating their input files as needed
+    specs = []
+    for ntimes in narr_steps:
+        # (the render and startup benchmarks use the smallest NARR file)
+        smallest = ntimes == min(narr_steps)
+        if 'narr' not in kinds and not (smallest and ('render' in kinds or
+                                                      'startup' in kinds)):
+            continue
+        path = os.path.join(workdir, 'narr_{}x{}_{}.nc'.format(ny, nx, ntimes))
+        if not os.path.isfile(path):
+            if verbose: print('Generating {}...'.format(path))
+            make_narr_file(path, ntimes, ny, nx)
+        if 'narr' in kinds:
+            specs.append({'name':'narr_{}steps'.format(ntimes), 'kind':'narr',
+                          'path':path, 'ntimes':ntimes,
+                          'size':{'ntimes':ntimes, 'grid':[ny, nx]}})
+        if 'render' in kinds and smallest:
+            nframes = min(frames, ntimes)
+            specs.append({'name':'render_olr', 'kind':'render', 'path':path,
+                          'frames':nframes,
+                          'size':{'frames':nframes, 'grid':[ny, nx]}})
+        if 'startup' in kinds and smallest:
+            specs.append({'name':'startup', 'kind':'startup', 'path':path,
+                          'runs':startup_runs,
+                          'size':{'runs':startup_runs, 'grid':[ny, nx]}})
+    for kind, make_file in (('asos', make_asos_file),
+                            ('sounding', make_sounding_file)):
+        if kind not in kinds:
+            continue
+        for nrows in csv_rows:
+            path = os.path.join(workdir, '{}_{}.csv'.format(kind, nrows))
+            if not os.path.isfile(path):
+                if verbose: print('Generating {}...'.format(path))
+                make_file(path, nrows)
+            specs.append({'name':'{}_{}rows'.format(kind, nrows), 'kind':kind,
+                          'path':path, 'nrows':nrows,
+                          'size':{'rows':nrows,
+                                  'mb':os.path.getsize(path) / 1e6}})
+
+    # Run each case in its own process ([repeat] times)
+    results = {'meta':{'date':'{:%Y-%m-%d %H:%M}'.format(datetime.now()),
+                       'python':platform.python_version(),
+                       'numpy':np.__version__, 'platform':platform.platform(),
+                       'cpus':os.cpu_count(), 'repeat':repeat},
+               'cases':{}}
+    for spec in specs:
+        runs = [_run_in_subprocess(spec) for r in range(repeat)]
+        result = runs[0]
+        result['stages'] = {stage:min(run['stages'][stage] for run in runs)
+                            for stage in result['stages']}
+        if result['peak_rss_mb'] is not None:
+            result['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+        results['cases'][spec['name']] = result
+        if verbose: _print_case(spec['name'], result)
+    return results
+
+
+
+def compare_results(old, new, threshold=0.2, min_seconds=0.01):
+    """
+    Compares two sets of benchmark results (see run_benchmarks).
+
+    Requires:
+        old, new ----> the results of the two runs (dictionaries)
+        threshold ---> relative increase of a time or of the peak memory use
+                       that counts as a regression (float; 0.2 = 20%)
+        min_seconds -> times that changed by less than this many seconds are
+                       never regressions (they are too noisy)
+
+    Returns:
+        rows --------> a list of (case, stage, old value, new value, ratio,
+                       regressed) tuples for every stage (and 'peak_rss_mb')
+                       of the cases in both runs
+    """
+    rows = []
+    for name in sorted(set(old['cases']) & set(new['cases'])):
+        a, b = old['cases'][name], new['cases'][name]
+        pairs = [(stage, a['stages'][stage], b['stages'][stage], min_seconds)
+                 for stage in a['stages'] if stage in b['stages']]
+        if a['peak_rss_mb'] is not None and b['peak_rss_mb'] is not None:
+            # (only the memory used by the benchmark itself is compared)
+            pairs.append(('peak_rss_mb', a['peak_rss_mb'] - a['base_rss_mb'],
+                          b['peak_rss_mb'] - b['base_rss_mb'], 1.))
+        for stage, x, y, noise in pairs:
+            ratio = y / x if x > 0 else float('inf') if y > 0 else 1.
+            rows.append((name, stage, x, y, ratio,
+                         y - x > noise and ratio > 1. + threshold))
+    return rows
+
+
+
+def _print_case(name, result):
+    """
+    Prints the result of one benchmark case.
+    """
+    stages = '  '.join('{} {:8.4f} s'.format(stage, seconds) for stage, seconds
+                       in result['stages'].items())
+    rss = '' if result['peak_rss_mb'] is None else \
+          '  peak RSS {:7.1f} MB'.format(result['peak_rss_mb'])
+    print('{:24s} {}{}'.format(name, stages, rss))
+
+
+
+def main(argv=None):
+    """
+    The command line interface (see the module docstring).
+    """
+    parser = argparse.ArgumentParser(description='Benchmarks for the data '
+                                     'loaders and plotting functions.')
+    commands = parser.add_subparsers(dest='command')
+    run = commands.add_parser('run', help='generate inputs and run benchmarks')
+    run.add_argument('--sizes', choices=sorted(SIZES), default='small',
+                     help='preset input sizes (default: small)')
+    run.add_argument('--narr-steps', type=int, nargs='+',
+                     help='NARR time steps (overrides --sizes)')
+    run.add_argument('--csv-rows', type=int, nargs='+',
+                     help='ASOS/RAOB rows (overrides --sizes)')
+    run.add_argument('--grid', default='60x80',
+                     help='NARR grid size NYxNX (the real NARR grid is '
+                     '277x349)')
+    run.add_argument('--frames', type=int, default=3,
+                     help='maps rendered by the render benchmark')
+    run.add_argument('--only', nargs='+', choices=sorted(_BENCHMARKS),
+                     help='only run these benchmarks')
+    run.add_argument('--repeat', type=int, default=1,
+                     help='runs of each case (the fastest is kept)')
+    run.add_argument('--startup-runs', type=int, default=5,
+                     help='runs of each command timed by the startup benchmark')
+    run.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(),
+                     'atmos_benchmarks'), help='directory for the inputs')
+    run.add_argument('-o', '--output', default='benchmark_results.json',
+                     help='results file (default: benchmark_results.json)')
+    compare = commands.add_parser('compare', help='compare two results files')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.2,
+                         help='relative slowdown that is flagged (default 0.2)')
+    case = commands.add_parser('case') # (used internally by "run")
+    case.add_argument('spec')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        ny, nx = (int(n) for n in args.grid.lower().split('x'))
+        results = run_benchmarks(args.narr_steps or SIZES[args.sizes]['narr'],
+                                 args.csv_rows or SIZES[args.sizes]['csv'],
+                                 args.workdir, grid=(ny, nx),
+                                 frames=args.frames, repeat=args.repeat,
+                                 kinds=args.only,
+                                 startup_runs=args.startup_runs)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Saved the results to {}'.format(args.output))
+    elif args.command == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows = compare_results(old, new, threshold=args.threshold)
+        print('{:24s} {:12s} {:>10s} {:>10s} {:>7s}'.format('case', 'stage',
+              'old', 'new', 'ratio'))
+        for name, stage, x, y, ratio, regressed in rows:
+            print('{:24s} {:12s} {:10.4f} {:10.4f} {:7.2f}{}'.format(name,
+                  stage, x, y, ratio, '  REGRESSION' if regressed else ''))
+        nbad = sum(row[-1] for row in rows)
+        print('{} regression(s) in {} comparisons'.format(nbad, len(rows)))
+        return 1 if nbad else 0
+    elif args.command == 'case':
+        print(json.dumps(_run_case(json.loads(args.spec))))
+    else:
+        parser.print_help()
+    return 0
+
+
+
+# Any code within the following block with be executed when this module is
+# run as a script (e.g., "python benchmarks.py run")
+if __name__ == '__main__':
+    sys.exit(main())
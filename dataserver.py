@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+An asyncio data server that keeps parsed ASOS, RAOB and NARR data warm in one
+process, and the client API to query it over a local socket.
+
+Start the server (it runs until it is interrupted):
+    python dataserver.py [--socket PATH] [--workers N]
+
+Then, from any number of processes/request handlers:
+    from dataserver import DataClient
+    with DataClient() as client:
+        metdata = client.get_meteorogram('ORD', dt1, dt2)
+        sounding = client.get_sounding('KILX', date)
+        narr = client.get_narr(dt1, dt2, variables=['t2m', 'mslp'])
+(or, within asyncio code, "client = await AsyncDataClient.connect()" and
+"await client.get_meteorogram(...)", which can have many queries in flight
+over one connection). The results are the same as those of
+ut.get_meteorogram(), ut.get_sounding() and ut.load_narr_data() (the NARR
+data as a dictionary of numpy arrays over the requested times).
+
+Each query is run in a thread pool, so slow file reads don't hold up other
+queries. Identical queries that arrive while one is already running share its
+result instead of loading the data again.
+
+The protocol: each message is a 4-byte header length and a 4-byte payload
+length (big-endian), a JSON header, and the payload: the raw bytes of every
+array in the message, one after another. The header of a request is
+{'id', 'op', 'args'}; the header of a response is {'id', 'error', 'result',
+'arrays'}, where the arrays in 'result' are replaced by {'__array__': i} and
+'arrays' lists the (dtype, shape) of each array in the payload.
+
+@author: njweber2
+"""
+import numpy as np
+from datetime import datetime
+import asyncio
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import utilities as ut
+import instrument
+
+# The header/payload lengths that start every message
+_PREFIX = struct.Struct('!II')
+
+
+
+def get_socket_path():
+    """
+    Returns the default path of the data server's (unix) socket.
+    """
+    return os.path.join(tempfile.gettempdir(), 'atmos_dataserver.sock')
+
+
+
+######################################################################
+### SERVER ###########################################################
+######################################################################
+
+class DataServer(object):
+    """
+    Answers meteorogram, sounding and NARR queries (see the module docstring)
+    on a unix socket, keeping the parsed data in memory between queries.
+
+    Requires:
+        path -----> (optional) the socket path (default: get_socket_path())
+        workers --> number of threads that run the queries (int)
+    """
+    def __init__(self, path=None, workers=4):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.path = get_socket_path() if path is None else path
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._inflight = {}  # {query key: Future of the encoded result}
+        self._locks = {}     # {data file: threading.Lock}
+        self._lock = threading.Lock()
+        self._narr = {}      # {NARR file: (file key, NarrDataset, TimeIndex)}
+        self._ops = {'ping':self._ping, 'meteorogram':self._meteorogram,
+                     'sounding':self._sounding, 'narr':self._narr_slice}
+
+    async def serve(self):
+        """
+        Runs the server (until it is cancelled).
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle, path=self.path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    async def _handle(self, reader, writer):
+        """
+        Serves one connection: each request is answered in its own task, so
+        a connection can have many requests in flight.
+        """
+        sendlock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    header, payload = await _read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                task = asyncio.ensure_future(self._answer(header, writer,
+                                                          sendlock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def _answer(self, request, writer, sendlock):
+        """
+        Runs one request (or waits for an identical one that is already
+        running) and sends the response.
+        """
+        try:
+            op, args = request['op'], request.get('args', {})
+            if op not in self._ops:
+                raise ValueError('ERROR: unknown query "{}"!'.format(op))
+            key = json.dumps([op, args], sort_keys=True)
+            future = self._inflight.get(key)
+            if future is None:
+                loop = asyncio.get_event_loop()
+                future = loop.run_in_executor(self.executor, self._run, op,
+                                              args)
+                self._inflight[key] = future
+                future.add_done_callback(
+                    lambda f: self._inflight.pop(key, None))
+            else:
+                instrument.count('dataserver.coalesced')
+            error, (encoded, arrays) = None, await asyncio.shield(future)
+        except Exception as err:
+            error = str(err) if isinstance(err, ValueError) else \
+                    '{}: {}'.format(type(err).__name__, err)
+            encoded, arrays = {'result':None, 'arrays':[]}, []
+        header = {'id':request.get('id'), 'error':error}
+        header.update(encoded)
+        async with sendlock:
+            _write_message(writer, header, arrays)
+            await writer.drain()
+
+    def _run(self, op, args):
+        """
+        Runs query [op] (in a worker thread) and encodes its result.
+        """
+        with instrument.stage('dataserver.' + op):
+            return _encode(self._ops[op](**args))
+
+    def _file_lock(self, path):
+        """
+        Returns the lock that serializes loading/reading the data file [path]
+        (the loaders and netCDF4 aren't safe to run on one file from several
+        threads at once).
+        """
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def _ping(self):
+        return 'pong'
+
+    def _meteorogram(self, stid, dt1, dt2, csvfile=None):
+        path, _ = ut.station_file('asos', stid, csvfile)
+        with self._file_lock(path):
+            return ut.get_meteorogram(stid, _parse_time(dt1), _parse_time(dt2),
+                                      csvfile=csvfile)
+
+    def _sounding(self, stid, date, csvfile=None):
+        path, _ = ut.station_file('sounding', stid, csvfile)
+        with self._file_lock(path):
+            return ut.get_sounding(stid, _parse_time(date), csvfile=csvfile)
+
+    def _narr_slice(self, dt1, dt2, variables=None, ncfile='narr_oct2010.nc'):
+        path = os.path.join(ut.get_datadir(), ncfile)
+        with self._file_lock(path):
+            # Keep one NarrDataset (and its chunk cache) per file, over all
+            # of its times, and slice the requested times out of it
+            try:
+                key = ut.file_key(path)
+            except OSError:
+                raise ValueError('ERROR: could not read "{}"!'.format(path))
+            if path not in self._narr or self._narr[path][0] != key:
+                narr = ut.load_narr_data(datetime(1, 1, 1),
+                                         datetime(9999, 12, 31), ncfile=ncfile)
+                self._narr[path] = (key, narr, ut.TimeIndex(narr['dates']))
+            _, narr, index = self._narr[path]
+
+            subset = index.slice(_parse_time(dt1), _parse_time(dt2))
+            if variables is None:
+                variables = list(narr.variables.keys())
+            result = {'dates':index.times[subset].astype(datetime), 
+                      'lats':narr['lats'],
+                      'lons':narr['lons']}
+            for var in variables:
+                if var not in narr.variables:
+                    raise ValueError('ERROR: no variable "{}" in {}!'.format(
+                                     var, ncfile))
+                result[var] = narr[var][subset]
+            return result
+
+
+
+def serve(path=None, workers=4):
+    """
+    Runs a DataServer (see the module docstring) until it is interrupted.
+    """
+    try:
+        asyncio.run(DataServer(path, workers=workers).serve())
+    except KeyboardInterrupt:
+        pass
+
+
+
+######################################################################
+### CLIENTS ##########################################################
+######################################################################
+
+class DataClient(object):
+    """
+    A (blocking) connection to a DataServer. Each method returns the same
+    data as the utilities.py function of the same name.
+
+    Requires:
+        path --> (optional) the server's socket path (default:
+                 get_socket_path())
+    """
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(get_socket_path() if path is None else path)
+        self._file = self.sock.makefile('rb')
+        self._nextid = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+    def request(self, op, **args):
+        """
+        Sends query [op] with arguments [args] and returns its result.
+        """
+        self._nextid += 1
+        header = _request_header(self._nextid, op, args)
+        self.sock.sendall(b''.join(_pack_message(header, [])))
+        prefix = self._file.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise ConnectionError('the data server closed the connection')
+        nheader, npayload = _PREFIX.unpack(prefix)
+        header = json.loads(self._file.read(nheader).decode())
+        return _decode(header, bytearray(self._file.read(npayload)))
+
+    def get_meteorogram(self, stid, dt1, dt2, csvfile=None):
+        return self.request('meteorogram', stid=stid, dt1=dt1, dt2=dt2,
+                            csvfile=csvfile)
+
+    def get_sounding(self, stid, date, csvfile=None):
+        return self.request('sounding', stid=stid, date=date, csvfile=csvfile)
+
+    def get_narr(self, dt1, dt2, variables=None, ncfile='narr_oct2010.nc'):
+        """
+        Returns the NARR data from [dt1] through [dt2] as a dictionary with
+        the keys 'dates', 'lats', 'lons', and each of [variables] (default:
+        all of them). See ut.load_narr_data().
+        """
+        return self.request('narr', dt1=dt1, dt2=dt2, variables=variables,
+                            ncfile=ncfile)
+
+
+
+class AsyncDataClient(object):
+    """
+    An asyncio connection to a DataServer, which can have many queries in
+    flight at once. Create it with "await AsyncDataClient.connect(path)";
+    its methods are coroutines that return the same data as those of a
+    DataClient.
+    """
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self._nextid = 0
+        self._waiting = {}  # {request id: Future}
+        self._error = None  # (set once the connection is lost)
+        self._receiver = asyncio.ensure_future(self._receive())
+
+    @classmethod
+    async def connect(cls, path=None):
+        reader, writer = await asyncio.open_unix_connection(
+                         get_socket_path() if path is None else path)
+        return cls(reader, writer)
+
+    async def close(self):
+        self._receiver.cancel()
+        self.writer.close()
+        self._fail(ConnectionError('the connection to the data server is '
+                                   'closed'))
+
+    async def _receive(self):
+        """
+        Hands each response to the query that is waiting for it. If the
+        connection is lost (or a response can't be read), every waiting
+        query fails, and so does every later one.
+        """
+        try:
+            while True:
+                header, payload = await _read_message(self.reader)
+                future = self._waiting.pop(header['id'], None)
+                if future is not None and not future.done():
+                    future.set_result((header, payload))
+        except asyncio.IncompleteReadError:
+            self._fail(ConnectionError('the data server closed the '
+                                       'connection'))
+        except Exception as err:
+            self._fail(ConnectionError('lost the data server connection '
+                                       '({}: {})'.format(type(err).__name__,
+                                                         err)))
+
+    def _fail(self, error):
+        """
+        Fails the waiting queries (and all later ones) with [error].
+        """
+        if self._error is None:
+            self._error = error
+        for future in self._waiting.values():
+            if not future.done():
+                future.set_exception(self._error)
+        self._waiting.clear()
+
+    async def request(self, op, **args):
+        """
+        Sends query [op] with arguments [args] and returns its result.
+        Raises a ConnectionError if the connection to the server is lost.
+        """
+        if self._error is not None:
+            raise self._error
+        self._nextid += 1
+        rid = self._nextid
+        future = asyncio.get_event_loop().create_future()
+        self._waiting[rid] = future
+        try:
+            _write_message(self.writer, _request_header(rid, op, args), [])
+            await self.writer.drain()
+        except Exception:
+            self._waiting.pop(rid, None)
+            raise
+        header, payload = await future
+        return _decode(header, payload)
+
+    async def get_meteorogram(self, stid, dt1, dt2, csvfile=None):
+        return await self.request('meteorogram', stid=stid, dt1=dt1, dt2=dt2,
+                                  csvfile=csvfile)
+
+    async def get_sounding(self, stid, date, csvfile=None):
+        return await self.request('sounding', stid=stid, date=date,
+                                  csvfile=csvfile)
+
+    async def get_narr(self, dt1, dt2, variables=None,
+                       ncfile='narr_oct2010.nc'):
+        return await self.request('narr', dt1=dt1, dt2=dt2,
+                                  variables=variables, ncfile=ncfile)
+
+
+
+######################################################################
+### MESSAGES #########################################################
+######################################################################
+
+def _request_header(rid, op, args):
+    """
+    Returns the header of a request (datetimes are sent as ISO strings).
+    """
+    args = {k:(v.isoformat() if isinstance(v, datetime) else v) for k, v in \
+            args.items()}
+    return {'id':rid, 'op':op, 'args':args}
+
+
+
+def _parse_time(value):
+    """
+    Converts an ISO time string (from a request) to a datetime object.
+    """
+    try:
+        return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        raise ValueError('ERROR: invalid time "{}"!'.format(value))
+
+
+
+def _pack_message(header, arrays):
+    """
+    Returns the pieces (bytes-like objects) of a message.
+    """
+    data = json.dumps(header).encode()
+    npayload = sum(array.nbytes for array in arrays)
+    return [_PREFIX.pack(len(data), npayload), data] + \
+           [memoryview(array.reshape(-1).view(np.uint8)) for array in arrays]
+
+
+
+def _write_message(writer, header, arrays):
+    """
+    Writes a message to an asyncio stream (see _pack_message).
+    """
+    writer.writelines(_pack_message(header, arrays))
+
+
+
+async def _read_message(reader):
+    """
+    Reads a message from an asyncio stream.
+
+    Returns:
+        header ---> the decoded JSON header (dictionary)
+        payload --> the raw bytes of the arrays (bytearray)
+    """
+    nheader, npayload = _PREFIX.unpack(await reader.readexactly(_PREFIX.size))
+    header = json.loads((await reader.readexactly(nheader)).decode())
+    payload = bytearray(await reader.readexactly(npayload))
+    return header, payload
+
+
+
+def _encode(result):
+    """
+    Encodes the result of a query for a response.
+
+    Returns:
+        encoded -> a dictionary with the keys 'result' ([result] with each
+                   numpy array replaced by {'__array__': i} (masked arrays
+                   also get a 'mask' array, and arrays of datetime objects
+                   are sent as datetime64 with 'datetime': True), and 
+                   datetime objects replaced by {'__datetime__': ISO 
+                   string}) and 'arrays' (the (dtype, shape) of each array)
+        arrays --> the list of (contiguous) arrays
+    """
+    arrays = []
+    def add(array):
+        arrays.append(np.ascontiguousarray(array))
+        return len(arrays) - 1
+
+    def encode(value):
+        if isinstance(value, dict):
+            return {k:encode(v) for k, v in value.items()}
+        if isinstance(value, datetime):
+            return {'__datetime__':value.isoformat()}
+        if isinstance(value, np.ndarray):
+            if value.dtype == object: # (datetime objects)
+                return {'__array__':add(value.astype('datetime64[us]')),
+                        'datetime':True}
+            code = {'__array__':add(np.ma.getdata(value))}
+            if np.ma.getmask(value) is not np.ma.nomask:
+                code['mask'] = add(np.ma.getmaskarray(value))
+            return code
+        return value
+    result = encode(result)
+    return {'result':result, 'arrays':[(a.dtype.str, a.shape) for a in
+                                       arrays]}, arrays
+
+
+
+def _decode(header, payload):
+    """
+    Decodes the result in a response (see _encode), raising a ValueError if
+    the query failed.
+    """
+    if header['error'] is not None:
+        raise ValueError(header['error'])
+    arrays = []
+    offset = 0
+    for dtype, shape in header['arrays']:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays.append(np.frombuffer(payload, dtype=dtype, count=count,
+                                    offset=offset).reshape(shape))
+        offset += count * dtype.itemsize
+
+    def decode(value):
+        if isinstance(value, dict):
+            if '__datetime__' in value:
+                return datetime.strptime(value['__datetime__'][:19],
+                                         '%Y-%m-%dT%H:%M:%S')
+            if '__array__' in value:
+                array = arrays[value['__array__']]
+                if value.get('datetime'):
+                    return array.astype(datetime)
+                if 'mask' in value:
+                    return np.ma.array(array, mask=arrays[value['mask']])
+                return array
+            return {k:decode(v) for k, v in value.items()}
+        return value
+    return decode(header['result'])
+
+
+
+# Any code within the following block with be executed when this module is
+# run as a script (e.g., "python dataserver.py")
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serves ASOS, RAOB and NARR '
+                                     'data over a local socket.')
+    parser.add_argument('--socket', default=get_socket_path(),
+                        help='the socket path (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of query threads (default: 4)')
+    args = parser.parse_args()
+    print('Serving data on {}'.format(args.socket))
+    serve(args.socket, workers=args.workers)
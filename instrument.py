@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Module containing lightweight, opt-in instrumentation for the data loaders
+and plotting functions: stage timers, counters and progress messages.
+
+Instrumentation is off by default, and then every hook returns immediately
+(a stage costs one function call and an empty "with" block). Turn it on for
+a run with enable() (or by setting the ATMOS_TRACE environment variable to a
+filename, which also saves a Chrome trace there when Python exits):
+
+    import instrument
+    instrument.enable()
+    plot_narr_olr(dt1, dt2)
+    print(instrument.report())
+    instrument.export_chrome_trace('trace.json') # open in chrome://tracing
+                                                 # or ui.perfetto.dev
+
+The hooks used by the other modules are:
+    with stage('name', key=value, ...): ...  --> times a stage
+    count('name', n)                         --> adds n to a counter
+    note('message')                          --> a progress message, printed
+                                                 within "with printing(True)"
+
+@author: njweber2
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+_enabled = False
+_echo = False
+_events = []   # (name, start [s], duration [s], pid, thread id, args)
+_counters = {}
+_notes = []    # (message, time [s], pid, thread id)
+
+
+
+def enable():
+    """
+    Turns the instrumentation on (the data collected so far is kept).
+    """
+    global _enabled
+    _enabled = True
+
+
+
+def disable():
+    """
+    Turns the instrumentation off (the data collected so far is kept).
+    """
+    global _enabled
+    _enabled = False
+
+
+
+def is_enabled():
+    """
+    Returns True if the instrumentation is on.
+    """
+    return _enabled
+
+
+
+def reset():
+    """
+    Discards all of the collected stages, counters and messages.
+    """
+    del _events[:]
+    del _notes[:]
+    _counters.clear()
+
+
+
+class _Stage(object):
+    """
+    Times one stage (a "with" block; see stage()).
+    """
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _events.append((self.name, self.start, end - self.start, os.getpid(),
+                        threading.get_ident(), self.args))
+        return False
+
+
+
+class _NoStage(object):
+    """
+    The stage used while the instrumentation is off: it does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_STAGE = _NoStage()
+
+
+
+def stage(name, **args):
+    """
+    Returns a context manager that times the "with" block it wraps as the
+    stage [name] (string; e.g., 'narr.read'). Any keyword arguments are
+    saved with the stage (they appear in the Chrome trace).
+    """
+    if not _enabled:
+        return _NO_STAGE
+    return _Stage(name, args)
+
+
+
+def count(name, n=1):
+    """
+    Adds [n] to the counter [name] (string; e.g., 'csv.rows_parsed').
+    """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+
+def note(message):
+    """
+    Records a progress message. It is printed if printing is on (see
+    printing()), and saved with the trace if the instrumentation is on.
+    """
+    if _echo:
+        print(message)
+    if _enabled:
+        _notes.append((message, time.perf_counter(), os.getpid(),
+                       threading.get_ident()))
+
+
+
+class printing(object):
+    """
+    A context manager that prints the progress messages (see note()) within
+    its "with" block if [on] is True. This is what the "verbose" arguments
+    of the plotting functions do.
+    """
+    def __init__(self, on=True):
+        self.on = on
+
+    def __enter__(self):
+        global _echo
+        self.previous = _echo
+        _echo = _echo or bool(self.on)
+        return self
+
+    def __exit__(self, *exc):
+        global _echo
+        _echo = self.previous
+        return False
+
+
+
+def drain():
+    """
+    Returns (and discards) the data collected so far in this process, to be
+    passed on to merge() in another process (e.g., by a worker process).
+    """
+    data = {'events':list(_events), 'counters':dict(_counters),
+            'notes':list(_notes)}
+    reset()
+    return data
+
+
+
+def merge(data):
+    """
+    Adds the data collected by another process (see drain()).
+    """
+    _events.extend(data['events'])
+    _notes.extend(data['notes'])
+    for name, n in data['counters'].items():
+        _counters[name] = _counters.get(name, 0) + n
+
+
+
+def summary():
+    """
+    Returns the collected data, aggregated by stage.
+
+    Returns:
+        summary -> a dictionary with the keys:
+                   'stages'   : {stage name: {'calls', 'total', 'mean', 'max'}}
+                                (times in seconds)
+                   'counters' : {counter name: value}
+    """
+    stages = {}
+    for name, start, duration, pid, tid, args in _events:
+        s = stages.setdefault(name, {'calls':0, 'total':0., 'max':0.})
+        s['calls'] += 1
+        s['total'] += duration
+        s['max'] = max(s['max'], duration)
+    for s in stages.values():
+        s['mean'] = s['total'] / s['calls']
+    return {'stages':stages, 'counters':dict(_counters)}
+
+
+
+def report():
+    """
+    Returns a per-run report (a string) of the time taken by each stage (in
+    order of the total time) and the value of each counter.
+    """
+    data = summary()
+    lines = ['{:28s} {:>7s} {:>10s} {:>10s} {:>10s}'.format('stage', 'calls',
+             'total [s]', 'mean [ms]', 'max [ms]')]
+    for name, s in sorted(data['stages'].items(), key=lambda x: -x[1]['total']):
+        lines.append('{:28s} {:7d} {:10.3f} {:10.3f} {:10.3f}'.format(name,
+                     s['calls'], s['total'], s['mean'] * 1e3, s['max'] * 1e3))
+    if data['counters']:
+        lines.append('')
+        lines.append('{:28s} {:>18s}'.format('counter', 'value'))
+        for name, n in sorted(data['counters'].items()):
+            lines.append('{:28s} {:>18,}'.format(name, n))
+    return '\n'.join(lines)
+
+
+
+def export_chrome_trace(path):
+    """
+    Saves the collected stages and messages to [path] as a Chrome trace (JSON
+    in the "Trace Event Format"), with one row per process and thread. The
+    counters are saved in the trace's metadata.
+    """
+    events = []
+    for name, start, duration, pid, tid, args in _events:
+        events.append({'name':name, 'cat':name.split('.')[0], 'ph':'X',
+                       'ts':start * 1e6, 'dur':duration * 1e6, 'pid':pid,
+                       'tid':tid, 'args':{k:str(v) for k, v in args.items()}})
+    for message, t, pid, tid in _notes:
+        events.append({'name':message, 'cat':'note', 'ph':'i', 's':'t',
+                       'ts':t * 1e6, 'pid':pid, 'tid':tid})
+    events.sort(key=lambda e: e['ts'])
+    with open(path, 'w') as f:
+        json.dump({'traceEvents':events, 'displayTimeUnit':'ms',
+                   'otherData':{'counters':dict(_counters)}}, f)
+
+
+
+def _export_at_exit(path):
+    """
+    Saves the Chrome trace to [path] when the main process exits (worker
+    processes pass their data on to it instead; see drain()).
+    """
+    import multiprocessing
+    if multiprocessing.parent_process() is None:
+        export_chrome_trace(path)
+
+
+
+# Turn the instrumentation on for the whole run if ATMOS_TRACE is set
+if os.environ.get('ATMOS_TRACE'):
+    enable()
+    atexit.register(_export_at_exit, os.environ['ATMOS_TRACE'])
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A persistent plot worker: one long-running process that has already imported
+matplotlib (and drawn the base map of the NARR maps) plots figures on request,
+so that short plot commands don't pay for starting Python, importing
+matplotlib and building the map every time.
+
+Start the worker (it runs until it is interrupted):
+    python plotserver.py serve [--socket PATH] [--no-narr]
+
+Then plot from the command line:
+    python plotserver.py sounding KILX 2010102512
+    python plotserver.py meteorogram ORD 2010102500 2010102600
+    python plotserver.py olr 2010102500 2010102521 [--output gif]
+    python plotserver.py t2m_mslp 2010102500 2010102521
+or from Python:
+    from plotserver import PlotClient
+    with PlotClient() as client:
+        client.plot('sounding', stid='KILX', date=date)
+This module only imports the standard library, so the command line client
+starts quickly. If no worker is running, the command line client plots in
+its own process instead (unless --no-local is given).
+
+The worker plots one figure at a time, in the order the requests arrive
+(matplotlib isn't thread-safe). The protocol: each request is one line of
+JSON, {'op', 'args'}, with the times as ISO strings; each response is one
+line of JSON, {'error', 'seconds'}.
+
+@author: njweber2
+"""
+from datetime import datetime
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+# The plot commands: {name: (plotting_functions.py function, time arguments)}
+_COMMANDS = {'meteorogram':('plot_meteorogram', ('dt1', 'dt2')),
+             'sounding':('plot_sounding', ('date',)),
+             'olr':('plot_narr_olr', ('dt1', 'dt2')),
+             't2m_mslp':('plot_narr_t2m_mslp', ('dt1', 'dt2'))}
+
+
+
+def get_socket_path():
+    """
+    Returns the default path of the plot worker's (unix) socket.
+    """
+    return os.path.join(tempfile.gettempdir(), 'atmos_plotserver.sock')
+
+
+
+######################################################################
+### SERVER ###########################################################
+######################################################################
+
+class PlotServer(object):
+    """
+    Runs plot commands (see _COMMANDS) sent to a unix socket, in a process
+    that keeps matplotlib (and the NARR map template) loaded between commands.
+
+    Requires:
+        path --> (optional) the socket path (default: get_socket_path())
+        narr --> if True, the NARR map template is drawn before the first 
+                 command (see plotting_functions.preload)
+    """
+    def __init__(self, path=None, narr=True):
+        self.path = get_socket_path() if path is None else path
+        self.narr = narr
+
+    def serve(self):
+        """
+        Does the one-time setup, then runs the commands of each connection,
+        in order, until it is interrupted.
+        """
+        import plotting_functions as pf
+        self.pf = pf
+        start = time.perf_counter()
+        pf.preload(narr=self.narr)
+        print('Ready in {:.2f} s; plotting on {}'.format(
+              time.perf_counter() - start, self.path))
+        sys.stdout.flush()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.path)
+            listener.listen(16)
+            while True:
+                conn, _ = listener.accept()
+                try:
+                    with conn, conn.makefile('rwb') as stream:
+                        for line in stream:
+                            stream.write(json.dumps(self._run(line)).encode()
+                                         + b'\n')
+                            stream.flush()
+                except OSError: # (the client went away)
+                    pass
+        finally:
+            listener.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _run(self, line):
+        """
+        Runs one request (a line of JSON) and returns the response.
+        """
+        start = time.perf_counter()
+        try:
+            request = json.loads(line.decode())
+            op, args = request['op'], request.get('args', {})
+            if op != 'ping':
+                _plot(self.pf, op, _parse_args(op, args))
+            error = None
+        except Exception as err:
+            error = str(err) if isinstance(err, ValueError) else \
+                    '{}: {}'.format(type(err).__name__, err)
+        return {'error':error, 'seconds':time.perf_counter() - start}
+
+
+
+def serve(path=None, narr=True):
+    """
+    Runs a PlotServer (see the module docstring) until it is interrupted.
+    """
+    try:
+        PlotServer(path, narr=narr).serve()
+    except KeyboardInterrupt:
+        pass
+
+
+
+######################################################################
+### CLIENT ###########################################################
+######################################################################
+
+class PlotClient(object):
+    """
+    A connection to a PlotServer.
+
+    Requires:
+        path --> (optional) the worker's socket path (default:
+                 get_socket_path())
+    """
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(get_socket_path() if path is None else path)
+        except OSError:
+            self.sock.close()
+            raise
+        self._file = self.sock.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
+
+    def request(self, op, **args):
+        """
+        Sends command [op] with the arguments [args] (datetimes are sent as
+        ISO strings) and waits for it to finish.
+
+        Returns:
+            seconds -> the time the worker took to run the command (float)
+        """
+        args = {k:(v.isoformat() if isinstance(v, datetime) else v) for k, v
+                in args.items()}
+        line = json.dumps({'op':op, 'args':args}).encode() + b'\n'
+        self.sock.sendall(line)
+        response = self._file.readline()
+        if not response:
+            raise ConnectionError('the plot worker closed the connection')
+        response = json.loads(response.decode())
+        if response['error'] is not None:
+            raise ValueError(response['error'])
+        return response['seconds']
+
+    def ping(self):
+        return self.request('ping')
+
+    def plot(self, op, **args):
+        """
+        Plots a figure: [op] is 'meteorogram', 'sounding', 'olr' or
+        't2m_mslp', and [args] are the arguments of its plotting function
+        (e.g., plot_sounding(stid, date)).
+        """
+        if op not in _COMMANDS:
+            raise ValueError('ERROR: unknown plot command "{}"!'.format(op))
+        return self.request(op, **args)
+
+
+
+def _plot(pf, op, args):
+    """
+    Runs plot command [op] with the (parsed) arguments [args], using the
+    plotting_functions module [pf].
+    """
+    if op not in _COMMANDS:
+        raise ValueError('ERROR: unknown plot command "{}"!'.format(op))
+    getattr(pf, _COMMANDS[op][0])(**args)
+
+
+
+def _parse_args(op, args):
+    """
+    Returns the arguments of a plot command, with its times (ISO strings)
+    converted to datetime objects.
+    """
+    args = dict(args)
+    for name in _COMMANDS.get(op, ('', ()))[1]:
+        if name in args:
+            args[name] = _parse_time(args[name])
+    return args
+
+
+
+def _parse_time(value):
+    """
+    Converts a time string ("YYYYMMDDHH" or ISO, e.g. "2010-10-25T12:00") to
+    a datetime object. (This is a copy of ut.parse_time, so that the client
+    doesn't have to import numpy.)
+    """
+    if isinstance(value, datetime):
+        return value
+    value = str(value)
+    formats = ['%Y%m%d%H'] if value.isdigit() and len(value) == 10 else \
+              ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', 
+               '%Y-%m-%dT%H']
+    for fmt in formats:
+        try:
+            return datetime.strptime(value[:19], fmt)
+        except ValueError:
+            pass
+    raise ValueError('ERROR: invalid time "{}"!'.format(value))
+
+
+
+def main(argv=None):
+    """
+    The command line interface (see the module docstring).
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description='A persistent plot worker, '
+                                     'and its command line client.')
+    commands = parser.add_subparsers(dest='command')
+    server = commands.add_parser('serve', help='run the plot worker')
+    server.add_argument('--no-narr', action='store_true',
+                        help="don't build the NARR map ahead of time")
+    clients = {'ping':commands.add_parser('ping', help='check the worker')}
+    for op, (function, times) in sorted(_COMMANDS.items()):
+        client = commands.add_parser(op, help='run {}()'.format(function))
+        if op in ('meteorogram', 'sounding'):
+            client.add_argument('stid', help='station ID')
+        for name in times:
+            client.add_argument(name, help='time (YYYYMMDDHH)')
+        client.add_argument('--force', action='store_true',
+                            help='re-render up-to-date figures')
+        if op in ('olr', 't2m_mslp'):
+            client.add_argument('--output', default='png',
+                                choices=['png', 'gif', 'webm', 'sprite'])
+            client.add_argument('--stations', nargs='+',
+                                help='only map the region around these')
+        clients[op] = client
+    for client in clients.values():
+        client.add_argument('--no-local', action='store_true',
+                            help='fail if no plot worker is running')
+    for command in [server] + list(clients.values()):
+        command.add_argument('--socket', default=get_socket_path(),
+                             help='the socket path (default: %(default)s)')
+    args = vars(parser.parse_args(argv))
+
+    command = args.pop('command')
+    if command is None:
+        parser.print_help()
+        return 0
+    path = args.pop('socket')
+    if command == 'serve':
+        serve(path, narr=not args['no_narr'])
+        return 0
+    local = not args.pop('no_local')
+    try:
+        args = _parse_args(command, args)
+        try:
+            client = PlotClient(path)
+        except OSError:
+            if not local or command == 'ping':
+                raise ValueError('ERROR: no plot worker is running on '
+                                 '{}!'.format(path))
+            print('(no plot worker is running; plotting in this process)')
+            start = time.perf_counter()
+            import plotting_functions as pf
+            _plot(pf, command, args)
+            seconds = time.perf_counter() - start
+        else:
+            with client:
+                seconds = client.request(command, **args)
+    except ValueError as err:
+        print(err)
+        return 1
+    print('{} done in {:.3f} s'.format(command, seconds))
+    return 0
+
+
+
+# Any code within the following block with be executed when this module is
+# run as a script (e.g., "python plotserver.py serve")
+if __name__ == '__main__':
+    sys.exit(main())
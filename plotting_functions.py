@@ -6,15 +6,18 @@ Module containing functions to plot atmospheric data in various forms.
 @author: njweber2
 """
 import utilities as ut    # our utilities.py file!
+import instrument         # stage timers/counters (see instrument.py)
 import numpy as np        # for doing math and dealing with arrays
-import matplotlib.pyplot as plt # plotting tools
 from datetime import datetime  # this allows us to make datetime objects
+import os                 # for file paths and environment variables
+# matplotlib.pyplot (our plotting tools) and basemap are slow to import, so
+# they are only imported once something is plotted (see _pyplot() below)
 # These following two lines will allow us to ignore the warnings that are
 # raised when using the basemap toolkit (which is being phased out).
 import warnings
 warnings.filterwarnings("ignore")
 
-def plot_meteorogram(stid, dt1, dt2):
+def plot_meteorogram(stid, dt1, dt2, force=False):
     """
     Plots and ASOS meteorogram (multi-panel weather timeseries plot) for a 
     given station and time range.
@@ -23,17 +26,53 @@ def plot_meteorogram(stid, dt1, dt2):
         stid -> tation ID (string)
         dt1 --> starting time (datetime object)
         dt2 --> ending time (datetime object)
+        force -> if True, the figure is re-rendered even if an up-to-date
+                 copy exists (see ut.RenderManifest)
         
     Returns:
         nothing! Saves figure as "meteorogram_[stid]_[dt1]-[dt2].png"
     """
     
     # Load the ASOS data dictionary using our function in utilities.py
-    metdata = ut.get_meteorogram(stid, dt1, dt2)
+    with instrument.stage('meteorogram.load', stid=stid):
+        metdata = ut.get_meteorogram(stid, dt1, dt2)
     # Now we have the ob. dates ('dates'), temperatures ('t'), dew point 
     # temperatures ('td'), wind directions ('wdir'), wind speeds ('wspd'), 
     # pressures ('pres'), and 1-hour precipitation values ('prec')
     
+    # Skip the figure if it was already rendered from the same data and code
+    manifest = ut.RenderManifest()
+    savefile = _meteorogram_file(stid, dt1, dt2)
+    key = _render_key(metdata, ('meteorogram', stid, dt1, dt2))
+    if not force and manifest.is_current(savefile, key):
+        instrument.count('figures_skipped')
+        return
+    
+    # Create the six-panel figure with _meteorogram_layout(), then plot the
+    # data onto it with _draw_meteorogram() (both below)
+    with instrument.stage('meteorogram.draw', stid=stid):
+        fig, axes = _meteorogram_layout()
+        _draw_meteorogram(axes, metdata, stid, dt1, dt2)
+    
+    # Save the figure as a .png file
+    with instrument.stage('meteorogram.savefig', stid=stid):
+        fig.savefig(savefile)
+    _pyplot().close(fig) # close this figures so we don't use tons of memory
+    instrument.count('figures_rendered')
+    manifest.record(savefile, key)
+    manifest.save()
+    
+    
+    
+def _meteorogram_layout():
+    """
+    Creates the (empty) six-panel meteorogram figure.
+    
+    Returns:
+        fig ---> the Figure object
+        axes --> an array of the six Axes objects (one per row)
+    """
+    plt = _pyplot() # plotting tools
     
     ######################################################################
     ### FILL IN THIS BLOCK ###############################################
@@ -43,6 +82,24 @@ def plot_meteorogram(stid, dt1, dt2):
     #       pro-tip: make it taller than it is wide using "figsize"
 
     
+    ######################################################################
+    ### END HERE #########################################################
+    ######################################################################
+    return fig, axes
+    
+    
+    
+def _draw_meteorogram(axes, metdata, stid, dt1, dt2):
+    """
+    Plots the ASOS data in [metdata] (see ut.get_meteorogram) for station 
+    [stid] onto the six [axes] of a meteorogram figure.
+    """
+    plt = _pyplot() # plotting tools
+    
+    ######################################################################
+    ### FILL IN THIS BLOCK ###############################################
+    ######################################################################
+    
     # TODO: plot the data onto the different axes
     # Let the dates be the x-axis values (matplotlib can handle datetimes)
     #   - row1 : temperature and dewpoint
@@ -72,32 +129,288 @@ def plot_meteorogram(stid, dt1, dt2):
     title = '{} meteorogram beginning {:%Y-%m-%d %H:00}'
     axes[0].set_title(title.format(stid, dt1), loc='left')
     
-    # Save the figure as a .png file
+    
+    
+def _meteorogram_file(stid, dt1, dt2):
+    """
+    Returns the .png filename of a meteorogram figure.
+    """
     figdir = ut.get_figdir() # find/create a "figures" directory here
     # each filename describes the figure type and date range
     savefile = '{}/meteorogram_{}_{:%b%d}-{:%b%d}.png'
-    plt.savefig(savefile.format(figdir, stid, dt1, dt2)) 
-    plt.close() # close this figures so we don't use tons of memory
+    return savefile.format(figdir, stid, dt1, dt2)
     
     
     
-def plot_sounding(stid, date):
+def plot_meteorograms(jobs, workers=None, verbose=True, force=False):
+    """
+    Plots ASOS meteorograms (see plot_meteorogram) for many stations and time
+    ranges. The jobs are grouped by station, so that each station's file is
+    loaded only once, and each process reuses one meteorogram figure for all
+    of its jobs (only the plotted data is replaced).
+    
+    Requires:
+        jobs ----> a list of (station ID, starting time, ending time) tuples
+        workers -> if > 1, the stations are spread across this many 
+                   processes (int)
+        verbose -> if True, prints a summary of the time taken by each job
+        force ---> if True, figures are re-rendered even if an up-to-date 
+                   copy exists (see ut.RenderManifest)
+        
+    Returns:
+        timings -> a list with one dictionary per job (in the order of [jobs])
+                   with the keys ('stid', 'dt1', 'dt2', 'load', 'draw', 
+                   'save', 'total', 'skipped', 'error'); the times are in
+                   seconds, and 'error' is the message of a failed job (or
+                   None)
+    """
+    _pyplot().ioff() # we don't want plots to display
+    
+    # Group the jobs by station: {stid: [(job #, dt1, dt2), ...]}
+    groups = {}
+    for j, (stid, dt1, dt2) in enumerate(jobs):
+        groups.setdefault(stid, []).append((j, dt1, dt2))
+    
+    # Plot each station's meteorograms, in this process (on one figure) or
+    # across a pool (on one figure per process; see _init_meteorogram_worker)
+    if workers is None or workers <= 1:
+        figure = MeteorogramFigure()
+        try:
+            results = [plot_meteorogram_group(stid, windows, force, figure) \
+                       for stid, windows in groups.items()]
+        finally:
+            figure.close()
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        n = len(groups)
+        with ProcessPoolExecutor(max_workers=workers, 
+                                 initializer=_init_meteorogram_worker,
+                                 initargs=(instrument.is_enabled(),)) as pool:
+            results = []
+            for group, collected in pool.map(_plot_meteorogram_group_worker, 
+                                             groups.keys(), groups.values(), 
+                                             [force] * n):
+                results.append(group)
+                instrument.merge(collected)
+    
+    # Collect the timings and record the new figures in the render manifest
+    manifest = ut.RenderManifest()
+    timings = [None] * len(jobs)
+    for group in results:
+        for j, timing, record in group:
+            timings[j] = timing
+            if record is not None:
+                manifest.record(*record)
+    manifest.save()
+    
+    if verbose:
+        _print_timings(timings)
+    return timings
+    
+    
+    
+class MeteorogramFigure(object):
+    """
+    The six-panel meteorogram figure that a sequence of meteorograms is drawn
+    on (see plot_meteorogram_group). It is made when the first meteorogram 
+    is drawn, and only the plotted data is replaced for the others, until 
+    close() is called.
+    """
+    def __init__(self):
+        self.fig = self.axes = None
+        
+    def clear(self):
+        """
+        Returns the (empty) figure and its six axes, for the next meteorogram.
+        """
+        if self.fig is None:
+            self.fig, self.axes = _meteorogram_layout()
+        else:
+            _clear_meteorogram(self.axes)
+        return self.fig, self.axes
+        
+    def close(self):
+        if self.fig is not None:
+            _pyplot().close(self.fig) # close this figure to free its memory
+            self.fig = self.axes = None
+
+
+
+def plot_meteorogram_group(stid, windows, force=False, figure=None):
+    """
+    Plots and saves the meteorograms (see plot_meteorogram) of one station
+    for several time ranges, all on one figure. 
+    Figures that are up to date in the render manifest are skipped (unless 
+    [force]). A failed meteorogram doesn't stop the others; its error is 
+    returned in its timing dictionary. The new figures are NOT recorded in
+    the render manifest, so that the caller can record them all at once.
+    
+    Requires:
+        stid ----> station ID (string)
+        windows -> a list of (job #, starting time, ending time) tuples; the
+                   job # (any value) identifies each meteorogram's results
+        force ---> if True, the figures are re-rendered even if an up-to-date
+                   copy exists (see ut.RenderManifest)
+        figure --> (optional) the MeteorogramFigure to draw on, which is left
+                   open for later calls; by default, a new figure is used and
+                   closed before returning
+        
+    Returns:
+        results -> a list of (job #, timing dictionary, record) tuples (see
+                   plot_meteorograms for the timings), where the record is the
+                   (savefile, key) of a new figure (see 
+                   ut.RenderManifest.record) or None
+    """
+    if figure is None:
+        figure = MeteorogramFigure()
+        try:
+            return plot_meteorogram_group(stid, windows, force, figure)
+        finally:
+            figure.close()
+    from time import perf_counter
+    
+    manifest = ut.RenderManifest()
+    results = []
+    for j, dt1, dt2 in windows:
+        timing = {'stid':stid, 'dt1':dt1, 'dt2':dt2, 'load':0., 'draw':0., 
+                  'save':0., 'skipped':False, 'error':None}
+        record = None
+        start = perf_counter()
+        try:
+            with instrument.stage('meteorogram.load', stid=stid):
+                metdata = ut.get_meteorogram(stid, dt1, dt2)
+            timing['load'] = perf_counter() - start
+            savefile = _meteorogram_file(stid, dt1, dt2)
+            key = _render_key(metdata, ('meteorogram', stid, dt1, dt2))
+            if not force and manifest.is_current(savefile, key):
+                timing['skipped'] = True
+                instrument.count('figures_skipped')
+            else:
+                tic = perf_counter()
+                with instrument.stage('meteorogram.draw', stid=stid):
+                    fig, axes = figure.clear()
+                    _draw_meteorogram(axes, metdata, stid, dt1, dt2)
+                timing['draw'] = perf_counter() - tic
+                tic = perf_counter()
+                with instrument.stage('meteorogram.savefig', stid=stid):
+                    fig.savefig(savefile)
+                timing['save'] = perf_counter() - tic
+                instrument.count('figures_rendered')
+                record = (savefile, key)
+        except Exception as err: # (a failed job doesn't stop the others)
+            timing['error'] = str(err) if isinstance(err, ValueError) else \
+                              '{}: {}'.format(type(err).__name__, err)
+        timing['total'] = perf_counter() - start
+        results.append((j, timing, record))
+    return results
+
+
+
+# The state of a meteorogram worker process: {'figure':...}
+_meteorogram_worker = {}
+
+def _init_meteorogram_worker(instrumented=False):
+    """
+    Sets up a worker process of plot_meteorograms(), with the 
+    instrumentation on if [instrumented]. The worker's MeteorogramFigure is 
+    used for all of its stations, and is freed when the worker exits.
+    """
+    instrument.reset() # (drop any data inherited from the parent process)
+    if instrumented:
+        instrument.enable()
+    _pyplot().ioff() # we don't want plots to display
+    _meteorogram_worker.update(figure=MeteorogramFigure())
+
+
+
+def _plot_meteorogram_group_worker(stid, windows, force):
+    """
+    Runs plot_meteorogram_group() in a worker process of plot_meteorograms().
+    
+    Returns:
+        the results of plot_meteorogram_group(), and the instrumentation 
+        data collected in this process since its last group (see 
+        instrument.drain())
+    """
+    results = plot_meteorogram_group(stid, windows, force, 
+                                     _meteorogram_worker['figure'])
+    return results, instrument.drain()
+
+
+
+def _clear_meteorogram(axes):
+    """
+    Removes the plotted data (lines, bars, ...) from meteorogram [axes] so that
+    the figure can be reused for another meteorogram.
+    """
+    for ax in axes:
+        for artists in (ax.lines, ax.collections, ax.patches, ax.texts):
+            for artist in list(artists):
+                artist.remove()
+        if ax.get_legend() is not None:
+            ax.get_legend().remove()
+        # forget the old data limits (so that the y-axes fit the new data) 
+        # and restart the color cycle
+        ax.relim()
+        ax.autoscale()
+        ax.set_prop_cycle(None)
+        
+        
+        
+def _print_timings(timings):
+    """
+    Prints a table of the per-job timings returned by plot_meteorograms().
+    """
+    print('{:6s} {:>11s} {:>11s} {:>8s} {:>8s} {:>8s} {:>8s}'.format(
+          'stid', 'start', 'end', 'load', 'draw', 'save', 'total'))
+    for t in timings:
+        line = '{:6s} {:%b%d %H:%M} {:%b%d %H:%M}'.format(t['stid'], t['dt1'], 
+                                                         t['dt2'])
+        if t['error'] is not None:
+            line += '  FAILED: ' + t['error']
+        else:
+            line += ' {load:8.3f} {draw:8.3f} {save:8.3f} {total:8.3f}'.format(
+                    **t)
+            if t['skipped']:
+                line += '  (up to date)'
+        print(line)
+    print('{} jobs ({} up to date, {} failed) in {:.3f} s of plotting '
+          'time'.format(len(timings), sum(t['skipped'] for t in timings),
+          sum(t['error'] is not None for t in timings), 
+          sum(t['total'] for t in timings)))
+    
+    
+    
+def plot_sounding(stid, date, force=False):
     """
     Plots radiosonde data (temp. and dewpoint) for a given station and time.
     
     Requires:
         stid --> station ID (string)
         date --> desired time (datetime object)
+        force -> if True, the figure is re-rendered even if an up-to-date
+                 copy exists (see ut.RenderManifest)
         
     Returns:
         nothing! Saves figure as "sounding_[stid]_[dt].png"
     """
     
     # Load the sounding data dictionary using our function in utilities.py
-    sounding = ut.get_sounding(stid, date)
+    with instrument.stage('sounding.load', stid=stid):
+        sounding = ut.get_sounding(stid, date)
     # Now we have the sounding date ('date'), pressures ('p'), heights ('z'),
     # temperatures ('t'), and dew point temperatures ('td')
     
+    # Skip the figure if it was already rendered from the same data and code
+    figdir = ut.get_figdir() # find/create a "figures" directory here
+    # each filename describes the figure type and observation date
+    savefile = '{}/sounding_{}_{:%Y%m%d%H}.png'.format(figdir, stid, date)
+    manifest = ut.RenderManifest()
+    key = _render_key(sounding, ('sounding', stid, date))
+    if not force and manifest.is_current(savefile, key):
+        instrument.count('figures_skipped')
+        return
+    plt = _pyplot() # plotting tools
     
     ######################################################################
     ### FILL IN THIS BLOCK ###############################################
@@ -119,18 +432,22 @@ def plot_sounding(stid, date):
     ######################################################################
     
     # Title the figure
-    ax.set_title('{} sounding on {:%Y-%m-%d %H:00}'.format(stid, date), loc='left')
+    ax.set_title('{} sounding on {:%Y-%m-%d %H:00}'.format(stid, date), 
+                 loc='left')
     
     # Save the figure as a .png file
-    figdir = ut.get_figdir() # find/create a "figures" directory here
-    # each filename describes the figure type and observation date
-    savefile = '{}/sounding_{}_{:%Y%m%d%H}.png'.format(figdir, stid, date)
-    plt.savefig(savefile)
+    with instrument.stage('sounding.savefig', stid=stid):
+        plt.savefig(savefile)
     plt.close() # close this figures so we don't use tons of memory
+    instrument.count('figures_rendered')
+    manifest.record(savefile, key)
+    manifest.save()
 
 
 
-def plot_narr_t2m_mslp(dt1, dt2, verbose=False):
+def plot_narr_t2m_mslp(dt1, dt2, verbose=False, workers=None, force=False, 
+                       bbox=None, stations=None, output='png', dpi=None,
+                       compress_level=None, fps=4):
     """
     Plots/saves a US map of 2-meter temperature, MSLP, and wind barbs (from the
     NARR dataset) every 3 hours in the date range [dt1] to [dt2].
@@ -138,19 +455,63 @@ def plot_narr_t2m_mslp(dt1, dt2, verbose=False):
     Requires:
         dt1 -----> a datetime object containing the starting date
         dt2 -----> a datetime object containing the ending date
-        verbose -> if True, function prints logging information
+        verbose -> if True, function prints logging information (see 
+                   instrument.note())
+        workers -> if > 1, the maps are rendered in parallel by this many
+                   processes (int)
+        force ---> if True, every map is re-rendered, even those with an
+                   up-to-date copy (see ut.RenderManifest)
+        bbox ----> (optional) only contour the data in the region (south 
+                   lat., north lat., west lon., east lon.)
+        stations > (optional) only contour the data around these stations
+                   (list of IDs; see ut.load_narr_data)
+        output --> 'png' (one .png file per map), or all of the maps in one
+                   file: 'gif' or 'webm' (an animation), or 'sprite' (a 
+                   sprite sheet .png of all of the maps, tiled)
+        dpi -----> (optional) resolution of the maps (default: matplotlib's
+                   "savefig.dpi")
+        compress_level -> (optional) zlib compression level (0-9) of the 
+                   .png files (default: Pillow's)
+        fps -----> frames per second of an animation (float)
         
     Returns:
-        nothing! Saves figures as "t2m_mslp_*.png
+        nothing! Saves figures as "t2m_mslp_*.png (or, for the other [output]
+        modes, as "t2m_mslp_[dt1]-[dt2].*")
     """
-    from mpl_toolkits.basemap import Basemap   # for projecting data onto a map
+    _pyplot().ioff() # we don't want plots to display
+    
+    with instrument.printing(verbose):
+        # Load the NARR temp., press., and wind data from the netcdf file
+        instrument.note('Loading NARR data...')
+        narr = ut.load_narr_data(dt1, dt2, bbox=bbox, stations=stations)
+        # ^ this indexes like a dictionary of numpy arrays (see 
+        #   load_narr_data() for details)
+        
+        # Draw a map at each time with _draw_t2m_mslp_frame() (below)
+        instrument.note('Plotting temp/pressure/wind maps...')
+        plot_narr_maps('t2m_mslp', narr, workers=workers, force=force,
+                       output=output, dpi=dpi, 
+                       compress_level=compress_level, fps=fps)
+        instrument.note('Done!\n')
+    
     
-    plt.ioff() # we don't want plots to display
     
-    # Load the NARR temp., press., and wind data from the netcdf file
-    if verbose: print('Loading NARR data...')
-    narr = ut.load_narr_data(dt1, dt2)  # from utilities.py
-    # ^ this is a dictionary of numpy arrays (see load_narr_data() for details)
+def _draw_t2m_mslp_frame(template, fields, date):
+    """
+    Draws the data of one 2-meter temperature/MSLP/wind map for 
+    plot_narr_t2m_mslp().
+    
+    Requires:
+        template -> the _MapTemplate to draw on; the map (coast/country/state
+                    lines and lat/lon lines) is already drawn on its axis
+        fields ---> a dictionary of the 2-D ('t2m', 'mslp', 'u10m', 'v10m')
+                    fields at this time
+        date -----> the date of this map (datetime object)
+    """
+    # Get our Basemap object, the projected lats/lons, and the figure, map
+    # axis, and colorbar axis objects
+    m, x, y = template.m, template.x, template.y
+    fig, ax, cax = template.fig, template.ax, template.cax
     
     ######################################################################
     ### FILL IN THIS BLOCK ###############################################
@@ -160,134 +521,801 @@ def plot_narr_t2m_mslp(dt1, dt2, verbose=False):
     #        (we will use these variables for plotting later)
     #       Contour temperature every 2C and pressure every 4hPa
     
-    # TODO: Create a Basemap object to plot the data on (over North America)
+    # TODO: Contour-fill the temperatures (using the colormap and levels
+    #       defined above) and solid-contour the pressures in black (also
+    #       using pre-defined levels) on [ax]
     
-    # TODO: Project lat/lon variables onto this map projection
+    # Freebie: plot wind barbs in black (I coarsen the grid by a factor 
+    # of 8, otherwise the barbs will be FAR too densely packed)
+    m.barbs(x[::8,::8], y[::8,::8], fields['u10m'][::8,::8], 
+            fields['v10m'][::8,::8], length=5, barbcolor='k', 
+            flagcolor='k', linewidth=0.5, ax=ax)
     
-    # Loop through the dates and create/save a figure at each time
+    # TODO: Add a colorbar (in [cax]) and (optionally) contour labels (using
+    #       clabel())
     
-        # TODO: Create Figure and Axes objects
-        
-        # TODO: Contour-fill the temperatures (using the colormap and levels
-        #       defined above) and solid-contour the pressures in black (also
-        #       using pre-defined levels)
-        
-        # Freebie: plot wind barbs in black (I coarsen the grid by a factor 
-        # of 8, otherwise the barbs will be FAR too densely packed)
-        m.barbs(x[::8,::8], y[::8,::8], narr['u10m'][d,::8,::8], 
-                narr['v10m'][d,::8,::8], length=5, barbcolor='k', 
-                flagcolor='k', linewidth=0.5)
-        
-        # TODO: Draw the map (coast/country/state lines and lat/lon lines)
-        
-        # TODO: Add a colorbar and (optionally) contour labels (using clabel())
-        
-        ##################################################################
-        ### END HERE #####################################################
-        ##################################################################
-        
-        # Add a title describing the fields, their units, and the date
-        title = '2-meter temp. [C; colors], MSLP [hPa; contours], and ' + \
-                'winds [kts; barbs] -- {:%Y-%m-%d %H:00} UTC'
-        ax.set_title(title.format(date), loc='left')
-        
-        # Save the figure as a .png file
-        figdir = ut.get_figdir() # find/create a "figures" directory here
-        savefile = '{}/t2m_mslp_{:%Y%m%d%H}.png'.format(figdir, date)
-        plt.savefig(savefile) # each filename describes the fields & date
-        plt.close() # close this figures so we don't use tons of memory
-    if verbose: print('Done!\n')
+    ######################################################################
+    ### END HERE #########################################################
+    ######################################################################
+    
+    # Add a title describing the fields, their units, and the date
+    title = '2-meter temp. [C; colors], MSLP [hPa; contours], and ' + \
+            'winds [kts; barbs] -- {:%Y-%m-%d %H:00} UTC'
+    ax.set_title(title.format(date), loc='left')
     
     
     
 
-def plot_narr_olr(dt1, dt2, verbose=False):
+def plot_narr_olr(dt1, dt2, verbose=False, workers=None, force=False, 
+                  bbox=None, stations=None, output='png', dpi=None,
+                  compress_level=None, fps=4):
     """
     Plots/saves a US map of 2-meter temperature, MSLP, and outgoing longwave
-    radiation (from the NARR dataset) every 3 hours in the date range [dt1] to [dt2].
+    radiation (from the NARR dataset) every 3 hours in the date range [dt1] 
+    to [dt2].
     
     Requires:
         dt1 -----> a datetime object containing the starting date
         dt2 -----> a datetime object containing the ending date
-        verbose -> if True, function prints logging information
+        verbose -> if True, function prints logging information (see 
+                   instrument.note())
+        workers -> if > 1, the maps are rendered in parallel by this many
+                   processes (int)
+        force ---> if True, every map is re-rendered, even those with an
+                   up-to-date copy (see ut.RenderManifest)
+        bbox ----> (optional) only contour the data in the region (south 
+                   lat., north lat., west lon., east lon.)
+        stations > (optional) only contour the data around these stations
+                   (list of IDs; see ut.load_narr_data)
+        output --> 'png' (one .png file per map), or all of the maps in one
+                   file: 'gif' or 'webm' (an animation), or 'sprite' (a 
+                   sprite sheet .png of all of the maps, tiled)
+        dpi -----> (optional) resolution of the maps (default: matplotlib's
+                   "savefig.dpi")
+        compress_level -> (optional) zlib compression level (0-9) of the 
+                   .png files (default: Pillow's)
+        fps -----> frames per second of an animation (float)
         
     Returns:
-        nothing! Saves figures as "olr_*.png
+        nothing! Saves figures as "olr_*.png (or, for the other [output] 
+        modes, as "olr_[dt1]-[dt2].*")
     """
-    from mpl_toolkits.basemap import Basemap   # for projecting data onto a map
+    _pyplot().ioff() # we don't want plots to display
+    
+    with instrument.printing(verbose):
+        # Load the NARR temp., press., and wind data from the netcdf file
+        instrument.note('Loading NARR data...')
+        narr = ut.load_narr_data(dt1, dt2, bbox=bbox, stations=stations)
+        # ^ this indexes like a dictionary of numpy arrays
+        
+        # Draw a map at each time with _draw_olr_frame() (below)
+        instrument.note('Plotting olr/pressure/temp maps...')
+        plot_narr_maps('olr', narr, workers=workers, force=force,
+                       output=output, dpi=dpi, 
+                       compress_level=compress_level, fps=fps)
+        instrument.note('Done!\n')
     
-    plt.ioff() # we don't want plots to display
     
+    
+def _draw_olr_frame(template, fields, date):
+    """
+    Draws the data of one OLR/temperature/MSLP map for plot_narr_olr().
+    
+    Requires:
+        template -> the _MapTemplate to draw on; the map (coast/country/state
+                    lines and lat/lon lines) is already drawn on its axis
+        fields ---> a dictionary of the 2-D ('olr', 't2m', 'mslp') fields at
+                    this time
+        date -----> the date of this map (datetime object)
+    """
     # Establish our colormap and contour intervals
-    cmap  = plt.cm.binary                   # colormap for OLR
+    cmap  = _pyplot().cm.binary             # colormap for OLR
     olevs = np.arange(100., 350., 10.)     # contour levels for olr
     plevs = np.arange(940., 1051., 4.)     # contour levels for pressures
     
-    # Load the NARR temp., press., and wind data from the netcdf file
-    if verbose: print('Loading NARR data...')
-    narr = ut.load_narr_data(dt1, dt2)  # from utilities.py
-    # ^ this is a dictionary of numpy arrays
+    # Get the projected lats/lons and our map axis object
+    x, y, ax = template.x, template.y, template.ax
+    
+    # Contour-fill the OLR using the colormap [cmap]
+    cs1 = ax.contourf(x, y, fields['olr'], levels=olevs, cmap=cmap, 
+                      extend='both', antialiasing=True)
+    # Solid-contour the temperatures in blue/red
+    #   below-freezing temps = blue
+    ax.contour(x, y, fields['t2m'], levels=range(-32,0,4), colors='b',
+               linestyles='-', linewidths=0.8, antialiasing=True) 
+    #   above-freezing temps = red
+    ax.contour(x, y, fields['t2m'], levels=range(4,33,4),
+               colors='r', linewidths=0.8,  antialiasing=True) 
+    #   freezing level = magenta
+    ax.contour(x, y, fields['t2m'], levels=[0],
+               colors='m', linewidths=0.8,  antialiasing=True) 
+    # Solid-contour the pressures in black
+    cs2 = ax.contour(x, y, fields['mslp'], levels=plevs, colors='k', 
+                     antialiasing=True)
+    
+    # Add the colorbar and the contour labels
+    # assign the data from our contour-fills to the colorbar axis
+    template.fig.colorbar(cs1, cax=template.cax, ticks=olevs[::2])
+    # label the pressure contours every other pressure level ("::2")
+    ax.clabel(cs2, plevs[::2], fmt='%d')
+    
+    # Add a title describing the fields, their units, and the date
+    title = 'OLR [W m$^{-2}$], 2-m temp. [every 4C ' + \
+            '], and MSLP [hPa] -- {:%Y-%m-%d %H:00} UTC'.format(date)
+    ax.set_title(title, loc='left')
+    
+    
+    
+# The NARR map products: for each, the function that draws one map, the
+# variables it needs, and the filename of each map (figure dir. and date)
+_NARR_PRODUCTS = {
+    'olr' : (_draw_olr_frame, ('olr', 't2m', 'mslp'), 
+             '{}/olr_{:%Y%m%d%H}.png'),
+    't2m_mslp' : (_draw_t2m_mslp_frame, ('t2m', 'mslp', 'u10m', 'v10m'), 
+                  '{}/t2m_mslp_{:%Y%m%d%H}.png'),
+}
+
+
+
+# The Basemap projection that all NARR maps are drawn on (over North America)
+_NARR_PROJECTION = dict(width=8000000, height=5000000, projection='lcc',
+                        resolution='l', lat_1=45., lat_2=55, lat_0=45, 
+                        lon_0=-97.)
+
+def _narr_basemap(lons, lats):
+    """
+    Returns the Basemap object that all NARR maps are drawn on (domain = 
+    North America) and projects the NARR lat/lon grid onto it. The Basemap 
+    (which takes seconds to build) is kept for the rest of the session, and
+    the projected grid is cached on disk (keyed by the projection parameters
+    and the grid), so the projection is only computed once.
+    
+    Returns:
+        m -----> the Basemap object
+        x, y --> the projected NARR grid (2-D arrays)
+    """
+    import hashlib
     
-    # Create our Basemap object to plot the data on (domain = North America)
-    m = Basemap(width=8000000,height=5000000,projection='lcc',
-                resolution='l',lat_1=45.,lat_2=55,lat_0=45,lon_0=-97.)
-    # Project out lat/lon variables onto this map projection
-    x, y = m(narr['lons'], narr['lats'])
+    m = _basemap()
     
-    # Loop through the dates and create/save a figure at each time
-    if verbose: print('Plotting olr/pressure/temp maps...')
-    for d, date in enumerate(narr['dates']):
-        if verbose: print('  ', date)
+    # Look for the projected grid in the cache directory
+    key = hashlib.sha1(repr(sorted(_NARR_PROJECTION.items())).encode())
+    for coord in (lons, lats):
+        coord = np.ascontiguousarray(np.ma.getdata(coord))
+        key.update(str((coord.dtype.str, coord.shape)).encode())
+        key.update(coord.tobytes())
+    cachefile = '{}/narr_xy.{}.npy'.format(ut.get_cachedir(), key.hexdigest())
+    try:
+        x, y = np.load(cachefile)
+        instrument.count('map.projection_cache_hits')
+    except (OSError, ValueError):
+        with instrument.stage('map.projection'):
+            x, y = m(lons, lats)
+        # (each grid, e.g. a station window's, has its own cache file)
+        ut.write_sidecar(cachefile[:-4], None, [('.npy', np.array([x, y]))])
+    return m, x, y
+
+
+
+# The Basemap objects built so far: {projection parameters: Basemap}
+_basemaps = {}
+
+def _basemap():
+    """
+    Returns the Basemap object of _NARR_PROJECTION, building it (and loading
+    its coastline database) the first time it is needed in this process.
+    """
+    key = repr(sorted(_NARR_PROJECTION.items()))
+    if key in _basemaps:
+        instrument.count('map.basemap_cache_hits')
+    else:
+        # (for projecting data onto a map)
+        from mpl_toolkits.basemap import Basemap
+        with instrument.stage('map.basemap'):
+            _basemaps[key] = Basemap(**_NARR_PROJECTION)
+    return _basemaps[key]
+
+
+
+class _MapTemplate(object):
+    """
+    A figure with a NARR map axis and a colorbar axis that is reused for every
+    map in a sequence. The static layers (coast/country/state lines and 
+    lat/lon lines) are drawn once; reset() removes everything drawn since.
+    """
+    def __init__(self, m, x, y):
+        with instrument.stage('map.template'):
+            self._setup(m, x, y)
+        
+    def _setup(self, m, x, y):
+        self.m, self.x, self.y = m, x, y
         
         # Create our figure and axis objects
-        fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(10,6))
-        # adjust the axis that we've just made to make room for a colorbar axis
-        # (which we will make later) to its right
-        fig.subplots_adjust(left=0.05, right=0.90, bottom=0.05, top=0.92)
-        
-        # Contour-fill the OLR using the colormap [cmap]
-        cs1 = ax.contourf(x, y, narr['olr'][d,:,:], levels=olevs, cmap=cmap, 
-                          extend='both', antialiasing=True)
-        # Solid-contour the temperatures in blue/red
-        #   below-freezing temps = blue
-        ax.contour(x, y, narr['t2m'][d,:,:], levels=range(-32,0,4), colors='b',
-                   linestyles='-', linewidths=0.8, antialiasing=True) 
-        #   above-freezing temps = red
-        ax.contour(x, y, narr['t2m'][d,:,:], levels=range(4,33,4),
-                   colors='r', linewidths=0.8,  antialiasing=True) 
-        #   freezing level = magenta
-        ax.contour(x, y, narr['t2m'][d,:,:], levels=[0],
-                   colors='m', linewidths=0.8,  antialiasing=True) 
-        # Solid-contour the pressures in black
-        cs2 = ax.contour(x, y, narr['mslp'][d,:,:], levels=plevs, colors='k', 
-                         antialiasing=True)
-        
-        # Draw the map (coast/country/state lines and lat/lon lines)
-        m.drawcoastlines(color='k')
-        m.drawcountries(color='k')
-        m.drawstates(color='k')
-        m.drawparallels(np.arange(0.,81,10.), dashes=[2,1], labels=[1,0,0,0])
-        m.drawmeridians(np.arange(0.,360,20.), dashes=[2,1], labels=[0,0,0,1])
-        
-        # Add the colorbar and the contour labels
-        # make a new axis object for our colorbar
-        cax = fig.add_axes([0.92, 0.05, 0.02, 0.87]) # [left, bottom, width, height]
-        # assign the data from our contour-fills to this colorba
-        plt.colorbar(cs1, cax=cax, ticks=olevs[::2])
-        # label the pressure contours every other pressure level ("::2")
-        plt.clabel(cs2, plevs[::2], fmt='%d')
-        
-        # Add a title describing the fields, their units, and the date
-        title = 'OLR [W m$^{-2}$], 2-m temp. [every 4C ' + \
-                '], and MSLP [hPa] -- {:%Y-%m-%d %H:00} UTC'.format(date)
-        ax.set_title(title, loc='left')
-        
-        # Save the figure as a .png file
-        figdir = ut.get_figdir() # find/create a "figures" directory here
-        savefile = '{}/olr_{:%Y%m%d%H}.png'.format(figdir, date)
-        plt.savefig(savefile) # each filename describes the fields & date
-        plt.close() # close this figures so we don't use tons of memory
-    if verbose: print('Done!\n')
+        self.fig, self.ax = _pyplot().subplots(nrows=1, ncols=1, figsize=(10,6))
+        # adjust the axis that we've just made to make room for a colorbar
+        # axis to its right
+        self.fig.subplots_adjust(left=0.05, right=0.90, bottom=0.05, top=0.92)
+        
+        # Draw the map (coast/country/state lines and lat/lon lines), above 
+        # the contours that will be drawn later
+        m.drawcoastlines(color='k', ax=self.ax, zorder=2.5)
+        m.drawcountries(color='k', ax=self.ax, zorder=2.5)
+        m.drawstates(color='k', ax=self.ax, zorder=2.5)
+        m.drawparallels(np.arange(0.,81,10.), dashes=[2,1], labels=[1,0,0,0],
+                        ax=self.ax, zorder=2.5)
+        m.drawmeridians(np.arange(0.,360,20.), dashes=[2,1], labels=[0,0,0,1],
+                        ax=self.ax, zorder=2.5)
+        
+        # make a new axis object for the colorbar
+        self._caxrect = [0.92, 0.05, 0.02, 0.87] # [left, bottom, width, height]
+        self.cax = self.fig.add_axes(self._caxrect)
+        self._static = set(self.ax.get_children())
+        # Draw the empty map once, so that the axis layout is final before the
+        # first contour labels are placed (otherwise the first map's labels
+        # land slightly differently from all the later maps')
+        self.fig.canvas.draw()
+        
+    def reset(self):
+        """
+        Removes the data artists (contours, barbs, labels, ...) and the 
+        colorbar of the previous map.
+        """
+        stale = [a for a in self.ax.get_children() if a not in self._static]
+        for artist in stale:
+            # (some artists remove their children, e.g. contour labels)
+            if artist.axes is not None:
+                artist.remove()
+        # (a colorbar also changes its axis, so make a new colorbar axis)
+        self.cax.remove()
+        self.cax = self.fig.add_axes(self._caxrect)
+        
+    def close(self):
+        # close this figure so we don't use tons of memory
+        _pyplot().close(self.fig)
+
+
+
+# The map templates built so far: {hash of the NARR grid: _MapTemplate}
+_templates = {}
+
+def _narr_template(lons, lats):
+    """
+    Returns the _MapTemplate of the NARR maps on the grid [lons]/[lats]. The
+    template (whose static map layers take seconds to draw) is kept for the
+    rest of the session, so later maps on the same grid reuse it.
+    """
+    key = ut.data_hash([lons, lats])
+    if key in _templates:
+        instrument.count('map.template_cache_hits')
+    else:
+        _templates[key] = _MapTemplate(*_narr_basemap(lons, lats))
+    return _templates[key]
+
+
+
+def plot_narr_maps(product, narr, workers=None, force=False, output='png',
+                   dpi=None, compress_level=None, fps=4):
+    """
+    Plots/saves the maps of a NARR product from already-loaded data (e.g., 
+    one load shared by several products). This is what plot_narr_olr() and
+    plot_narr_t2m_mslp() do after loading their data.
+    
+    One map is drawn at each time in [narr], reusing one _MapTemplate for all
+    of the maps (and for any later maps on the same grid; see 
+    _narr_template). Maps that are up to date in the render manifest are 
+    skipped (unless [force]). With [workers] > 1 the maps are rendered by a 
+    pool of processes: each process sets up the map template once, and then
+    receives only the 2-D fields of each of its maps through shared memory.
+    The saved files are the same either way. The date of each map is 
+    reported with instrument.note(); the maps of the other [output] modes 
+    are rendered in this process (see _render_narr_sequence).
+    
+    Requires:
+        product -> 'olr' or 't2m_mslp'
+        narr ----> the NARR data (see ut.load_narr_data), with the variables
+                   of [product]
+        the other arguments are those of plot_narr_olr()
+        
+    Returns:
+        nothing! Saves figures as "[product]_*.png" (or, for the other 
+        [output] modes, as "[product]_[dt1]-[dt2].*")
+    """
+    if product not in _NARR_PRODUCTS:
+        raise ValueError('ERROR: unknown NARR product "{}"!'.format(product))
+    if output != 'png':
+        _render_narr_sequence(product, narr, output, dpi=dpi, fps=fps,
+                              force=force)
+        return
+    draw_frame, variables, savefile = _NARR_PRODUCTS[product]
+    figdir = ut.get_figdir() # find/create a "figures" directory here
+    manifest = ut.RenderManifest()
+    savekw = _savefig_kwargs(dpi, compress_level)
+    params = (product, sorted(_NARR_PROJECTION.items()), sorted(savekw.items()))
+    
+    def stale_frames():
+        # Yields the (date, fields, savefile, key) of each map to render
+        for d, date in enumerate(narr['dates']):
+            with instrument.stage('map.fields', date=date):
+                fields = {var:narr[var][d,:,:] for var in variables}
+            key = _render_key(fields, params)
+            mapfile = savefile.format(figdir, date)
+            if not force and manifest.is_current(mapfile, key):
+                instrument.note('   {} (up to date)'.format(date))
+                instrument.count('figures_skipped')
+                continue
+            yield date, fields, mapfile, key
+    
+    # Serial rendering: set up the template (once there is a map to draw), 
+    # then draw the maps in order
+    if workers is None or workers <= 1:
+        template = None
+        for date, fields, mapfile, key in stale_frames():
+            instrument.note('   {}'.format(date))
+            if template is None:
+                template = _narr_template(narr['lons'], narr['lats'])
+            _save_frame(draw_frame, template, fields, date, mapfile, savekw)
+            manifest.record(mapfile, key)
+        manifest.save()
+        return
+    
+    # Parallel rendering (each process has its own _MapTemplate): keep up to
+    # 2 maps per process in flight, so that only those maps' fields are 
+    # loaded at any time
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    pool = None
+    pending = {}
+    def finish(done):
+        for future in done:
+            shm, mapfile, key = pending.pop(future)
+            shm.close()
+            shm.unlink()
+            date, collected = future.result()
+            instrument.merge(collected)
+            manifest.record(mapfile, key)
+            instrument.note('   {}'.format(date))
+    try:
+        for date, fields, mapfile, key in stale_frames():
+            if pool is None:
+                pool = ProcessPoolExecutor(max_workers=workers, 
+                                           initializer=_init_frame_worker,
+                                           initargs=(product, narr['lons'], 
+                                                     narr['lats'],
+                                                     instrument.is_enabled()))
+            if len(pending) >= 2 * workers:
+                finish(wait(pending, return_when=FIRST_COMPLETED)[0])
+            shm, spec = _share_fields(fields)
+            future = pool.submit(_render_shared_frame, spec, date, mapfile,
+                                 savekw)
+            pending[future] = (shm, mapfile, key)
+        while pending:
+            finish(wait(pending, return_when=FIRST_COMPLETED)[0])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for shm, _, _ in pending.values():
+            shm.close()
+            shm.unlink()
+        manifest.save()
+            
+            
+            
+def _save_frame(draw_frame, template, fields, date, savefile, savekw={}):
+    """
+    Draws one map with [draw_frame] on [template] and saves it as [savefile]
+    (with the savefig() keyword arguments [savekw]).
+    """
+    with instrument.stage('map.reset'):
+        template.reset()
+    with instrument.stage('map.draw', date=date):
+        draw_frame(template, fields, date)
+    with instrument.stage('map.savefig', date=date):
+        # each filename describes the fields & date
+        template.fig.savefig(savefile, **savekw)
+    instrument.count('figures_rendered')
+    
+    
+    
+def _savefig_kwargs(dpi=None, compress_level=None):
+    """
+    Returns the savefig() keyword arguments for the map resolution [dpi] and
+    the .png compression level [compress_level] (if they are given).
+    """
+    savekw = {}
+    if dpi is not None:
+        savekw['dpi'] = dpi
+    if compress_level is not None:
+        savekw['pil_kwargs'] = {'compress_level':int(compress_level)}
+    return savekw
+
+
+
+# The file extension of each sequence output mode (see _render_narr_sequence)
+_SEQUENCE_FILES = {'gif':'.gif', 'webm':'.webm', 'sprite':'_sprite.png'}
+
+def _render_narr_sequence(product, narr, output, dpi=None, fps=4, 
+                          force=False):
+    """
+    Draws the map of the NARR [product] at each time in [narr] (see 
+    plot_narr_maps) and streams the frames, straight from memory, into
+    one animation ([output] = 'gif' or 'webm') or sprite sheet ('sprite').
+    The file is skipped if it is up to date in the render manifest (unless
+    [force]).
+    """
+    if output not in _SEQUENCE_FILES:
+        raise ValueError('ERROR: unknown output mode "{}"!'.format(output))
+    draw_frame, variables, _ = _NARR_PRODUCTS[product]
+    dates = narr['dates']
+    savefile = '{}/{}_{:%Y%m%d%H}-{:%Y%m%d%H}{}'.format(ut.get_figdir(), 
+               product, dates[0], dates[-1], _SEQUENCE_FILES[output])
+    
+    # The sequence is identified by its data file, times and window (which
+    # avoids reading all of the data just to check the manifest)
+    manifest = ut.RenderManifest()
+    data = {'file':ut.file_key(narr.ncpath), 'dates':list(dates), 
+            'window':repr(narr.window)}
+    key = _render_key(data, (product, sorted(_NARR_PROJECTION.items()), 
+                             output, dpi, fps))
+    if not force and manifest.is_current(savefile, key):
+        instrument.note('   {} (up to date)'.format(savefile))
+        instrument.count('figures_skipped')
+        return
+    
+    template = _narr_template(narr['lons'], narr['lats'])
+    olddpi = template.fig.get_dpi()
+    if dpi is not None:
+        template.fig.set_dpi(dpi)
+    writer = None
+    try:
+        for d, date in enumerate(dates):
+            instrument.note('   {}'.format(date))
+            with instrument.stage('map.fields', date=date):
+                fields = {var:narr[var][d,:,:] for var in variables}
+            with instrument.stage('map.reset'):
+                template.reset()
+            with instrument.stage('map.draw', date=date):
+                draw_frame(template, fields, date)
+                template.fig.canvas.draw()
+            frame = np.asarray(template.fig.canvas.buffer_rgba())
+            if writer is None:
+                height, width = frame.shape[:2]
+                writer = _open_frame_writer(output, savefile, width, height, 
+                                            fps, dates)
+            with instrument.stage('map.encode', date=date):
+                writer.write(frame)
+            instrument.count('frames_encoded')
+        writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    finally:
+        template.fig.set_dpi(olddpi)
+    instrument.count('figures_rendered')
+    manifest.record(savefile, key)
+    manifest.save()
+
+
+
+def _open_frame_writer(output, savefile, width, height, fps, dates):
+    """
+    Returns a writer that encodes RGBA frames (of [width] x [height] pixels)
+    into [savefile]: with ffmpeg for animations (or, for a .gif without 
+    ffmpeg, with Pillow), or as a sprite sheet.
+    """
+    import shutil
+    if output == 'sprite':
+        return _SpriteWriter(savefile, width, height, dates)
+    if shutil.which('ffmpeg') is not None:
+        return _FFmpegWriter(savefile, width, height, fps)
+    if output == 'gif':
+        return _GifWriter(savefile, fps)
+    raise ValueError('ERROR: ffmpeg is needed to write {} files!'.format(
+                     output))
+
+
+
+class _FFmpegWriter(object):
+    """
+    Pipes raw RGBA frames into an ffmpeg process that encodes them into a 
+    .gif (with a palette made from all of the frames) or .webm (VP9) file.
+    """
+    def __init__(self, savefile, width, height, fps):
+        import subprocess
+        command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', 
+                   '-pix_fmt', 'rgba', '-s', '{}x{}'.format(width, height),
+                   '-r', str(fps), '-i', '-']
+        if savefile.endswith('.gif'):
+            command += ['-vf', 'split[a][b];[a]palettegen[p];[b][p]paletteuse']
+        else:
+            # (yuv420p needs even frame sizes)
+            command += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-c:v', 
+                        'libvpx-vp9', '-pix_fmt', 'yuv420p', '-b:v', '0', 
+                        '-crf', '32']
+        self.savefile = savefile
+        self.proc = subprocess.Popen(command + [savefile], 
+                                     stdin=subprocess.PIPE)
+        
+    def write(self, frame):
+        self.proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+        
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise ValueError('ERROR: ffmpeg could not write {}!'.format(
+                             self.savefile))
+            
+    def abort(self):
+        self.proc.kill()
+        self.proc.wait()
+        
+
+
+class _GifWriter(object):
+    """
+    Encodes frames into an animated .gif with Pillow (when ffmpeg is not 
+    available). Each frame is reduced to its own 256-color palette and 
+    appended to the file as it arrives, so only one frame is held in memory.
+    The file is written under a temporary name and renamed when it is 
+    complete.
+    """
+    def __init__(self, savefile, fps):
+        self.savefile = savefile
+        self.tmpfile = '{}.{}.tmp'.format(savefile, os.getpid())
+        self.duration = int(round(1000. / fps))
+        self.f = open(self.tmpfile, 'wb')
+        self.n = 0
+        
+    def write(self, frame):
+        from PIL import Image, GifImagePlugin
+        image = Image.fromarray(np.ascontiguousarray(frame[..., :3]))
+        image = image.quantize(colors=256)
+        if self.n == 0:
+            # (the global header: the screen size, the first frame's palette
+            # and an endless loop)
+            header, _ = GifImagePlugin.getheader(image, info={'loop':0})
+            self.f.write(b''.join(header))
+        self.f.write(b''.join(GifImagePlugin.getdata(image, 
+                     duration=self.duration, include_color_table=True)))
+        self.n += 1
+        
+    def close(self):
+        self.f.write(b';') # (the GIF trailer)
+        self.f.close()
+        os.replace(self.tmpfile, self.savefile)
+        
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmpfile)
+        
+
+
+class _SpriteWriter(object):
+    """
+    Tiles the frames into one sprite sheet (a .png, with a .json file next
+    to it that gives the tile size, the number of columns and the date of
+    each tile). The frames arrive in the sheet's row order, so each row of
+    tiles is compressed and appended to the .png as soon as it is complete:
+    only one row of tiles (columns x tile size) is held in memory. The .png 
+    is written under a temporary name and renamed when it is complete.
+    """
+    def __init__(self, savefile, width, height, dates):
+        import struct
+        import zlib
+        self.savefile = savefile
+        self.tmpfile = '{}.{}.tmp'.format(savefile, os.getpid())
+        self.width, self.height = width, height
+        self.dates = dates
+        self.ncols = int(np.ceil(np.sqrt(len(dates))))
+        self.nrows = int(np.ceil(len(dates) / self.ncols))
+        self.band = np.full((height, self.ncols * width, 3), 255, 
+                            dtype=np.uint8)
+        self.n = 0
+        self.compressor = zlib.compressobj(6)
+        # PNG signature and header (8-bit RGB, no interlacing)
+        self.f = open(self.tmpfile, 'wb')
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', self.ncols * width, 
+                                         self.nrows * height, 8, 2, 0, 0, 0))
+        
+    def write(self, frame):
+        col = self.n % self.ncols
+        self.band[:, col*self.width:(col+1)*self.width] = frame[..., :3]
+        self.n += 1
+        if col == self.ncols - 1:
+            self._flush_band()
+        
+    def close(self):
+        import json
+        if self.n % self.ncols:
+            # (the last row is only partly filled)
+            self.band[:, (self.n % self.ncols) * self.width:] = 255
+            self._flush_band()
+        self._chunk(b'IDAT', self.compressor.flush())
+        self._chunk(b'IEND', b'')
+        self.f.close()
+        os.replace(self.tmpfile, self.savefile)
+        layout = {'tile_width':self.width, 'tile_height':self.height,
+                  'columns':self.ncols, 
+                  'dates':['{:%Y-%m-%d %H:%M}'.format(d) for d in self.dates]}
+        with open(self.savefile[:-4] + '.json', 'w') as f:
+            json.dump(layout, f, indent=1)
+            
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmpfile)
+        
+    def _flush_band(self):
+        """
+        Compresses the current row of tiles into the .png. Each line of 
+        pixels gets PNG filter 1 ("Sub": the difference from the pixel to
+        its left), which compresses the flat areas of the maps well.
+        """
+        lines = np.empty((self.height, 1 + self.band.shape[1] * 3), 
+                         dtype=np.uint8)
+        lines[:, 0] = 1
+        pixels = self.band.reshape(self.height, -1)
+        lines[:, 1:4] = pixels[:, :3]
+        np.subtract(pixels[:, 3:], pixels[:, :-3], out=lines[:, 4:])
+        self._chunk(b'IDAT', self.compressor.compress(lines.tobytes()))
+        
+    def _chunk(self, kind, data):
+        """
+        Writes one PNG chunk (length, type, data and CRC).
+        """
+        import struct
+        import zlib
+        if kind == b'IDAT' and not data:
+            return
+        self.f.write(struct.pack('>I', len(data)) + kind + data + 
+                     struct.pack('>I', zlib.crc32(kind + data)))
+    
+    
+    
+def _render_key(data, params):
+    """
+    Returns the render manifest entry (see ut.RenderManifest) of a figure drawn
+    from [data] with plot parameters [params] by the current plotting code.
+    """
+    return ut.RenderManifest.key(data, params, _code_version())
+
+
+
+def _code_version():
+    """
+    Returns a hash of the plotting code (this module and utilities.py), so
+    that figures are re-rendered after the code changes.
+    """
+    if 'code' not in _code_version.__dict__:
+        import hashlib
+        digest = hashlib.sha1()
+        for module in (__file__, ut.__file__):
+            with open(module, 'rb') as f:
+                digest.update(f.read())
+        _code_version.code = digest.hexdigest()
+    return _code_version.code
+
+
+
+def _pyplot():
+    """
+    Imports and returns matplotlib.pyplot. Unless a backend has already been
+    chosen (pyplot was imported elsewhere first, or the MPLBACKEND environment
+    variable is set), the non-interactive "Agg" backend is used: the figures
+    are only saved to files, and Agg is the fastest backend to start up.
+    """
+    import sys
+    if 'matplotlib.pyplot' not in sys.modules and \
+       not os.environ.get('MPLBACKEND'):
+        import matplotlib
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+
+def preload(narr=True, ncfile='narr_oct2010.nc'):
+    """
+    Does the slow, one-time setup of the plotting functions ahead of time, for
+    a long-running process that plots many figures (e.g., plotserver.py): 
+    imports matplotlib.pyplot, draws and discards one figure, and (if [narr])
+    builds the map template of the NARR maps on the full grid of [ncfile].
+    """
+    import io
+    plt = _pyplot()
+    fig = plt.figure()
+    fig.savefig(io.BytesIO(), format='png')
+    plt.close(fig)
+    if narr:
+        # (only the grid is read from the file here)
+        grid = ut.load_narr_data(datetime(1, 1, 1), datetime(9999, 12, 31),
+                                 ncfile=ncfile)
+        _narr_template(grid['lons'], grid['lats'])
+
+
+
+# The state of a map-rendering worker process: {'product':..., 'template':...}
+_frame_worker = {}
+
+def _init_frame_worker(product, lons, lats, instrumented=False):
+    """
+    Sets up a map-rendering worker process (see plot_narr_maps), with 
+    the instrumentation on if [instrumented].
+    """
+    instrument.reset() # (drop any data inherited from the parent process)
+    if instrumented:
+        instrument.enable()
+    _pyplot().ioff() # we don't want plots to display
+    template = _narr_template(lons, lats)
+    _frame_worker.update(product=product, template=template)
+    
+    
+
+def _render_shared_frame(spec, date, savefile, savekw={}):
+    """
+    Draws and saves one map in a worker process, reading its fields from the
+    shared memory block described by [spec] (see _share_fields).
+    
+    Returns:
+        date -------> [date]
+        collected --> the instrumentation data collected in this process since
+                      the last map (see instrument.drain())
+    """
+    from multiprocessing import shared_memory
+    
+    draw_frame = _NARR_PRODUCTS[_frame_worker['product']][0]
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    try:
+        fields = {}
+        for var, dtype, shape, offset, maskoffset in spec['fields']:
+            data = np.ndarray(shape, dtype=dtype, buffer=shm.buf, 
+                              offset=offset).copy()
+            if maskoffset is not None:
+                mask = np.ndarray(shape, dtype=bool, buffer=shm.buf,
+                                  offset=maskoffset).copy()
+                data = np.ma.array(data, mask=mask)
+            fields[var] = data
+    finally:
+        shm.close()
+    _save_frame(draw_frame, _frame_worker['template'], fields, date, savefile,
+                savekw)
+    return date, instrument.drain()
+
+
+
+def _share_fields(fields):
+    """
+    Copies a dictionary of 2-D (possibly masked) arrays into one new shared
+    memory block.
+    
+    Returns:
+        shm ---> the SharedMemory object (to be unlinked by the caller)
+        spec --> a picklable description of the block for _render_shared_frame
+    """
+    from multiprocessing import shared_memory
+    
+    # Lay out each field's data (and mask, if it has one) in the block
+    layout = []
+    size = 0
+    for var, field in fields.items():
+        data = np.ma.getdata(field)
+        mask = np.ma.getmask(field)
+        maskoffset = None
+        if mask is not np.ma.nomask:
+            maskoffset = size + data.nbytes
+        layout.append((var, data, mask, size, maskoffset))
+        size += data.nbytes + (0 if maskoffset is None else mask.nbytes)
+        
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    spec = {'name':shm.name, 'fields':[]}
+    for var, data, mask, offset, maskoffset in layout:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf, 
+                   offset=offset)[...] = data
+        if maskoffset is not None:
+            np.ndarray(mask.shape, dtype=bool, buffer=shm.buf, 
+                       offset=maskoffset)[...] = mask
+        spec['fields'].append((var, data.dtype.str, data.shape, offset, 
+                               maskoffset))
+    return shm, spec
     
       
 # Any code within the following block with be executed if this module is run
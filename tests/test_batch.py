@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for batch.py (run with "python -m pytest tests/test_batch.py"). The
+loads and plots are replaced by fakes, so only the task graph, checkpoint
+and scheduling logic is tested here.
+
+@author: njweber2
+"""
+from datetime import datetime
+import json
+import pytest
+
+import batch
+import utilities as ut
+
+# A tiny job spec: ORD's first meteorogram window and the olr maps are asked
+# for twice, and the olr and t2m_mslp maps share one NARR load
+SPEC = {'jobs': [
+    {'products': ['meteorogram'], 'stations': ['ORD', 'MSP'],
+     'start': '2010102300', 'end': '2010102700', 'window_hours': 48},
+    {'products': ['meteorogram'], 'stations': ['ORD'],
+     'start': '2010-10-23T00:00', 'end': '2010102500'},
+    {'products': ['sounding'], 'stations': ['KILX'],
+     'start': '2010102300', 'end': '2010102400'},
+    {'products': ['olr', 't2m_mslp'], 'start': '2010102500',
+     'end': '2010102506', 'around': ['ORD']},
+    {'product': 'olr', 'start': '2010-10-25 00:00', 'end': '2010102506',
+     'around': ['ORD']},
+]}
+
+
+
+@pytest.fixture
+def specfile(tmp_path):
+    path = tmp_path / 'jobs.json'
+    path.write_text(json.dumps(SPEC))
+    return str(path)
+
+
+
+@pytest.fixture
+def fakes(tmp_path, monkeypatch):
+    """
+    Replaces the loads and plots with fakes that record their calls (in the
+    returned dictionary); the loads and plots listed in its 'fail' set raise
+    errors. The render manifest is kept in [tmp_path].
+    """
+    calls = {'load':[], 'plot':[], 'fail':set()}
+    def load(task):
+        calls['load'].append(task['id'])
+        if task['id'] in calls['fail']:
+            raise ValueError('ERROR: no data!')
+        return task['id']
+    def plot(task, data, force=False, figure=None):
+        assert data == task['load']
+        calls['plot'].append(task['id'])
+        if task['id'] in calls['fail']:
+            raise RuntimeError('drawing failed')
+        return []
+    monkeypatch.setattr(batch, '_load', load)
+    monkeypatch.setattr(batch, '_plot', plot)
+    monkeypatch.setattr(ut, 'get_manifest_file',
+                        lambda: str(tmp_path / 'manifest.json'))
+    return calls
+
+
+
+def _done(path):
+    """
+    Returns the IDs of the plots that are done in checkpoint file [path].
+    """
+    checkpoint = batch.Checkpoint(path)
+    checkpoint.close()
+    return checkpoint.done
+
+
+
+def test_plan_dedups_shared_loads(specfile, capsys):
+    graph = batch.build_graph(batch.read_spec(specfile))
+    ids = {load['id']:[plot['id'] for plot in plots] for load, plots in graph}
+    assert sorted(ids) == ['asos:stid=MSP', 'asos:stid=ORD',
+                           'narr:dt1=2010102500:dt2=2010102506:'
+                           'stations=["ORD"]', 'soundings:stid=KILX']
+    assert ids['asos:stid=ORD'] == [
+        'meteorogram:dt1=2010102300:dt2=2010102500:stid=ORD',
+        'meteorogram:dt1=2010102500:dt2=2010102700:stid=ORD']
+    narr = [p for l, p in ids.items() if l.startswith('narr')][0]
+    assert [p.split(':')[0] for p in narr] == ['olr', 't2m_mslp']
+    assert len(ids['soundings:stid=KILX']) == 3
+    for load, plots in graph:
+        assert all(plot['load'] == load['id'] for plot in plots)
+    assert batch.main(['plan', specfile]) == 0
+    assert capsys.readouterr().out.endswith('4 loads, 9 plots\n')
+
+
+
+def test_expand_windows_and_times():
+    dt1, dt2 = datetime(2010, 10, 23), datetime(2010, 10, 24, 6)
+    # the last window is cut off at the end time
+    job = {'window_hours':12}
+    plots = [p['args'] for _, p in batch._expand('meteorogram', job, ['ORD'],
+                                                 dt1, dt2)]
+    assert [(a['dt1'], a['dt2']) for a in plots] == [
+        ('2010102300', '2010102312'), ('2010102312', '2010102400'),
+        ('2010102400', '2010102406')]
+    # the soundings run through the end time
+    plots = [p['args']['date'] for _, p in batch._expand('sounding',
+             {'every_hours':6}, ['KILX'], dt1, dt2)]
+    assert plots == ['2010102300', '2010102306', '2010102312', '2010102318',
+                     '2010102400', '2010102406']
+    [(load, plot)] = batch._expand('olr', {'bbox':[30, 50, -100, -80]}, [],
+                                   dt1, dt2)
+    assert load['args']['bbox'] == plot['args']['bbox'] == [30., 50., -100.,
+                                                            -80.]
+
+
+
+@pytest.mark.parametrize('job', [
+    {'products':['meteorogram'], 'start':'2010102300', 'end':'2010102400'},
+    {'products':['skewt'], 'start':'2010102300', 'end':'2010102400'},
+    {'products':['olr'], 'start':'2010102400', 'end':'2010102300'},
+    {'products':['olr'], 'start':'2010102400'},
+    {'products':['sounding'], 'stations':['KILX'], 'start':'2010102300',
+     'end':'2010102400', 'every_hours':0},
+], ids=['no-stations', 'unknown-product', 'backwards', 'no-end', 'no-step'])
+def test_bad_jobs(job):
+    with pytest.raises(ValueError, match='ERROR'):
+        batch.build_graph([job])
+
+
+
+def test_make_units():
+    graph = batch.build_graph([{'products':['sounding'],
+                                'stations':['KILX', 'KGRB'],
+                                'start':'2010102300', 'end':'2010102700'}])
+    units = batch.make_units(graph, size=4)
+    # 9 soundings per station: units of 4, 4 and 1 plots
+    assert [len(plots) for load, plots in units] == [4, 4, 1] * 2
+    assert [load['id'] for load, _ in units[:3]] == ['soundings:stid=KILX'] * 3
+
+
+
+def test_checkpoint_resume(tmp_path):
+    path = str(tmp_path / 'jobs.checkpoint')
+    checkpoint = batch.Checkpoint(path)
+    checkpoint.record('a', None, 1.)
+    checkpoint.record('b', 'ERROR: failed!', 1.)
+    checkpoint.record('c', None, 1.)
+    checkpoint.record('c', 'ERROR: failed on a rerun!', 1.)
+    checkpoint.close()
+    with open(path, 'a') as f:
+        f.write('{"id": "d", "err') # (cut off by an interruption)
+    checkpoint = batch.Checkpoint(path)
+    assert checkpoint.done == {'a'}
+    checkpoint.close()
+    checkpoint = batch.Checkpoint(path, restart=True)
+    assert checkpoint.done == set()
+    checkpoint.close()
+
+
+
+def test_failures_are_not_done(specfile, tmp_path, fakes):
+    graph = batch.build_graph(batch.read_spec(specfile))
+    badplot = 'meteorogram:dt1=2010102500:dt2=2010102700:stid=MSP'
+    fakes['fail'].update(['asos:stid=ORD', badplot])
+    checkpoint = batch.Checkpoint(str(tmp_path / 'jobs.checkpoint'))
+    summary = batch.run_graph(graph, checkpoint, workers=1, verbose=False)
+    checkpoint.close()
+    # ORD's load failed, so neither of its plots ran
+    failed = dict(summary['failed'])
+    assert sorted(failed) == sorted(
+        ['meteorogram:dt1=2010102300:dt2=2010102500:stid=ORD',
+         'meteorogram:dt1=2010102500:dt2=2010102700:stid=ORD', badplot])
+    assert failed[badplot] == 'RuntimeError: drawing failed'
+    assert 'load asos:stid=ORD failed' in \
+           failed['meteorogram:dt1=2010102300:dt2=2010102500:stid=ORD']
+    assert not any(p.endswith('stid=ORD') for p in fakes['plot'])
+    assert summary['done'] == 6 and summary['skipped'] == 0
+    assert not summary['interrupted']
+    done = _done(str(tmp_path / 'jobs.checkpoint'))
+    assert len(done) == 6 and not done & set(failed)
+
+
+
+def test_rerun_skips_done_plots(specfile, fakes):
+    checkpoint = specfile + '.checkpoint'
+    fakes['fail'].add('sounding:date=2010102312:stid=KILX')
+    assert batch.main(['run', specfile, '--workers', '1', '-q']) == 1
+    assert len(fakes['plot']) == 9
+    # The second run only redoes the failed plot (with its load)
+    fakes['fail'].clear()
+    del fakes['load'][:], fakes['plot'][:]
+    assert batch.main(['run', specfile, '--workers', '1', '-q']) == 0
+    assert fakes['load'] == ['soundings:stid=KILX']
+    assert fakes['plot'] == ['sounding:date=2010102312:stid=KILX']
+    assert len(_done(checkpoint)) == 9
+    # ... and a third run has nothing to do, unless it restarts
+    del fakes['load'][:], fakes['plot'][:]
+    assert batch.main(['run', specfile, '--workers', '1', '-q']) == 0
+    assert fakes['load'] == fakes['plot'] == []
+    assert batch.main(['run', specfile, '--workers', '1', '-q',
+                       '--restart']) == 0
+    assert len(fakes['plot']) == 9
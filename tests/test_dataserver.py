@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for dataserver.py's AsyncDataClient (run with "python -m pytest
+tests/test_dataserver.py"). The data server is replaced by a fake one that
+answers some requests and then drops the connection.
+
+@author: njweber2
+"""
+import asyncio
+import pytest
+
+import dataserver as ds
+
+
+
+def _run(tmp_path, respond, queries):
+    """
+    Starts a fake server that calls coroutine [respond](header, writer) for
+    each request (it returns False to drop the connection), then runs
+    [queries](client) against it.
+    """
+    path = str(tmp_path / 'ds.sock')
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                header, _ = await ds._read_message(reader)
+                if not await respond(header, writer):
+                    break
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_unix_server(handle, path)
+        async with server:
+            client = await ds.AsyncDataClient.connect(path)
+            try:
+                return await asyncio.wait_for(queries(client), 5)
+            finally:
+                await client.close()
+    return asyncio.run(main())
+
+
+
+def test_closed_connection_fails_queries(tmp_path):
+    async def respond(header, writer):
+        if header['op'] == 'drop':
+            return False
+        if header['op'] == 'ping':
+            ds._write_message(writer, {'id':header['id'], 'error':None,
+                                       'result':'pong', 'arrays':[]}, [])
+            await writer.drain()
+        return True  # (the other queries never get a response)
+
+    async def queries(client):
+        assert await client.request('ping') == 'pong'
+        waiting = asyncio.ensure_future(client.request('slow'))
+        await asyncio.sleep(0.05)
+        dropped = await asyncio.gather(waiting, client.request('drop'),
+                                       return_exceptions=True)
+        assert all(isinstance(err, ConnectionError) for err in dropped)
+        with pytest.raises(ConnectionError, match='closed the connection'):
+            await client.request('ping')
+    _run(tmp_path, respond, queries)
+
+
+
+def test_bad_response_fails_queries(tmp_path):
+    async def respond(header, writer):
+        writer.write(ds._PREFIX.pack(4, 0) + b'{{{{')
+        await writer.drain()
+        return True
+
+    async def queries(client):
+        with pytest.raises(ConnectionError, match='JSONDecodeError'):
+            await client.request('ping')
+        with pytest.raises(ConnectionError):
+            await client.request('ping')
+    _run(tmp_path, respond, queries)
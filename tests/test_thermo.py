@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for thermo.py (run with "python -m pytest tests/test_thermo.py").
+
+@author: njweber2
+"""
+import numpy as np
+import pytest
+
+import thermo
+
+# The public functions, and the names of their array arguments
+FUNCTIONS = [(thermo.vapor_pressure, ('td',)),
+             (thermo.relative_humidity, ('t', 'td')),
+             (thermo.mixing_ratio, ('td', 'p')),
+             (thermo.potential_temperature, ('t', 'p')),
+             (thermo.lcl_temperature, ('t', 'td')),
+             (thermo.lcl_pressure, ('t', 'td', 'p')),
+             (thermo.equivalent_potential_temperature, ('t', 'td', 'p')),
+             (thermo.wet_bulb_temperature, ('t', 'td', 'p'))]
+
+
+
+def _inputs(n=500, dtype=float, seed=0):
+    """
+    Returns random surface/sounding conditions: {'t', 'td', 'p'} (1-D arrays).
+    """
+    rng = np.random.default_rng(seed)
+    t = rng.uniform(-40., 40., n)
+    td = t - rng.uniform(0., 25., n)
+    p = rng.uniform(200., 1050., n)
+    return {'t':t.astype(dtype), 'td':td.astype(dtype), 'p':p.astype(dtype)}
+
+
+
+@pytest.mark.parametrize('func, names', FUNCTIONS,
+                         ids=[f.__name__ for f, _ in FUNCTIONS])
+def test_out_aliased_to_each_input(func, names):
+    inputs = _inputs()
+    expected = func(*[inputs[name] for name in names])
+    for i in range(len(names)):
+        args = [inputs[name].copy() for name in names]
+        result = func(*args, out=args[i])
+        assert result is args[i]
+        np.testing.assert_allclose(result, expected, rtol=1e-12,
+                                   err_msg='out= aliased to ' + names[i])
+
+
+
+@pytest.mark.parametrize('func, names', FUNCTIONS,
+                         ids=[f.__name__ for f, _ in FUNCTIONS])
+def test_float32_with_scalar_arguments(func, names):
+    inputs = _inputs(dtype=np.float32)
+    # one float32 array, with Python floats and 0-d float64 arrays
+    for i in range(len(names)):
+        args = [float(inputs[name][0]) for name in names]
+        args[i] = inputs[names[i]]
+        assert func(*args).dtype == np.float32
+        args = [np.float64(a) if np.ndim(a) == 0 else a for a in args]
+        assert func(*args).dtype == np.float32
+    # all scalars: the result is a (0-d) float64
+    assert func(*[20.] * len(names)).dtype == np.float64
+
+
+
+def _expected(func, inputs, names):
+    """
+    Returns the loop-based (thermo._naive) values of [func] for [inputs].
+    """
+    shape = np.broadcast_shapes(*[np.shape(inputs[name]) for name in names])
+    # (the arguments that [func] doesn't take don't matter)
+    args = [np.broadcast_to(inputs[name] if name in names else unused, 
+                            shape).ravel().astype(float) 
+            for name, unused in [('t', 20.), ('td', 10.), ('p', 1000.)]]
+    return thermo._naive(func.__name__, *args).reshape(shape)
+
+
+
+@pytest.mark.parametrize('func, names', FUNCTIONS,
+                         ids=[f.__name__ for f, _ in FUNCTIONS])
+def test_matches_loop_reference(func, names):
+    inputs = _inputs()
+    result = func(*[inputs[name] for name in names])
+    assert result.dtype == np.float64
+    np.testing.assert_allclose(result, _expected(func, inputs, names),
+                               rtol=1e-10, atol=1e-10)
+
+
+
+@pytest.mark.parametrize('func, names', FUNCTIONS,
+                         ids=[f.__name__ for f, _ in FUNCTIONS])
+def test_broadcast_shapes(func, names):
+    # e.g., a (time, level) grid of temperatures with one pressure per level
+    inputs = _inputs(n=24)
+    inputs = {'t':inputs['t'].reshape(4, 1, 6), 
+              'td':inputs['td'].reshape(4, 1, 6) - 1.,
+              'p':np.linspace(1000., 300., 5)[:, np.newaxis]}
+    result = func(*[inputs[name] for name in names])
+    shape = np.broadcast_shapes(*[inputs[name].shape for name in names])
+    assert result.shape == shape
+    np.testing.assert_allclose(result, _expected(func, inputs, names),
+                               rtol=1e-10, atol=1e-10)
+    # a preallocated result of the broadcast shape
+    out = np.empty(shape)
+    assert func(*[inputs[name] for name in names], out=out) is out
+    np.testing.assert_allclose(out, result, rtol=1e-12)
+
+
+
+@pytest.mark.parametrize('func, names', FUNCTIONS,
+                         ids=[f.__name__ for f, _ in FUNCTIONS])
+def test_float32(func, names):
+    inputs = _inputs(dtype=np.float32)
+    result = func(*[inputs[name] for name in names])
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, _expected(func, inputs, names),
+                               rtol=1e-4, atol=1e-3)
+
+
+
+@pytest.mark.parametrize('func, names', FUNCTIONS,
+                         ids=[f.__name__ for f, _ in FUNCTIONS])
+def test_nan_input(func, names):
+    inputs = _inputs(n=20)
+    for i, name in enumerate(names):
+        inputs[name][i::len(names) + 1] = np.nan
+    result = func(*[inputs[name] for name in names])
+    expected = _expected(func, inputs, names)
+    assert np.array_equal(np.isnan(result), np.isnan(expected))
+    assert np.isnan(result).any() and not np.isnan(result).all()
+    np.testing.assert_allclose(result, expected, rtol=1e-10, atol=1e-10)
+
+
+
+def test_known_values():
+    # Bolton (1980) and the empirical wet-bulb formula of Stull (2011, JAMC)
+    np.testing.assert_allclose(thermo.relative_humidity(20., 10.), 52.5,
+                               atol=0.1)
+    np.testing.assert_allclose(thermo.potential_temperature(15., 850.), 
+                               301.8, atol=0.1)
+    np.testing.assert_allclose(thermo.wet_bulb_temperature(25., 15., 1000.),
+                               18.6, atol=0.3)
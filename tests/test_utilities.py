@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for utilities.py (run with "python -m pytest tests/test_utilities.py").
+
+@author: njweber2
+"""
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+
+import utilities as ut
+
+START = datetime(2010, 10, 23)
+STATIONS = ['BN0', 'BN1', 'BN2', 'BN3']
+
+
+
+@pytest.fixture
+def interleaved_asos(tmp_path):
+    """
+    An ASOS CSV export with 48 hourly observations of each of STATIONS, with
+    the stations' rows interleaved in runs of 12 hours (BN0 00-11Z, BN1 
+    00-11Z, ..., BN0 12-23Z, ...).
+    """
+    csvfile = tmp_path / 'asos_interleaved.txt'
+    lines = ['station,valid, tmpc ,  dwpc ,  drct ,  sknt ,  mslp ,  p01m']
+    for run in range(0, 48, 12):
+        for i, stid in enumerate(STATIONS):
+            for h in range(run, run + 12):
+                date = (START + timedelta(hours=h)).strftime('%Y-%m-%d %H:%M')
+                lines.append('{},{},{:.2f},{:.2f},180.00,5.00,1012.00,M'.format(
+                             stid, date, 10. + i + 0.1 * h, i + 0.1 * h))
+    csvfile.write_text('\n'.join(lines) + '\n')
+    return str(csvfile)
+
+
+
+@pytest.fixture
+def cachedir(tmp_path, monkeypatch):
+    """
+    An empty cache directory for the sidecar files, and empty in-memory 
+    caches (the real ones are restored afterwards).
+    """
+    path = tmp_path / 'cache'
+    path.mkdir()
+    monkeypatch.setattr(ut, 'get_cachedir', lambda: str(path))
+    for cache in ('_asos_cache', '_sounding_cache', '_regrid_cache'):
+        monkeypatch.setattr(ut, cache, {})
+    return path
+
+
+
+@pytest.fixture
+def raob_file(tmp_path):
+    """
+    A RAOB export with two launches of station BN0 (12 h apart, in reverse
+    order), whose levels are out of height order and have a missing 
+    dewpoint, and whose levelcodes differ from their pressures.
+    """
+    csvfile = tmp_path / 'soundings_BN0.txt'
+    lines = ['station,validUTC,levelcode,pressure_mb,height_m,tmpc,dwpc,drct,'
+             'speed_kts,bearing,range_sm']
+    for launch in (12, 0):
+        date = (START + timedelta(hours=launch)).strftime('%Y-%m-%d %H:%M:%S')
+        for level, (p, z, td) in enumerate([(500., 5600., '-30.0'), 
+                                            (1000., 100., '5.0'),
+                                            (850., 1500., 'M'), 
+                                            (700., 3000., '-12.5')]):
+            lines.append('BN0,{},{},{},{},{:.1f},{},M,M,M,M'.format(date, 
+                         level + 4, p, z + launch, 15. - z / 200., td))
+    csvfile.write_text('\n'.join(lines) + '\n')
+    return str(csvfile)
+
+
+
+@pytest.fixture
+def narr_file(tmp_path, monkeypatch):
+    """
+    A small NARR file, in a data directory of its own: 10 3-hourly times from
+    START on a curvilinear 12 x 16 grid around the Great Lakes, with random 
+    fields (and two missing OLR values).
+    
+    Returns:
+        the file name, and a dictionary of the arrays that are in it
+    """
+    from netCDF4 import Dataset
+    monkeypatch.setattr(ut, 'get_datadir', lambda: str(tmp_path))
+    rng = np.random.default_rng(0)
+    nt, ny, nx = 10, 12, 16
+    jj, ii = np.mgrid[:ny, :nx]
+    data = {'lat':38. + 0.75 * jj + 0.05 * ii, 'lon':-95. + ii - 0.1 * jj}
+    for var, mean, std in [('t2m', 10., 5.), ('mslp', 1010., 8.),
+                           ('u10m', 0., 10.), ('v10m', 0., 10.), 
+                           ('olr', 250., 30.)]:
+        data[var] = (mean + std * rng.standard_normal((nt, ny, nx))).astype(
+                     np.float32)
+    data['olr'] = np.ma.masked_array(data['olr'])
+    data['olr'][[2, 7], 5, 6] = np.ma.masked
+    with Dataset(str(tmp_path / 'narr_test.nc'), 'w') as ncdata:
+        for dim, size in [('time', nt), ('y', ny), ('x', nx)]:
+            ncdata.createDimension(dim, size)
+        time = ncdata.createVariable('time', 'f8', ('time',))
+        time.units = 'hours since 1800-01-01'
+        time[:] = (START - datetime(1800, 1, 1)).total_seconds() / 3600. + \
+                  3. * np.arange(nt)
+        for var in ('lat', 'lon'):
+            ncdata.createVariable(var, 'f4', ('y', 'x'))[:] = data[var]
+        for var in ('t2m', 'mslp', 'u10m', 'v10m', 'olr'):
+            ncvar = ncdata.createVariable(var, 'f4', ('time', 'y', 'x'),
+                                          fill_value=1e20)
+            ncvar.units = 'test units'
+            ncvar[:] = data[var]
+    return 'narr_test.nc', data
+
+
+
+def _read_blocks(csvfile, **kwargs):
+    """
+    Returns {stid: concatenated dates} of iter_csv_blocks(csvfile, 'asos'),
+    read in blocks of about one row.
+    """
+    dates = {}
+    for stid, columns in ut.iter_csv_blocks(csvfile, 'asos', block_mb=1e-5,
+                                            **kwargs):
+        dates.setdefault(stid, []).append(columns['dates'])
+    return {stid:np.concatenate(d) for stid, d in dates.items()}
+
+
+
+def test_iter_csv_blocks_reads_every_station(interleaved_asos):
+    dates = _read_blocks(interleaved_asos)
+    assert sorted(dates) == STATIONS
+    for stid in STATIONS:
+        assert len(dates[stid]) == 48
+        assert np.all(np.diff(dates[stid]) > np.timedelta64(0))
+
+
+
+def test_iter_csv_blocks_dt2_keeps_interleaved_stations(interleaved_asos):
+    # Every station's rows through the first time after dt2 (11 rows), even
+    # though the first station passes dt2 before the others are seen
+    dt2 = START + timedelta(hours=9, minutes=30)
+    last = np.datetime64(START + timedelta(hours=10), 'm')
+    for stations in [None, STATIONS, ['BN1', 'BN3']]:
+        dates = _read_blocks(interleaved_asos, stations=stations, dt2=dt2)
+        assert sorted(dates) == (STATIONS if stations is None else stations)
+        for stid, d in dates.items():
+            assert len(d) == 11 and d[-1] == last, stid
+
+
+
+def test_iter_csv_blocks_values(interleaved_asos):
+    columns = ut._read_csv(interleaved_asos, 'asos', stations=['BN2'])
+    np.testing.assert_allclose(columns['t'], 12. + 0.1 * np.arange(48),
+                               rtol=1e-6)
+    assert np.all(np.isnan(columns['prec']))
+
+
+
+def _save_manifest_entries(path, worker, n):
+    """
+    Records and saves [n] manifest entries, one at a time (in a pool worker).
+    """
+    for i in range(n):
+        manifest = ut.RenderManifest(path)
+        manifest.record('fig_{}_{}.png'.format(worker, i), {'data':str(i)})
+        manifest.save()
+
+
+
+def test_render_manifest_concurrent_saves(tmp_path):
+    from concurrent.futures import ProcessPoolExecutor
+    path = str(tmp_path / 'manifest.json')
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(_save_manifest_entries, [path] * 4, range(4), [25] * 4))
+    entries = ut.RenderManifest(path).entries
+    assert len(entries) == 100
+    assert entries['fig_3_24.png'] == {'data':'24'}
+
+
+
+def test_regrid_soundings_without_launches(tmp_path):
+    csvfile = tmp_path / 'soundings_empty.txt'
+    csvfile.write_text('station,validUTC,levelcode,pressure_mb,height_m,'
+                       'tmpc,dwpc,drct,speed_kts,bearing,range_sm\n')
+    nlevels = len(ut.SOUNDING_LEVELS['p'])
+    for grid in [ut.regrid_soundings([]),
+                 ut.regrid_soundings('BN0', csvfile=str(csvfile)),
+                 ut.regrid_soundings([], coord='z', levels=[0., 1000.])]:
+        assert len(grid['stations']) == len(grid['dates']) == 0
+        for var in ('t', 'td', 'z' if grid['coord'] == 'p' else 'p'):
+            assert grid[var].shape == (0, len(grid['levels']))
+            assert grid[var].dtype == np.float32
+    assert ut.regrid_soundings([])['t'].shape == (0, nlevels)
+    stats = ut.sounding_climatology(ut.regrid_soundings([]))
+    assert np.all(np.isnan(stats['t_mean']))
+
+
+
+@pytest.mark.parametrize('large', [False, True], ids=['small', 'large'])
+def test_large_files_get_a_sidecar(interleaved_asos, cachedir, monkeypatch,
+                                   large):
+    # A file above STREAM_MIN_MB is parsed block by block into its sidecar
+    # once, and later calls (even in a new session) use the sidecar
+    import instrument
+    if large:
+        monkeypatch.setattr(ut, 'STREAM_MIN_MB', 0.)
+    dt1, dt2 = START + timedelta(hours=5), START + timedelta(hours=20)
+    expected = ut._read_csv(interleaved_asos, 'asos', stations=['BN1'])
+    instrument.reset()
+    instrument.enable()
+    try:
+        for _ in range(2):
+            data = ut.get_meteorogram('BN1', dt1, dt2, csvfile=interleaved_asos)
+            monkeypatch.setattr(ut, '_asos_cache', {})
+        counts = instrument.summary()['counters']
+    finally:
+        instrument.reset()
+    assert counts.get('asos.sidecar_hits') == 1
+    assert len(list(cachedir.glob('*.npy'))) == 2
+    assert not list(cachedir.glob('*.spool')) + list(cachedir.glob('*.tmp'))
+    np.testing.assert_allclose(data['t'], expected['t'][5:21])
+    assert data['dates'][0] == dt1 and data['dates'][-1] == dt2
+
+
+
+def test_large_file_streams_without_a_cache(interleaved_asos, cachedir, 
+                                            monkeypatch):
+    # ... and only if the sidecar can't be written are the rows streamed
+    monkeypatch.setattr(ut, 'STREAM_MIN_MB', 0.)
+    monkeypatch.setattr(ut, 'get_cachedir', 
+                        lambda: str(cachedir / 'missing' / 'dir'))
+    dt1, dt2 = START + timedelta(hours=5), START + timedelta(hours=20)
+    data = ut.get_meteorogram('BN2', dt1, dt2, csvfile=interleaved_asos)
+    np.testing.assert_allclose(data['t'], 12. + 0.1 * np.arange(5, 21),
+                               rtol=1e-6)
+    assert ut._asos_cache == {}
+
+
+
+def test_write_sidecar_stale_removal(tmp_path):
+    old = str(tmp_path / 'asos_X.1-10')
+    ut.write_sidecar(old, 'asos_X.', [('.npy', np.arange(3))])
+    new = str(tmp_path / 'asos_X.2-20')
+    ut.write_sidecar(new, 'asos_X.', [('.npy', np.arange(4))])
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['asos_X.2-20.npy']
+    # content-keyed caches (prefix None) are all kept
+    for key in ('aaa', 'bbb'):
+        ut.write_sidecar(str(tmp_path / ('narr_xy.' + key)), None, 
+                         [('.npy', np.zeros((2, 3, 3)))])
+    assert len(list(tmp_path.glob('narr_xy.*.npy'))) == 2
+    rows = [np.arange(5.), np.arange(5.) * 2]
+    ut.write_sidecar(str(tmp_path / 'rows'), None, [('.npy', rows)])
+    np.testing.assert_array_equal(np.load(str(tmp_path / 'rows.npy')), 
+                                  np.stack(rows))
+
+
+
+def _raw_column(csvfile, name, date):
+    """
+    Returns the values of column [name] of the rows of [date] in a RAOB file
+    (those with a temperature and dewpoint), in height order.
+    """
+    import csv
+    with open(csvfile, 'r') as f:
+        rows = [row for row in csv.DictReader(f) if row['validUTC'] == date
+                and 'M' not in (row['tmpc'], row['dwpc'])]
+    rows.sort(key=lambda row: float(row['height_m']))
+    return np.array([float(row[name]) for row in rows])
+
+
+
+@pytest.mark.parametrize('stid, date', [('BN0', '2010-10-23 12:00:00'),
+                                        ('KILX', '2010-10-23 00:00:00')])
+def test_sounding_pressure_column(raob_file, cachedir, stid, date):
+    # 'p' is the pressure_mb column (the original loadtxt read the levelcode
+    # column as 'p')
+    csvfile = raob_file if stid == 'BN0' else None
+    sounding = ut.get_sounding(stid, datetime.strptime(date, 
+                               '%Y-%m-%d %H:%M:%S'), csvfile=csvfile)
+    csvfile = csvfile or '{}/soundings_{}.txt'.format(ut.get_datadir(), stid)
+    np.testing.assert_allclose(sounding['p'], 
+                               _raw_column(csvfile, 'pressure_mb', date))
+    assert not np.allclose(sounding['p'][:3], 
+                           _raw_column(csvfile, 'levelcode', date)[:3])
+    np.testing.assert_allclose(sounding['z'], 
+                               _raw_column(csvfile, 'height_m', date))
+
+
+
+def _counters(func, *args, **kwargs):
+    """
+    Returns the result of func(*args, **kwargs), and the instrument counters
+    that it incremented.
+    """
+    import instrument
+    instrument.reset()
+    instrument.enable()
+    try:
+        result = func(*args, **kwargs)
+        return result, instrument.summary()['counters']
+    finally:
+        instrument.reset()
+
+
+
+def test_load_asos_sidecar(interleaved_asos, cachedir, monkeypatch):
+    asos, counts = _counters(ut.load_asos, 'BN1', interleaved_asos)
+    assert 'asos.sidecar_hits' not in counts
+    np.testing.assert_allclose(asos['t'], 11. + 0.1 * np.arange(48), 
+                               rtol=1e-6)
+    assert asos['dates'].dtype == np.dtype('datetime64[m]')
+    assert asos['dates'][0] == np.datetime64(START, 'm')
+    assert asos['index'].nearest(START + timedelta(hours=7, minutes=40)) == 8
+    # The same session reuses the decoded columns
+    assert _counters(ut.load_asos, 'BN1', interleaved_asos)[1] == \
+           {'asos.cache_hits':1}
+    # ... and a new session memory-maps the sidecar
+    monkeypatch.setattr(ut, '_asos_cache', {})
+    again, counts = _counters(ut.load_asos, 'BN1', interleaved_asos)
+    assert counts == {'asos.sidecar_hits':1}
+    assert isinstance(again['block'], np.memmap)
+    for var in ('dates', 't', 'td', 'wdir', 'wspd', 'pres', 'prec'):
+        np.testing.assert_array_equal(again[var], asos[var])
+
+
+
+def test_load_asos_file_changes(interleaved_asos, cachedir):
+    import os
+    ut.load_asos('BN1', interleaved_asos)
+    with open(interleaved_asos, 'r') as f:
+        text = f.read()
+    # (same size, later modification time)
+    with open(interleaved_asos, 'w') as f:
+        f.write(text.replace(',180.00,', ',270.00,'))
+    mtime = os.stat(interleaved_asos).st_mtime_ns + 10**9
+    os.utime(interleaved_asos, ns=(mtime, mtime))
+    asos, counts = _counters(ut.load_asos, 'BN1', interleaved_asos)
+    assert counts['csv.rows_parsed'] == 4 * 48
+    assert 'asos.cache_hits' not in counts
+    assert 'asos.sidecar_hits' not in counts
+    assert np.all(asos['wdir'] == 270.)
+    # the stale sidecar was replaced
+    assert len(list(cachedir.glob('*.npy'))) == 2
+    key = '{}-{}'.format(*ut.file_key(interleaved_asos))
+    assert all(key in path.name for path in cachedir.glob('*.npy'))
+
+
+
+@pytest.mark.parametrize('large', [False, True], ids=['small', 'large'])
+def test_sounding_store(raob_file, cachedir, monkeypatch, large):
+    if large: # (built block by block)
+        monkeypatch.setattr(ut, 'STREAM_MIN_MB', 0.)
+    store = ut.load_soundings('BN0', raob_file)
+    launches = [np.datetime64(START, 's'), 
+                np.datetime64(START + timedelta(hours=12), 's')]
+    assert list(store['launches']) == launches
+    assert list(store['offsets']) == [0, 4] and list(store['lengths']) == [4, 4]
+    # each launch's levels are sorted by height
+    np.testing.assert_array_equal(store['z'], [100., 1500., 3000., 5600.,
+                                               112., 1512., 3012., 5612.])
+    np.testing.assert_array_equal(store['p'][:4], [1000., 850., 700., 500.])
+    assert np.isnan(store['td'][[1, 5]]).all()
+    # a new session reads the same store from its sidecar
+    monkeypatch.setattr(ut, '_sounding_cache', {})
+    again, counts = _counters(ut.load_soundings, 'BN0', raob_file)
+    assert counts == {'sounding.sidecar_hits':1}
+    for var in ('launches', 'offsets', 'lengths', 'p', 'z', 't', 'td'):
+        np.testing.assert_array_equal(again[var], store[var])
+        
+    # Profiles: the nearest launch (the earlier one on a tie), without the
+    # levels with missing values
+    dates = [START + timedelta(hours=h) for h in (-6, 6, 7, 30)]
+    profiles = ut.get_soundings('BN0', dates, csvfile=raob_file)
+    assert [p['date'] for p in profiles] == [START, START] + \
+           [START + timedelta(hours=12)] * 2
+    np.testing.assert_array_equal(profiles[0]['p'], [1000., 700., 500.])
+    np.testing.assert_allclose(profiles[2]['td'], [5., -12.5, -30.])
+    table = ut.get_sounding('BN0', START, csvfile=raob_file, compact=True)
+    np.testing.assert_array_equal(table['z'], [100., 3000., 5600.])
+
+
+
+def test_clear_caches(interleaved_asos, raob_file, cachedir):
+    ut.load_asos('BN1', interleaved_asos)
+    ut.load_soundings('BN0', raob_file)
+    # an empty memory cache (as in a new session) reads the sidecars
+    ut.clear_caches()
+    assert _counters(ut.load_asos, 'BN1', interleaved_asos)[1] == \
+           {'asos.sidecar_hits':1}
+    assert _counters(ut.load_soundings, 'BN0', raob_file)[1] == \
+           {'sounding.sidecar_hits':1}
+    # ... and clearing a file's sidecars too parses that file again
+    asos_files = sorted(p.name for p in cachedir.iterdir()
+                        if p.name.startswith('asos_'))
+    ut.clear_caches(raob_file)
+    assert sorted(p.name for p in cachedir.iterdir()) == asos_files
+    counts = _counters(ut.load_soundings, 'BN0', raob_file)[1]
+    assert 'sounding.sidecar_hits' not in counts
+    assert counts['csv.rows_parsed'] == 8
+
+
+
+def test_narr_dataset_lazy_reads(narr_file):
+    ncfile, data = narr_file
+    dt1, dt2 = START + timedelta(hours=3), START + timedelta(hours=24)
+    narr, counts = _counters(ut.load_narr_data, dt1, dt2, ncfile=ncfile, 
+                             chunk_size=3)
+    # Only the times and the grid are read when the file is opened
+    assert 'narr.chunk_reads' not in counts
+    assert list(narr['dates']) == [START + timedelta(hours=h) for h in 
+                                   range(3, 25, 3)]
+    np.testing.assert_array_equal(narr['lats'], 
+                                  data['lat'].astype(np.float32))
+    t2m = narr['t2m']
+    assert t2m.shape == (8, 12, 16) and len(t2m) == 8
+    
+    # One time step reads one chunk (of 3 times)
+    field, counts = _counters(lambda: t2m[4, 2:5, :])
+    np.testing.assert_array_equal(field, data['t2m'][5, 2:5, :])
+    assert counts['narr.chunk_reads'] == 1
+    # a range across chunks only reads the chunks that aren't cached yet
+    fields, counts = _counters(lambda: t2m[2:7])
+    np.testing.assert_array_equal(fields, data['t2m'][3:8])
+    assert counts['narr.chunk_reads'] == 2 and counts['narr.chunk_hits'] == 1
+    # integer and boolean index arrays, negative indices, and all times
+    np.testing.assert_array_equal(t2m[[7, 0]], data['t2m'][[8, 1]])
+    np.testing.assert_array_equal(t2m[np.arange(8) % 3 == 0, 0, 0], 
+                                  data['t2m'][[1, 4, 7], 0, 0])
+    np.testing.assert_array_equal(t2m[-1], data['t2m'][8])
+    np.testing.assert_array_equal(np.asarray(t2m), data['t2m'][1:9])
+    with pytest.raises(IndexError):
+        t2m[8]
+    assert t2m[5:5].shape == (0, 12, 16)
+    # the chunks cover the time range, and masked values stay masked
+    olr = np.ma.concatenate([chunk for _, chunk in 
+                             narr['olr'].iter_chunks()])
+    assert [t for t, _ in narr['olr'].iter_chunks()] == [slice(0, 3), 
+           slice(3, 6), slice(6, 8)]
+    assert np.array_equal(np.ma.getmaskarray(olr), 
+                          np.ma.getmaskarray(data['olr'][1:9]))
+    
+    # With a small memory budget, only the newest chunk is kept
+    narr = ut.load_narr_data(dt1, dt2, ncfile=ncfile, chunk_size=3, 
+                             cache_mb=1e-3)
+    for d in range(8):
+        narr['mslp'][d]
+    assert len(narr._chunks) == 1
+    assert _counters(lambda: narr['mslp'][0])[1]['narr.chunk_reads'] == 1
+
+
+
+def test_time_index():
+    # Hourly times with gaps and a repeated time, against nearest_ind()
+    hours = np.array([0, 1, 2, 2, 5, 6, 10, 11, 12, 20])
+    times = [START + timedelta(hours=int(h)) for h in hours]
+    index = ut.TimeIndex(times)
+    targets = [START + timedelta(minutes=m) for m in range(-120, 1400, 10)]
+    expected = [ut.nearest_ind(np.array(times), t) for t in targets]
+    assert [index.nearest(t) for t in targets] == expected
+    np.testing.assert_array_equal(index.nearest_many(targets), expected)
+    # ties go to the earlier time, and repeated times to their first index
+    assert index.nearest(START + timedelta(hours=3, minutes=30)) == 2
+    assert index.nearest(START + timedelta(hours=8)) == 5
+    assert index.nearest(np.datetime64(START + timedelta(hours=2), 'm')) == 2
+    
+    # Ranges run from the time nearest [dt1] through the time nearest [dt2]
+    assert index.slice(START + timedelta(hours=4), 
+                       START + timedelta(hours=11, minutes=20)) == slice(4, 8)
+    assert index.slice(START - timedelta(days=1), 
+                       START + timedelta(days=2)) == slice(0, 10)
+    assert ut.TimeIndex(times[:1]).slice(START, START) == slice(0, 1)
+    
+    with pytest.raises(ValueError, match='sorted'):
+        ut.TimeIndex(times[::-1])
+    with pytest.raises(IndexError):
+        ut.TimeIndex([]).nearest(START)
+
+
+
+def test_extract_stations(narr_file):
+    ncfile, data = narr_file
+    stations = ['ORD', 'MSP', 'KILX', 'GRB', 'X']
+    locations = {'X':(42.1, -89.4)} # (next to the missing OLR values)
+    # Interpolating the lat/lon grid itself gives back the stations' lat/lon
+    grid = {'dates':[START], 'lats':data['lat'], 'lons':data['lon'],
+            'glat':data['lat'][None], 'glon':data['lon'][None]}
+    coords = ut.extract_stations(grid, stations, variables=('glat', 'glon'),
+                                 locations=locations)
+    points = [ut.STATION_LOCATIONS.get(stid, locations.get(stid)) for stid
+              in stations]
+    np.testing.assert_allclose(np.stack([coords['glat'][0], 
+                                         coords['glon'][0]], axis=1),
+                               points, atol=2e-3)
+    
+    # The same weights sample each time step of the data: those of the 4 
+    # corners of the cell around each station
+    narr = ut.load_narr_data(START, START + timedelta(days=1), ncfile=ncfile,
+                             chunk_size=4)
+    series = ut.extract_stations(narr, stations, variables=('t2m', 'olr'),
+                                 locations=locations)
+    assert series['stations'] == stations and len(series['dates']) == 9
+    inds, weights = ut.GridLocator(narr['lats'], narr['lons']).weights(points)
+    assert np.all(weights >= 0.)
+    np.testing.assert_allclose(weights.sum(axis=1), 1.)
+    np.testing.assert_array_equal(inds[:, [1, 2, 3]] - inds[:, [0]], 
+                                  [[1, 16, 17]] * len(stations))
+    for var in ('t2m', 'olr'):
+        flat = np.ma.getdata(data[var][:9]).reshape(9, -1).astype(float)
+        expected = np.einsum('tsk,sk->ts', flat[:, inds], weights)
+        expected[np.ma.getmaskarray(data[var][:9]).reshape(9, -1)[:, 
+                 inds].any(-1)] = np.nan
+        np.testing.assert_allclose(series[var], expected, rtol=1e-6)
+    # (only station X is next to the missing values)
+    assert np.isnan(series['olr']).any(0).tolist() == [False] * 4 + [True]
+    assert np.flatnonzero(np.isnan(series['olr'][:, -1])).tolist() == [2, 7]
+    
+    with pytest.raises(ValueError, match='unknown location'):
+        ut.extract_stations(narr, ['NOWHERE'])
+    with pytest.raises(ValueError, match='outside the grid'):
+        ut.extract_stations(narr, ['X'], locations={'X':(20., -150.)})
+
+
+
+def test_station_bbox():
+    south, north, west, east = ut.station_bbox(['ORD', 'MSP', 'KILX'], 
+                                               margin=1.)
+    np.testing.assert_allclose([south, north, west, east], 
+                               [39.15, 45.88, -94.23, -86.9])
+    with pytest.raises(ValueError, match='unknown location'):
+        ut.station_bbox(['ORD', 'NOWHERE'])
+
+
+
+@pytest.mark.parametrize('bbox', [(40., 44., -90., -85.), (41.3, 41.5, -87.5,
+                         -87.3), (0., 90., -180., 180.), (46., 60., -84., 0.)],
+                         ids=['box', 'one-point', 'everything', 'corner'])
+def test_narr_window(narr_file, bbox):
+    _, data = narr_file
+    lats, lons = data['lat'], data['lon']
+    south, north, west, east = bbox
+    inside = (lats >= south) & (lats <= north) & (lons >= west) & \
+             (lons <= east)
+    # Without padding, the window is the smallest one that holds the box
+    rows, cols = ut.narr_window(lats, lons, bbox, pad=0)
+    assert inside[rows, cols].sum() == inside.sum() > 0
+    for edge in (inside[rows, cols][0], inside[rows, cols][-1], 
+                 inside[rows, cols][:, 0], inside[rows, cols][:, -1]):
+        assert edge.any()
+    # ... and the padding is added on each side (within the grid)
+    padded = ut.narr_window(lats, lons, bbox)
+    for s, p, n in zip((rows, cols), padded, lats.shape):
+        assert (p.start, p.stop) == (max(s.start - 1, 0), min(s.stop + 1, n))
+
+
+
+def test_narr_window_date_line_and_errors():
+    jj, ii = np.mgrid[:5, :10]
+    lats, lons = 50. + jj, (170. + 2. * ii + 180.) % 360. - 180.
+    # (the box crosses the date line, from 175E to 175W)
+    assert ut.narr_window(lats, lons, (51., 52., 175., -175.), pad=0) == \
+           (slice(1, 3), slice(3, 8))
+    with pytest.raises(ValueError, match='no grid points'):
+        ut.narr_window(lats, lons, (0., 10., 0., 10.))
+
+
+
+def test_load_narr_region(narr_file):
+    ncfile, data = narr_file
+    dt1, dt2 = START, START + timedelta(hours=12)
+    full = ut.load_narr_data(dt1, dt2, ncfile=ncfile)
+    for region in [{'bbox':(40., 44., -90., -85.)}, 
+                   {'stations':['ORD', 'GRB'], 'margin':1.}]:
+        narr = ut.load_narr_data(dt1, dt2, ncfile=ncfile, **region)
+        bbox = region.get('bbox') or ut.station_bbox(['ORD', 'GRB'], 1.)
+        window = ut.narr_window(full['lats'], full['lons'], bbox)
+        assert narr.window == window
+        assert narr['t2m'].shape == (5,) + full['lats'][window].shape
+        np.testing.assert_array_equal(narr['lons'], full['lons'][window])
+        np.testing.assert_array_equal(narr['t2m'][1:4], 
+                                      full['t2m'][1:4][(slice(None),) + 
+                                                       window])
+
+
+
+def test_obs_table(interleaved_asos, cachedir):
+    dt1, dt2 = START + timedelta(hours=5), START + timedelta(hours=20)
+    tables = [ut.get_meteorogram(stid, dt1, dt2, csvfile=interleaved_asos, 
+                                 compact=True) for stid in STATIONS[:3]]
+    table = tables[1]
+    assert len(table) == 16 and table.stations == ['BN1']
+    assert table.block.dtype == np.float32 and table.block.shape == (6, 16)
+    # it indexes like the dictionary of get_meteorogram()
+    datadict = ut.get_meteorogram('BN1', dt1, dt2, csvfile=interleaved_asos)
+    assert set(table.keys()) == set(datadict.keys()) and 't' in table
+    assert list(table['dates']) == list(datadict['dates'])
+    converted = table.to_dict()
+    for var in ('t', 'td', 'wdir', 'wspd', 'pres'):
+        assert np.shares_memory(table[var], table.block)
+        assert converted[var].dtype == np.float64
+        np.testing.assert_array_equal(converted[var], datadict[var])
+    assert np.isnan(table['prec']).all() and np.all(datadict['prec'] == 0.)
+    with pytest.raises(KeyError):
+        table['rh']
+    assert table.get('rh', 'none') == 'none'
+    
+    # Several stations in one table: each station's rows are contiguous
+    both = ut.ObsTable.concat(tables)
+    assert both.stations == STATIONS[:3] and list(both.offsets) == [0, 16, 32]
+    for stid, part in zip(STATIONS, tables):
+        rows = both.station(stid)
+        assert np.shares_memory(rows.block, both.block)
+        np.testing.assert_array_equal(rows.block, part.block)
+        np.testing.assert_array_equal(rows.times, part.times)
+    # and time ranges (inclusive) are taken from each station
+    window = both.between(START + timedelta(hours=6), 
+                          START + timedelta(hours=8))
+    assert window.stations == both.stations and len(window) == 9
+    assert list(window.offsets) == [0, 3, 6]
+    np.testing.assert_array_equal(window.station('BN2')['t'], 
+                                  tables[2]['t'][1:4])
+    one = table.between(START + timedelta(hours=6), START + timedelta(hours=8))
+    assert len(one) == 3 and np.shares_memory(one.block, table.block)
+    
+    # Tables built from columns, and the errors
+    built = ut.ObsTable.from_columns(table.times, {'t':table['t'], 
+                                     'td':table['td']}, stations=['BN1'], 
+                                     attrs={'source':'test'})
+    assert built.keys() == ['dates', 't', 'td', 'source']
+    assert built['source'] == 'test' and built.nbytes == 16 * (8 + 2 * 4)
+    with pytest.raises(ValueError, match='same columns'):
+        ut.ObsTable.concat([table, built])
+    with pytest.raises(ValueError, match='not in the table'):
+        both.station('BN3')
+    with pytest.raises(ValueError, match='variable, time'):
+        ut.ObsTable(table.times, table.block.T, table.columns)
+
+
+
+def test_derive_narr_fields(narr_file, cachedir):
+    ncfile, data = narr_file
+    # 9 times: 8 hours of the day, and 00Z twice
+    dt1, dt2 = START, START + timedelta(days=1)
+    narr = ut.load_narr_data(dt1, dt2, ncfile=ncfile, chunk_size=4, 
+                             derived=True)
+    hours = np.array([d.hour for d in narr['dates']])
+    assert list(narr['hours']) == list(range(0, 24, 3))
+    fields = {var:np.ma.masked_array(data[var][:9], dtype=float) for var in 
+              ('t2m', 'mslp', 'olr')}
+    fields['wspd10m'] = np.ma.sqrt(data['u10m'][:9].astype(float)**2 + 
+                                   data['v10m'][:9].astype(float)**2)
+    np.testing.assert_allclose(narr['wspd10m'][:], fields['wspd10m'], 
+                               rtol=1e-6)
+    for var, values in fields.items():
+        # Brute force: the statistics over all times, and each time's 
+        # anomaly from the mean of the times at the same hour
+        for stat, func in [('mean', np.ma.mean), ('std', np.ma.std),
+                           ('min', np.ma.min), ('max', np.ma.max)]:
+            np.testing.assert_allclose(narr['{}_{}'.format(var, stat)], 
+                                       func(values, axis=0), rtol=1e-5, 
+                                       atol=1e-4, err_msg=var + ' ' + stat)
+        cycle = np.ma.stack([values[hours == h].mean(axis=0) for h in 
+                             narr['hours']])
+        np.testing.assert_allclose(narr[var + '_diurnal'], cycle, rtol=1e-5)
+        anom = narr[var + '_anom'][:]
+        expected = values - cycle[hours // 3]
+        np.testing.assert_allclose(anom, expected, rtol=1e-5, atol=1e-4,
+                                   err_msg=var + ' anomaly')
+        assert np.array_equal(np.ma.getmaskarray(anom), 
+                              np.ma.getmaskarray(expected))
+    # (the 00Z anomalies are +/- half the difference of the two 00Z times)
+    np.testing.assert_allclose(narr['t2m_anom'][0], -narr['t2m_anom'][8], 
+                               atol=1e-4)
+    
+    # The sidecar is only computed once
+    again, counts = _counters(ut.load_narr_data, dt1, dt2, ncfile=ncfile, 
+                              derived=True)
+    assert counts['narr.derived_hits'] == 1
+    np.testing.assert_array_equal(again['olr_std'], narr['olr_std'])
+    with pytest.raises(ValueError, match='no variable'):
+        ut.derive_narr_fields(narr, variables=['rh2m'])
+
+
+
+@pytest.mark.parametrize('coord, levels', [
+    ('p', [1050., 1000., 925., 850., 775., 700., 600., 500., 400.]),
+    ('z', [0., 100., 112., 800., 1500., 2000., 3000., 5000., 5612., 6000.])])
+def test_regrid_soundings(raob_file, cachedir, coord, levels):
+    grid = ut.regrid_soundings('BN0', coord=coord, levels=levels, 
+                               csvfile=raob_file)
+    store = ut.load_soundings('BN0', raob_file)
+    assert list(grid['stations']) == ['BN0', 'BN0']
+    np.testing.assert_array_equal(grid['dates'], store['launches'])
+    # Brute force: each launch interpolated on its own, in log(p) or z, 
+    # skipping the missing values and without extrapolating
+    levels = np.array(levels)
+    targets = -np.log(levels) if coord == 'p' else levels
+    for var in ('p', 'z', 't', 'td'):
+        if var == coord:
+            continue
+        for i, (offset, length) in enumerate(zip(store['offsets'], 
+                                                 store['lengths'])):
+            x = store[coord][offset:offset + length].astype(float)
+            x = -np.log(x) if coord == 'p' else x
+            values = store[var][offset:offset + length].astype(float)
+            good = ~np.isnan(values)
+            expected = np.interp(targets, x[good], values[good], left=np.nan,
+                                 right=np.nan)
+            np.testing.assert_allclose(grid[var][i], expected, rtol=1e-6,
+                                       err_msg='{} {}'.format(var, i))
+    assert grid['t'].dtype == np.float32
+    assert np.isnan(grid['t'][:, 0]).all() and np.isnan(grid['t'][:, -1]).all()
+    
+    # The time range, and the cache
+    late = ut.regrid_soundings('BN0', coord=coord, levels=levels, 
+                               csvfile=raob_file, 
+                               dt1=START + timedelta(hours=1))
+    assert len(late['dates']) == 1
+    np.testing.assert_array_equal(late['td'], grid['td'][1:])
+    counts = _counters(ut.regrid_soundings, 'BN0', coord=coord, 
+                       levels=levels, csvfile=raob_file)[1]
+    assert counts['sounding.regrid_hits'] == 1
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Module containing vectorized thermodynamic calculations (relative humidity,
+vapor pressure, mixing ratio, potential/equivalent potential temperature,
+wet-bulb temperature, and the lifting condensation level).
+
+Every function works like a numpy ufunc: the inputs can be scalars or arrays
+of any (broadcastable) shapes, e.g. a single sounding level or a whole
+(time, y, x) NARR grid. float32 inputs give float32 results, and the result
+can be written into an existing array with the [out] argument, so that it
+isn't reallocated. That doesn't make a function allocation-free: most of
+them still need one or more work arrays of the result's size (up to five
+for wet_bulb_temperature), and an input that overlaps [out] is copied.
+
+Unless stated otherwise, temperatures are in Celsius and pressures in hPa.
+The formulas are from Bolton (1980), "The computation of equivalent
+potential temperature", Monthly Weather Review 108, 1046-1053.
+
+@author: njweber2
+"""
+import numpy as np
+
+# Physical constants
+T0 = 273.15       # 0 Celsius in Kelvin
+KAPPA = 0.2854    # Rd/cp for dry air
+EPSILON = 0.622   # Rd/Rv
+# Coefficients of Bolton's saturation vapor pressure formula (over water)
+ES0 = 6.112       # saturation vapor pressure at 0C [hPa]
+ES_B = 17.67
+ES_C = 243.5      # [C]
+# Psychrometer coefficient (for a ventilated psychrometer) [1/C]
+PSYCHRO = 6.6e-4
+
+
+
+def vapor_pressure(td, out=None):
+    """
+    Calculates the vapor pressure from the dewpoint (or the saturation vapor
+    pressure from the temperature).
+
+    Requires:
+        td ---> dewpoint temperatures in Celsius (array_like)
+        out --> (optional) array to store the result in
+
+    Returns:
+        e ----> vapor pressures in hPa
+    """
+    out, (td,) = _output(out, td)
+    # e = ES0 * exp(ES_B * td / (td + ES_C))
+    np.add(td, ES_C, out=out)
+    np.divide(td, out, out=out)
+    np.multiply(out, ES_B, out=out)
+    np.exp(out, out=out)
+    np.multiply(out, ES0, out=out)
+    return out
+
+
+
+def relative_humidity(t, td, out=None):
+    """
+    Calculates the relative humidity from the temperature and dewpoint.
+
+    Requires:
+        t ----> temperatures in Celsius (array_like)
+        td ---> dewpoint temperatures in Celsius (array_like)
+        out --> (optional) array to store the result in
+
+    Returns:
+        rh ---> relative humidities in percent
+    """
+    out, (t, td) = _output(out, t, td)
+    # rh = 100 * e(td) / e(t)
+    #    = 100 * exp(ES_B * (td / (td + ES_C) - t / (t + ES_C)))
+    scratch = _scratch(out)
+    np.add(t, ES_C, out=scratch)
+    np.divide(t, scratch, out=scratch)
+    np.add(td, ES_C, out=out)
+    np.divide(td, out, out=out)
+    np.subtract(out, scratch, out=out)
+    np.multiply(out, ES_B, out=out)
+    np.exp(out, out=out)
+    np.multiply(out, 100., out=out)
+    return out
+
+
+
+def mixing_ratio(td, p, out=None):
+    """
+    Calculates the water vapor mixing ratio from the dewpoint and pressure
+    (or the saturation mixing ratio from the temperature and pressure).
+
+    Requires:
+        td ---> dewpoint temperatures in Celsius (array_like)
+        p ----> pressures in hPa (array_like)
+        out --> (optional) array to store the result in
+
+    Returns:
+        w ----> mixing ratios in g/kg
+    """
+    out, (td, p) = _output(out, td, p)
+    # w = 1000 * EPSILON * e / (p - e)
+    e = vapor_pressure(np.broadcast_to(td, out.shape), out=out)
+    scratch = _scratch(out)
+    np.subtract(p, e, out=scratch)
+    np.divide(e, scratch, out=out)
+    np.multiply(out, 1000. * EPSILON, out=out)
+    return out
+
+
+
+def potential_temperature(t, p, out=None):
+    """
+    Calculates the potential temperature.
+
+    Requires:
+        t ----> temperatures in Celsius (array_like)
+        p ----> pressures in hPa (array_like)
+        out --> (optional) array to store the result in
+
+    Returns:
+        theta -> potential temperatures in Kelvin
+    """
+    out, (t, p) = _output(out, t, p)
+    # theta = (t + T0) * (1000 / p) ** KAPPA
+    np.divide(1000., p, out=out)
+    np.power(out, KAPPA, out=out)
+    scratch = _scratch(out)
+    np.add(t, T0, out=scratch)
+    np.multiply(out, scratch, out=out)
+    return out
+
+
+
+def lcl_temperature(t, td, out=None):
+    """
+    Calculates the temperature at the lifting condensation level (LCL) of a
+    parcel (Bolton eq. 15).
+
+    Requires:
+        t ----> temperatures in Celsius (array_like)
+        td ---> dewpoint temperatures in Celsius (array_like)
+        out --> (optional) array to store the result in
+
+    Returns:
+        tlcl -> LCL temperatures in Celsius
+    """
+    out, (t, td) = _output(out, t, td)
+    _lcl_kelvin(t, td, out)
+    np.subtract(out, T0, out=out)
+    return out
+
+
+
+def lcl_pressure(t, td, p, out=None):
+    """
+    Calculates the pressure at the lifting condensation level (LCL) of a
+    parcel, by lifting it dry-adiabatically to the LCL temperature.
+
+    Requires:
+        t ----> temperatures in Celsius (array_like)
+        td ---> dewpoint temperatures in Celsius (array_like)
+        p ----> pressures in hPa (array_like)
+        out --> (optional) array to store the result in
+
+    Returns:
+        plcl -> LCL pressures in hPa
+    """
+    out, (t, td, p) = _output(out, t, td, p)
+    # plcl = p * (tlcl / t) ** (1 / KAPPA)   [temperatures in K]
+    _lcl_kelvin(t, td, out)
+    scratch = _scratch(out)
+    np.add(t, T0, out=scratch)
+    np.divide(out, scratch, out=out)
+    np.power(out, 1. / KAPPA, out=out)
+    np.multiply(out, p, out=out)
+    return out
+
+
+
+def equivalent_potential_temperature(t, td, p, out=None):
+    """
+    Calculates the equivalent potential temperature (Bolton eq. 43).
+
+    Requires:
+        t ----> temperatures in Celsius (array_like)
+        td ---> dewpoint temperatures in Celsius (array_like)
+        p ----> pressures in hPa (array_like)
+        out --> (optional) array to store the result in
+
+    Returns:
+        thetae -> equivalent potential temperatures in Kelvin
+    """
+    out, (t, td, p) = _output(out, t, td, p)
+    w = mixing_ratio(td, p, out=_scratch(out))  # in g/kg
+    tlcl = _lcl_kelvin(t, td, _scratch(out))
+
+    # moisture term: exp((3.376 / tlcl - 0.00254) * w * (1 + 0.00081 * w))
+    np.divide(3.376, tlcl, out=tlcl)
+    np.subtract(tlcl, 0.00254, out=tlcl)
+    np.multiply(tlcl, w, out=tlcl)
+    np.multiply(w, 0.00081, out=out)
+    np.add(out, 1., out=out)
+    np.multiply(tlcl, out, out=tlcl)
+    np.exp(tlcl, out=tlcl)
+
+    # dry term: (t + T0) * (1000 / p) ** (KAPPA * (1 - 0.00028 * w))
+    np.multiply(w, -0.00028 * KAPPA, out=w)
+    np.add(w, KAPPA, out=w)
+    np.divide(1000., p, out=out)
+    np.power(out, w, out=out)
+    np.multiply(out, np.add(t, T0, out=w), out=out)
+
+    np.multiply(out, tlcl, out=out)
+    return out
+
+
+
+def wet_bulb_temperature(t, td, p, out=None, iterations=5):
+    """
+    Calculates the (psychrometric) wet-bulb temperature, by solving
+        e(td) = e(tw) - PSYCHRO * p * (t - tw)
+    for tw with a few Newton iterations.
+
+    Requires:
+        t ----------> temperatures in Celsius (array_like)
+        td ---------> dewpoint temperatures in Celsius (array_like)
+        p ----------> pressures in hPa (array_like)
+        out --------> (optional) array to store the result in
+        iterations -> number of Newton iterations (int)
+
+    Returns:
+        tw ---------> wet-bulb temperatures in Celsius
+    """
+    out, (t, td, p) = _output(out, t, td, p)
+    e = vapor_pressure(np.broadcast_to(td, out.shape), out=_scratch(out))
+    gamma = np.multiply(np.broadcast_to(p, out.shape), PSYCHRO, 
+                        out=_scratch(out))
+    f = _scratch(out)
+    df = _scratch(out)
+    dt = _scratch(out)
+
+    # First guess: the wet-bulb temperature is between td and t
+    np.add(t, td, out=out)
+    np.multiply(out, 0.5, out=out)
+    for _ in range(iterations):
+        # df/dtw = e(tw) * ES_B * ES_C / (tw + ES_C)**2 + PSYCHRO * p
+        vapor_pressure(out, out=f)
+        np.add(out, ES_C, out=df)
+        np.square(df, out=df)
+        np.divide(f, df, out=df)
+        np.multiply(df, ES_B * ES_C, out=df)
+        np.add(df, gamma, out=df)
+        # f(tw) = e(tw) - e(td) - PSYCHRO * p * (t - tw)
+        np.subtract(f, e, out=f)
+        np.subtract(t, out, out=dt)
+        np.multiply(dt, gamma, out=dt)
+        np.subtract(f, dt, out=f)
+        # tw = tw - f / df
+        np.divide(f, df, out=f)
+        np.subtract(out, f, out=out)
+    return out
+
+
+
+def _lcl_kelvin(t, td, out):
+    """
+    Stores the LCL temperature in Kelvin (Bolton eq. 15) in [out]:
+        tlcl = 1 / (1 / (td - 56) + ln(t / td) / 800) + 56   [all in K]
+    """
+    scratch = _scratch(out)
+    np.add(t, T0, out=scratch)
+    np.log(scratch, out=scratch)
+    np.add(td, T0, out=out)
+    np.log(out, out=out)
+    np.subtract(scratch, out, out=scratch)
+    np.divide(scratch, 800., out=scratch)
+    np.add(td, T0 - 56., out=out)
+    np.reciprocal(out, out=out)
+    np.add(out, scratch, out=out)
+    np.reciprocal(out, out=out)
+    np.add(out, 56., out=out)
+    return out
+
+
+
+def _output(out, *arrays):
+    """
+    Returns [out], or (if it is None) a new array with the broadcast shape of
+    [arrays] and a floating point type, and [arrays] as numpy arrays. Like
+    numpy's (value-based) casting, only the arrays with dimensions decide the
+    type, so float32 arrays give float32 even with a Python float or a 0-d
+    float64 argument (e.g., relative_humidity(t32, 10.)). The functions 
+    write partial results into [out] while they still read their inputs, so
+    any input that overlaps [out] (e.g., f(x, out=x)) is copied first.
+    """
+    arrays = [np.asarray(a) for a in arrays]
+    if out is None:
+        shape = np.broadcast_shapes(*[a.shape for a in arrays])
+        typed = [a for a in arrays if a.ndim] or arrays
+        out = np.empty(shape, dtype=np.result_type(np.float32, *typed))
+    else:
+        # (may_share_memory only compares the memory bounds, so it may copy
+        # an input that doesn't really overlap, but it is always cheap)
+        arrays = [a.copy() if np.may_share_memory(a, out) else a 
+                  for a in arrays]
+    return out, arrays
+
+
+
+def _scratch(out):
+    """
+    Returns a new, uninitialized work array like [out].
+    """
+    return np.empty(out.shape, dtype=out.dtype)
+
+
+
+def _naive_point(name, t, td, p):
+    """
+    Scalar version of function [name], written with the math module (the
+    wet-bulb temperature is found by bisection instead of Newton's method).
+    Used to check and benchmark the vectorized versions.
+    """
+    import math
+    def vapor(x):
+        return ES0 * math.exp(ES_B * x / (x + ES_C))
+    e = vapor(td)
+    w = 1000. * EPSILON * e / (p - e)
+    tk, tdk = t + T0, td + T0
+    tlcl = 1. / (1. / (tdk - 56.) + math.log(tk / tdk) / 800.) + 56.
+    thetae = tk * (1000. / p) ** (KAPPA * (1. - 0.00028 * w)) * \
+             math.exp((3.376 / tlcl - 0.00254) * w * (1. + 0.00081 * w))
+    if name == 'wet_bulb_temperature':
+        # e(tw) - PSYCHRO * p * (t - tw) increases with tw, from <= e at 
+        # tw = td to >= e at tw = t
+        lo, hi = td, t
+        for _ in range(100):
+            tw = 0.5 * (lo + hi)
+            if vapor(tw) - PSYCHRO * p * (t - tw) < e:
+                lo = tw
+            else:
+                hi = tw
+        return tw
+    return {'vapor_pressure':e,
+            'relative_humidity':100. * e / vapor(t),
+            'mixing_ratio':w,
+            'potential_temperature':tk * (1000. / p) ** KAPPA,
+            'lcl_temperature':tlcl - T0,
+            'lcl_pressure':p * (tlcl / tk) ** (1. / KAPPA),
+            'equivalent_potential_temperature':thetae}[name]
+
+
+
+def _naive(name, t, td, p):
+    """
+    Loop-based version of function [name] (for 1-D arrays of [t], [td] and
+    [p]; see _naive_point). Used to check and benchmark the vectorized 
+    versions. NaN inputs give NaN.
+    """
+    values = np.empty(len(t))
+    for i in range(len(t)):
+        if np.isnan(t[i]) or np.isnan(td[i]) or np.isnan(p[i]):
+            values[i] = np.nan
+        else:
+            values[i] = _naive_point(name, float(t[i]), float(td[i]), 
+                                     float(p[i]))
+    return values
+
+
+
+# Any code within the following block with be executed if this module is run
+# as a script! This checks the vectorized functions against simple loops and
+# known values, and measures their throughput.
+if __name__ == '__main__':
+    import time
+    
+    # Spot checks against published values
+    print('RH(20C, 10C)      = {:.1f} % (expect ~52.5)'.format(
+          float(relative_humidity(20., 10.))))
+    print('theta(15C, 850hPa) = {:.1f} K (expect ~301.8)'.format(
+          float(potential_temperature(15., 850.))))
+    # (compare with the empirical wet-bulb formula of Stull 2011, JAMC)
+    rh = float(relative_humidity(25., 15.))
+    stull = 25. * np.arctan(0.151977 * (rh + 8.313659)**0.5) + \
+            np.arctan(25. + rh) - np.arctan(rh - 1.676331) + \
+            0.00391838 * rh**1.5 * np.arctan(0.023101 * rh) - 4.686035
+    print('Tw(25C, 15C, 1000) = {:.1f} C (expect ~{:.1f})'.format(
+          float(wet_bulb_temperature(25., 15., 1000.)), stull))
+    
+    # A NARR-sized (time, y, x) grid of random surface conditions
+    rng = np.random.default_rng(0)
+    shape = (8, 277, 349)
+    t = rng.uniform(-30., 35., shape).astype(np.float32)
+    td = t - rng.uniform(0., 20., shape).astype(np.float32)
+    p = rng.uniform(950., 1040., shape).astype(np.float32)
+    npts = t.size
+    
+    # Accuracy and speed vs. the loop version, on a 1-D sample of points
+    n = 100000
+    t1, td1, p1 = [x.ravel()[:n].astype(float) for x in (t, td, p)]
+    start = time.perf_counter()
+    slow = _naive('equivalent_potential_temperature', t1, td1, p1)
+    tslow = time.perf_counter() - start
+    start = time.perf_counter()
+    fast = equivalent_potential_temperature(t1, td1, p1)
+    tfast = time.perf_counter() - start
+    print('\ntheta-e max. abs. error vs. loop: {:.2e} K'.format(
+          np.abs(fast - slow).max()))
+    print('theta-e loop: {:.2e} pts/s, vectorized: {:.2e} pts/s '
+          '({:.0f}x)'.format(n / tslow, n / tfast, tslow / tfast))
+    
+    # Throughput of each function over the whole float32 grid (in place)
+    out = np.empty(shape, dtype=np.float32)
+    print('\nfloat32 {} grid:'.format(shape))
+    for func, args in [(vapor_pressure, (td,)), (relative_humidity, (t, td)),
+                       (mixing_ratio, (td, p)), 
+                       (potential_temperature, (t, p)),
+                       (equivalent_potential_temperature, (t, td, p)),
+                       (wet_bulb_temperature, (t, td, p)),
+                       (lcl_temperature, (t, td)), 
+                       (lcl_pressure, (t, td, p))]:
+        start = time.perf_counter()
+        func(*args, out=out)
+        print('  {:34s} {:.2e} pts/s'.format(func.__name__, 
+              npts / (time.perf_counter() - start)))
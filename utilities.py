@@ -8,7 +8,72 @@ additional tools.
 """
 import numpy as np
 from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import json
 import os
+import instrument
+
+# The (float) variables in the ASOS files, in column order after the station
+# ID and date columns: temperature [C], dewpoint [C], wind direction [deg],
+# wind speed [kts], pressure [hPa], and 1-hour precipitation [mm]
+_ASOS_COLUMNS = ('t', 'td', 'wdir', 'wspd', 'pres', 'prec')
+
+# The layouts of the Iowa State ASOS and RAOB exports in data/: the 
+# datetime64 type of the date column (column 1, after the station ID) and
+# the (column #, name) of each float variable
+_CSV_LAYOUTS = {
+    'asos' : ('datetime64[m]', list(enumerate(_ASOS_COLUMNS, 2))),
+    # pressure [hPa], height [m], temperature [C], and dewpoint [C]
+    'sounding' : ('datetime64[s]', [(3, 'p'), (4, 'z'), (5, 't'), (6, 'td')]),
+}
+
+# Files larger than this (in MB) are parsed block by block into their sidecar
+# files instead of in memory; get_meteorogram() and get_sounding() only 
+# stream the rows they need from them if the sidecar can't be written
+STREAM_MIN_MB = 256.
+
+# Decoded ASOS files: {(path, station): (file key, column dict)}
+_asos_cache = {}
+
+# Indexed sounding files: {(path, station): (file key, store dict)}
+_sounding_cache = {}
+
+# Soundings interpolated to common levels (see regrid_soundings):
+# {(path, station): (file key, {(coordinate, levels): grid dict})}
+_regrid_cache = {}
+
+# The default levels of regrid_soundings(): pressure [hPa] and height [m]
+SOUNDING_LEVELS = {'p':np.arange(1000., 99., -25.), 
+                   'z':np.arange(0., 15001., 250.)}
+
+# The (latitude, longitude) of each station with data in data/ (ASOS and 
+# RAOB), used to sample gridded data at the stations (see extract_stations)
+STATION_LOCATIONS = {
+    'CLE' : (41.41, -81.85),  # Cleveland, OH
+    'CXTO' : (43.67, -79.40), # Toronto, Ontario
+    'GRB' : (44.48, -88.13),  # Green Bay, WI
+    'MSP' : (44.88, -93.23),  # Minneapolis / St. Paul, MN
+    'ORD' : (41.98, -87.90),  # Chicago, IL
+    'KGRB' : (44.48, -88.13), # Green Bay, WI
+    'KILN' : (39.42, -83.82), # Wilmington (Cincinnati / Dayton), OH
+    'KILX' : (40.15, -89.34), # Lincoln, IL
+    'KMPX' : (44.85, -93.57), # Chanhassen, MN
+}
+
+# Grid locators (see GridLocator), by a hash of their lat/lon grids
+_locator_cache = {}
+
+# NARR grid windows (see narr_window): {(path, file key, box): (y, x) slices}
+_window_cache = {}
+
+# The NARR variables that derive_narr_fields() computes statistics and 
+# anomalies of by default ('wspd10m' is itself derived, from 'u10m'/'v10m')
+DERIVED_VARIABLES = ('t2m', 'mslp', 'olr', 'wspd10m')
+
+# Bump this when derive_narr_fields() changes, so that old sidecars are redone
+_DERIVED_VERSION = 1
 
 def calculate_rh(t, td):
     """
@@ -42,102 +107,725 @@ def calculate_rh(t, td):
 
 
 
-def load_narr_data(dt1, dt2, ncfile='narr_oct2010.nc'):
+def load_narr_data(dt1, dt2, ncfile='narr_oct2010.nc', chunk_size=8,
+                   cache_mb=256., bbox=None, stations=None, margin=2.,
+                   derived=False):
     """
-    Loads temperature, pressure, wind, and OLR data from [ncfile], a pre-
-    -processed netCDF of North American Regional Analysis (NARR) data. All
-    times (3-hourly) between [dt1] and [dt2] are loaded.
+    Opens [ncfile], a pre-processed netCDF of North American Regional Analysis
+    (NARR) data, for all times (3-hourly) between [dt1] and [dt2]. The data is
+    loaded lazily: a variable is only read from the file when it is indexed,
+    [chunk_size] time steps at a time, and the most recently used chunks are
+    kept in memory (up to [cache_mb] megabytes). If a [bbox] or [stations] 
+    are given, only the smallest window of the grid that covers them is read
+    (see narr_window). With [derived], the derived fields of the time range
+    are added too (see derive_narr_fields).
     
     Requires:
-        dt1 ------> starting time (datetime object)
-        dt2 ------> ending time (datetime object)
-        ncfile ---> pre-processed NARR netcdf filename (string)
+        dt1 ---------> starting time (datetime object)
+        dt2 ---------> ending time (datetime object)
+        ncfile ------> pre-processed NARR netcdf filename (string)
+        chunk_size --> number of time steps read from the file at once (int)
+        cache_mb ----> memory budget for the cached chunks, in MB (float)
+        bbox --------> (optional) only load the region (south lat., north 
+                       lat., west lon., east lon.) (tuple of floats)
+        stations ----> (optional) only load the region around these stations
+                       (list of IDs in STATION_LOCATIONS; e.g., ['ORD', 'MSP'])
+        margin ------> with [stations], the margin added around them, in 
+                       degrees (float)
+        derived -----> also load the derived fields (True/False, or the list
+                       of variables to pass to derive_narr_fields)
         
     Returns:
-        datadict -> a dictionary of numpy arrays containing the data in the
-                    desired time range. The dictionary has the following keys:
+        narr -----> a NarrDataset, which indexes like a dictionary of numpy
+                    arrays containing the data in the desired time range. It
+                    has the following keys:
                     ('dates', 'lats', 'lons', 't2m', 'mslp', 'u10m', 'v10m',
-                     'olr')
+                     'olr'), plus those of the derived fields
     """
     from netCDF4 import Dataset, num2date
     
-    # Get the directory that this module is located in
-    thisdir = os.path.dirname(os.path.realpath(__file__))
+    # Get the full path to the netCDF file
+    ncpath = os.path.join(get_datadir(), ncfile)
     
-    # Load the 2-meter temperature and mslp data from [ncfile]
-    with Dataset(os.path.join(thisdir, 'data', ncfile), 'r') as ncdata:
+    # Load the dimensions (but not the data) from [ncfile]
+    with instrument.stage('narr.open', file=ncfile), \
+         Dataset(ncpath, 'r') as ncdata:
         # Get the dates (which are floats w/ units of "hours since 1800-01-01")
         # and convert to datetime objects
         dates = ncdata.variables['time']
-        dates = num2date(dates[:], dates.units)
+        with instrument.stage('narr.dates'):
+            dates = num2date(dates[:], dates.units, 
+                             only_use_cftime_datetimes=False)
         # Get the indices corresponding to [dt1] and [dt2]
-        ti1 = nearest_ind(dates, dt1)
-        ti2 = nearest_ind(dates, dt2) + 1
+        subset = TimeIndex(dates).slice(dt1, dt2)
+        ti1, ti2 = subset.start, subset.stop
         dates = dates[ti1:ti2]
         
-        # Get the latitudes and longitudes
+        # Get the latitudes and longitudes (of the desired region)
         lats = ncdata.variables['lat'][:,:]
         lons = ncdata.variables['lon'][:,:]
+        window = None
+        if stations is not None:
+            bbox = station_bbox(stations, margin=margin)
+        if bbox is not None:
+            window = narr_window(lats, lons, bbox, ncpath=ncpath)
+            lats, lons = lats[window], lons[window]
+        
+        # Find the (time, y, x) variables: temperature [C], pressure [hPa],
+        # winds [kts], OLR [W/m^2], ...
+        variables = [name for name, var in ncdata.variables.items() if \
+                     var.ndim == 3 and var.dimensions[0] == 'time']
+        
+    narr = NarrDataset(ncpath, ti1, ti2, dates, lats, lons, variables, 
+                       chunk_size=chunk_size, cache_mb=cache_mb, window=window)
+    if derived:
+        if derived is True:
+            derived = DERIVED_VARIABLES
+        narr.add_sidecar(derive_narr_fields(narr, variables=derived))
+    return narr
+
+
+
+def station_bbox(stations, margin=2.):
+    """
+    Returns the (south lat., north lat., west lon., east lon.) box around the
+    [stations] (IDs in STATION_LOCATIONS), plus [margin] degrees on each side.
+    """
+    try:
+        lats, lons = np.array([STATION_LOCATIONS[stid] for stid in stations]).T
+    except KeyError as err:
+        raise ValueError('ERROR: unknown location of station "{}"!'.format(
+                         err.args[0]))
+    return (float(lats.min() - margin), float(lats.max() + margin), 
+            float(lons.min() - margin), float(lons.max() + margin))
+
+
+
+def narr_window(lats, lons, bbox, ncpath=None, pad=1):
+    """
+    Finds the smallest (y, x) window of a curvilinear lat/lon grid that holds
+    every grid point in [bbox], plus [pad] grid points on each side (so that
+    contours and interpolation reach the edges of the box). With [ncpath], 
+    the window is cached for that file and box.
+    
+    Requires:
+        lats, lons --> 2-D (y, x) arrays of the grid's latitudes/longitudes
+        bbox --------> the (south lat., north lat., west lon., east lon.) box
+                       (tuple of floats)
         
-        # Load the temperatures, pressures, winds, and precipitation
-        t2m = ncdata.variables['t2m'][ti1:ti2, :, :] # in Celsius
-        mslp = ncdata.variables['mslp'][ti1:ti2, :, :] # in hPa
-        uwnd = ncdata.variables['u10m'][ti1:ti2, :, :] # in kts
-        vwnd = ncdata.variables['v10m'][ti1:ti2, :, :] # in kts
-        olr = ncdata.variables['olr'][ti1:ti2, :, :] # in W/m^2
+    Returns:
+        window ------> a (y slice, x slice) tuple, to index (y, x) arrays
+    """
+    if ncpath is not None:
+        key = (ncpath, file_key(ncpath), tuple(float(b) for b in bbox))
+        if key in _window_cache:
+            instrument.count('narr.window_hits')
+            return _window_cache[key]
+    
+    south, north, west, east = bbox
+    lats, lons = np.ma.getdata(lats), np.ma.getdata(lons)
+    # (longitudes are compared east of [west], so boxes can cross the 
+    # date line; a box that is 360 degrees wide holds every longitude)
+    width = 360. if east - west >= 360. else (east - west) % 360.
+    inside = (lats >= south) & (lats <= north) & \
+             ((lons - west) % 360. <= width)
+    if not np.any(inside):
+        raise ValueError('ERROR: no grid points in the box {}!'.format(bbox))
+    ny, nx = lats.shape
+    jj = np.flatnonzero(np.any(inside, axis=1))
+    ii = np.flatnonzero(np.any(inside, axis=0))
+    window = (slice(max(int(jj[0]) - pad, 0), min(int(jj[-1]) + pad + 1, ny)),
+              slice(max(int(ii[0]) - pad, 0), min(int(ii[-1]) + pad + 1, nx)))
+    if ncpath is not None:
+        _window_cache[key] = window
+    return window
+
+
+
+class NarrDataset(object):
+    """
+    Lazily-loaded NARR data over a range of time steps (see load_narr_data).
+    Indexing with 'dates', 'lats' or 'lons' returns those arrays; indexing
+    with a variable name returns a NarrVariable, which reads from the netCDF
+    file only when it is itself indexed (e.g., narr['t2m'][d,:,:]). The
+    variables of a derived-field sidecar (see add_sidecar) are indexed the 
+    same way, and its time statistics (e.g., 't2m_mean') are arrays.
+    """
+    def __init__(self, ncpath, ti1, ti2, dates, lats, lons, variables,
+                 chunk_size=8, cache_mb=256., window=None):
+        self.ncpath = ncpath
+        # the (y, x) slices of the grid to read (default: all of it)
+        self.window = (slice(None), slice(None)) if window is None else window
+        self.ti1 = ti1
+        self.ti2 = ti2
+        self.chunk_size = max(int(chunk_size), 1)
+        self.cache_bytes = cache_mb * 1e6
+        self.coords = {'dates':dates, 'lats':lats, 'lons':lons}
+        self.variables = {name:NarrVariable(self, name) for name in variables}
+        # The arrays without a time dimension (see add_sidecar)
+        self.fields = {}
+        # The (file, first time index, (y, x) window) of the variables that are
+        # not in [ncpath]
+        self.sources = {}
+        # Least-recently-used cache of chunks: {(name, chunk #): array}
+        self._chunks = OrderedDict()
+        self._nbytes = 0
         
-    # Store all of the dimensions and data in a dictionary
-    datadict = {'dates':dates, 'lats':lats, 'lons':lons, 't2m':t2m, 
-                'mslp':mslp, 'u10m':uwnd, 'v10m':vwnd, 'olr':olr}
+    def __getitem__(self, key):
+        if key in self.coords:
+            return self.coords[key]
+        if key in self.variables:
+            return self.variables[key]
+        if key in self.fields:
+            return self.fields[key]
+        raise KeyError(key)
+    
+    def __contains__(self, key):
+        return key in self.coords or key in self.variables or key in self.fields
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def keys(self):
+        return list(self.coords.keys()) + list(self.variables.keys()) + \
+               list(self.fields.keys())
+    
+    @property
+    def ntimes(self):
+        return self.ti2 - self.ti1
+    
+    def read_chunk(self, name, c):
+        """
+        Returns chunk number [c] (a 3-D masked array of [chunk_size] time 
+        steps) of variable [name], from the cache or from the netCDF file.
+        """
+        key = (name, c)
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+            instrument.count('narr.chunk_hits')
+            return self._chunks[key]
+        
+        from netCDF4 import Dataset
+        ncpath, t0, window = self.sources.get(name, (self.ncpath, self.ti1, 
+                                                     self.window))
+        t1 = t0 + c * self.chunk_size
+        t2 = min(t1 + self.chunk_size, t0 + self.ntimes)
+        with instrument.stage('narr.read', var=name, chunk=c), \
+             Dataset(ncpath, 'r') as ncdata:
+            chunk = ncdata.variables[name][(slice(t1, t2),) + window]
+        instrument.count('narr.chunk_reads')
+        instrument.count('narr.bytes_read', _nbytes(chunk))
+        
+        # Store the chunk, evicting the least-recently-used chunks if we are
+        # over the memory budget (but always keeping the newest one)
+        self._chunks[key] = chunk
+        self._nbytes += _nbytes(chunk)
+        while self._nbytes > self.cache_bytes and len(self._chunks) > 1:
+            _, old = self._chunks.popitem(last=False)
+            self._nbytes -= _nbytes(old)
+        return chunk
+    
+    def clear_cache(self):
+        """
+        Empties the chunk cache.
+        """
+        self._chunks.clear()
+        self._nbytes = 0
+        
+    def add_sidecar(self, ncpath):
+        """
+        Adds the variables in the netCDF file [ncpath], which covers the same
+        time steps and (y, x) window as this dataset (e.g., the derived-field
+        sidecar from derive_narr_fields). Its (time, y, x) variables are read
+        lazily, like those of the NARR file; the others are read right away.
+        """
+        from netCDF4 import Dataset
+        with Dataset(ncpath, 'r') as ncdata:
+            for name, var in ncdata.variables.items():
+                if var.dimensions[0] == 'time':
+                    if var.shape[0] != self.ntimes:
+                        raise ValueError('ERROR: {} does not match the time '
+                                         'range!'.format(ncpath))
+                    self.variables[name] = NarrVariable(self, name)
+                    self.sources[name] = (ncpath, 0, ())
+                else:
+                    self.fields[name] = var[:]
+        
+        
+        
+class NarrVariable(object):
+    """
+    One lazily-loaded (time, y, x) variable of a NarrDataset. Supports numpy-
+    style indexing, where the first index selects time steps (an integer, a
+    slice, or an array of integers/booleans).
+    """
+    def __init__(self, dataset, name):
+        self.dataset = dataset
+        self.name = name
+        
+    @property
+    def shape(self):
+        return (self.dataset.ntimes,) + self.dataset.coords['lats'].shape
+    
+    @property
+    def ndim(self):
+        return 3
+    
+    def __len__(self):
+        return self.dataset.ntimes
+    
+    def iter_chunks(self):
+        """
+        Yields a (time slice, 3-D masked array) pair for each chunk of this 
+        variable, in order (e.g., to process every time step with bounded
+        memory).
+        """
+        cs = self.dataset.chunk_size
+        for c in range(-(-len(self) // cs)):
+            tslice = slice(c * cs, min((c + 1) * cs, len(self)))
+            yield tslice, self.dataset.read_chunk(self.name, c)
+    
+    def __array__(self, dtype=None, copy=None):
+        data = np.ma.getdata(self[:])
+        return data if dtype is None else data.astype(dtype)
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        tkey, rest = key[0], (slice(None),) + key[1:]
+        cs = self.dataset.chunk_size
+        nt = len(self)
+        
+        # A single time step only needs a single chunk
+        if isinstance(tkey, (int, np.integer)):
+            if tkey < -nt or tkey >= nt:
+                raise IndexError('time index {} out of range'.format(tkey))
+            tkey = tkey % nt
+            chunk = self.dataset.read_chunk(self.name, tkey // cs)
+            return chunk[tkey % cs][key[1:]]
+        
+        # Otherwise gather the time steps from each chunk that is touched
+        tinds = np.arange(nt)[tkey]
+        if len(tinds) == 0:
+            return np.ma.empty((0,) + self.shape[1:])[rest]
+        chunknums = tinds // cs
+        breaks = np.flatnonzero(np.diff(chunknums)) + 1
+        parts = []
+        for run in np.split(np.arange(len(tinds)), breaks):
+            chunk = self.dataset.read_chunk(self.name, chunknums[run[0]])
+            parts.append(chunk[tinds[run] % cs][rest])
+        return np.ma.concatenate(parts) if len(parts) > 1 else parts[0]
+
+
+
+def extract_stations(narr, stations, variables=('t2m', 'mslp', 'u10m', 'v10m'),
+                     locations=None):
+    """
+    Samples NARR fields at station locations over every time step, using 
+    bilinear interpolation on the (curvilinear) NARR grid. The interpolation
+    weights of a set of stations are computed once and cached, and then each
+    chunk of time steps is interpolated with one vectorized gather.
+    
+    Requires:
+        narr --------> a NarrDataset (see load_narr_data), or a dictionary 
+                       with 'dates', 'lats', 'lons' and 3-D (time, y, x) 
+                       variable arrays
+        stations ----> station IDs (list of strings; e.g., ['ORD', 'MSP'])
+        variables ---> the variables to sample (list of strings)
+        locations ---> (optional) {station ID: (lat, lon)} for stations that
+                       are not in STATION_LOCATIONS
+        
+    Returns:
+        datadict ----> a dictionary with the keys 'dates', 'stations' and 
+                       each of [variables]: a 2-D (time, station) float array
+                       of the interpolated values (NaN where any of the 
+                       surrounding grid points is missing)
+    """
+    points = []
+    for stid in stations:
+        if locations is not None and stid in locations:
+            points.append(tuple(locations[stid]))
+        elif stid in STATION_LOCATIONS:
+            points.append(STATION_LOCATIONS[stid])
+        else:
+            raise ValueError('ERROR: unknown location of station "{}"!'.format(
+                             stid))
+    
+    # Get the (cached) interpolation weights of these stations
+    lats, lons = narr['lats'], narr['lons']
+    gridkey = data_hash([lats, lons])
+    if gridkey not in _locator_cache:
+        _locator_cache[gridkey] = GridLocator(lats, lons)
+    inds, weights = _locator_cache[gridkey].weights(points, names=stations)
+    
+    datadict = {'dates':narr['dates'], 'stations':list(stations)}
+    for var in variables:
+        field = narr[var]
+        if hasattr(field, 'iter_chunks'):
+            chunks = field.iter_chunks()
+        else:
+            chunks = [(slice(None), field)]
+        series = np.empty((len(field), len(stations)))
+        for tslice, chunk in chunks:
+            with instrument.stage('stations.gather', var=var):
+                # (time, station, corner) values of the surrounding points
+                flat = np.ma.getdata(chunk).reshape(len(chunk), -1)
+                corners = flat[:, inds]
+                values = np.einsum('tsk,sk->ts', corners, weights)
+                mask = np.ma.getmask(chunk)
+                if mask is not np.ma.nomask:
+                    missing = mask.reshape(len(chunk), -1)[:, inds].any(-1)
+                    values[missing] = np.nan
+            series[tslice] = values
+        datadict[var] = series
     return datadict
 
 
 
-def get_meteorogram(stid, dt1, dt2):
+def derive_narr_fields(narr, variables=DERIVED_VARIABLES):
+    """
+    Computes fields derived from the NARR data in [narr] and saves them to a
+    netCDF sidecar file (in the cache directory), which NarrDataset.add_
+    sidecar() reads as if they were NARR variables. The sidecar is only 
+    computed once for each NARR file, time range, grid window and list of
+    [variables].
+    
+    The fields are computed in one pass over the chunks of each variable, 
+    with running (Welford-style) statistics, so memory use does not grow
+    with the length of the time range; only the anomalies take a second pass.
+    
+    Requires:
+        narr --------> a NarrDataset (see load_narr_data)
+        variables ---> the variables to compute statistics and anomalies of
+                       (list of strings; 'wspd10m' is the 10-m wind speed, 
+                       from 'u10m' and 'v10m')
+        
+    Returns:
+        ncpath ------> full path to the sidecar file, which has the variables
+                       (time, y, x):  'wspd10m' [kts] (if it is one of 
+                                      [variables]), and '[var]_anom': the 
+                                      anomaly from the mean diurnal cycle
+                       (y, x):        '[var]_mean', '[var]_std' (population
+                                      standard deviation), '[var]_min' and 
+                                      '[var]_max', over the time range
+                       (hour, y, x):  '[var]_diurnal': the mean at each hour
+                                      of the day in 'hours'
+    """
+    from netCDF4 import Dataset
+    can_wspd = 'u10m' in narr.variables and 'v10m' in narr.variables
+    for var in variables:
+        if var not in narr.variables and not (var == 'wspd10m' and can_wspd):
+            raise ValueError('ERROR: no variable "{}" to derive from!'.format(
+                             var))
+    
+    # Look for an up-to-date sidecar of this file, range, window & variables
+    name = os.path.basename(narr.ncpath)
+    params = data_hash([_DERIVED_VERSION, narr.ti1, narr.ti2, 
+                        repr(narr.window), list(variables)])[:12]
+    prefix = '{}.derived.{}.'.format(name, params)
+    sidecar = os.path.join(get_cachedir(), prefix + '{}-{}.nc'.format(
+                           *file_key(narr.ncpath)))
+    if os.path.isfile(sidecar):
+        instrument.count('narr.derived_hits')
+        return sidecar
+    
+    with Dataset(narr.ncpath, 'r') as ncdata:
+        srcunits = {var:getattr(ncdata.variables[var], 'units', '') for var in \
+                    variables if var in ncdata.variables}
+    dates = narr['dates']
+    ny, nx = narr['lats'].shape
+    hours = sorted(set(d.hour for d in dates))
+    hourinds = np.searchsorted(hours, [d.hour for d in dates])
+    
+    def chunks(var):
+        # (time slice, chunk) pairs of a NARR or derived variable
+        if var != 'wspd10m' or var in narr.variables:
+            return narr[var].iter_chunks()
+        return ((tslice, np.ma.sqrt(u**2 + v**2)) for (tslice, u), (_, v) in \
+                zip(narr['u10m'].iter_chunks(), narr['v10m'].iter_chunks()))
+    
+    tmpfile = '{}.{}.tmp'.format(sidecar, os.getpid())
+    try:
+        with Dataset(tmpfile, 'w') as ncdata:
+            ncdata.createDimension('time', len(dates))
+            ncdata.createDimension('hour', len(hours))
+            ncdata.createDimension('y', ny)
+            ncdata.createDimension('x', nx)
+            ncdata.createVariable('hours', 'i4', ('hour',))[:] = hours
+            ncdata.source = narr.ncpath
+            chunkshape = (min(narr.chunk_size, len(dates)), ny, nx)
+            def create(var, dims, units, long_name):
+                kwargs = {'chunksizes':chunkshape} if dims[0] == 'time' else {}
+                ncvar = ncdata.createVariable(var, 'f4', dims, fill_value=1e20,
+                                              **kwargs)
+                ncvar.units = units
+                ncvar.long_name = long_name
+                return ncvar
+            
+            # The wind speed is written as it is computed
+            if 'wspd10m' in variables and 'wspd10m' not in narr.variables:
+                wspd = create('wspd10m', ('time', 'y', 'x'), 'kts', 
+                              '10-m wind speed')
+            else:
+                wspd = None
+                
+            for var in variables:
+                # Pass 1: the statistics over the range and at each hour
+                total = _RunningStats((ny, nx))
+                diurnal = [_RunningStats((ny, nx)) for hour in hours]
+                with instrument.stage('narr.derive', var=var, step='stats'):
+                    for tslice, chunk in chunks(var):
+                        if var == 'wspd10m' and wspd is not None:
+                            wspd[tslice] = chunk
+                        total.update(chunk)
+                        h = hourinds[tslice]
+                        for k in np.unique(h):
+                            diurnal[k].update(chunk[h == k])
+                if var == 'wspd10m':
+                    wspd = None
+                units = 'kts' if var == 'wspd10m' else srcunits[var]
+                for stat in ('mean', 'std', 'min', 'max'):
+                    create('{}_{}'.format(var, stat), ('y', 'x'), units, 
+                           '{} of {}'.format(stat, var))[:] = total.result(stat)
+                cycle = np.ma.stack([d.result('mean') for d in diurnal])
+                create(var + '_diurnal', ('hour', 'y', 'x'), units, 
+                       'mean diurnal cycle of {}'.format(var))[:] = cycle
+                
+                # Pass 2: the anomalies from the diurnal cycle
+                anom = create(var + '_anom', ('time', 'y', 'x'), units,
+                              'anomaly of {} from its mean diurnal '
+                              'cycle'.format(var))
+                with instrument.stage('narr.derive', var=var, step='anom'):
+                    for tslice, chunk in chunks(var):
+                        anom[tslice] = chunk - cycle[hourinds[tslice]]
+        os.replace(tmpfile, sidecar)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    _remove_stale(sidecar, prefix)
+    return sidecar
+
+
+
+class _RunningStats(object):
+    """
+    Running count, mean, variance (Welford's algorithm, updated with a whole
+    chunk of time steps at once via Chan et al.'s pairwise formula), minimum
+    and maximum at each point of a grid, skipping masked values.
+    """
+    def __init__(self, shape):
+        self.n = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        
+    def update(self, chunk):
+        """
+        Adds the values of a (time, y, x) [chunk] (masked array).
+        """
+        data = np.ma.getdata(chunk).astype(np.float64)
+        valid = ~np.ma.getmaskarray(chunk)
+        nb = valid.sum(axis=0)
+        meanb = np.where(valid, data, 0.).sum(axis=0) / np.maximum(nb, 1)
+        m2b = (np.where(valid, data - meanb, 0.)**2).sum(axis=0)
+        n = self.n + nb
+        delta = meanb - self.mean
+        frac = nb / np.maximum(n, 1)
+        self.mean += delta * frac
+        self.m2 += m2b + delta**2 * self.n * frac
+        self.n = n
+        self.min = np.fmin(self.min, np.where(valid, data, np.inf).min(axis=0))
+        self.max = np.fmax(self.max, np.where(valid, data, -np.inf).max(axis=0))
+        
+    def result(self, stat):
+        """
+        Returns the statistic [stat] ('mean', 'std', 'min' or 'max'), masked 
+        where there were no values.
+        """
+        if stat == 'std':
+            values = np.sqrt(self.m2 / np.maximum(self.n, 1))
+        else:
+            values = getattr(self, stat)
+        return np.ma.masked_where(self.n == 0, values)
+
+
+
+class GridLocator(object):
+    """
+    A spatial index (KD-tree) of a curvilinear lat/lon grid, used to find the
+    bilinear interpolation weights of points on the grid. The tree is built 
+    from the grid points' 3-D unit vectors, so distances are correct over 
+    the whole globe (and across the date line).
+    
+    Requires:
+        lats, lons --> 2-D (y, x) arrays of the grid's latitudes/longitudes
+    """
+    def __init__(self, lats, lons):
+        from scipy.spatial import cKDTree
+        
+        self.shape = np.shape(lats)
+        self._xyz = _unit_vectors(np.ma.getdata(lats), np.ma.getdata(lons))
+        with instrument.stage('stations.kdtree'):
+            self.tree = cKDTree(self._xyz.reshape(-1, 3))
+        self._weights = {}  # {station points: (indices, weights)}
+        
+    def weights(self, points, names=None):
+        """
+        Returns the bilinear interpolation weights of [points] (a list of 
+        (lat, lon) tuples; [names] are only used in error messages).
+        
+        Returns:
+            inds ------> a 2-D (point, corner) array of the flat grid indices
+                         of the 4 grid points around each point
+            weights ---> a 2-D (point, corner) array of their weights
+        """
+        key = tuple(points)
+        if key in self._weights:
+            instrument.count('stations.weight_hits')
+            return self._weights[key]
+        
+        ny, nx = self.shape
+        lats, lons = np.array(points, dtype=float).reshape(-1, 2).T
+        # Find the nearest grid point to each point
+        _, nearest = self.tree.query(_unit_vectors(lats, lons))
+        j0, i0 = np.divmod(np.atleast_1d(nearest), nx)
+        
+        # Find which of the 4 grid cells around the nearest grid point holds
+        # each point, and the point's fractional (s, t) position within it
+        east, north = _tangent_axes(lats, lons)
+        found = np.zeros(len(lats), dtype=bool)
+        cells = np.zeros((len(lats), 2), dtype=int)
+        st = np.zeros((len(lats), 2))
+        for dj, di in ((0, 0), (0, -1), (-1, 0), (-1, -1)):
+            j = np.clip(j0 + dj, 0, ny - 2)
+            i = np.clip(i0 + di, 0, nx - 2)
+            # the corners, in the plane tangent to the globe at each point
+            corners = self._xyz[np.stack([j, j, j+1, j+1], axis=1),
+                                np.stack([i, i+1, i, i+1], axis=1)]
+            px = np.einsum('pkc,pc->pk', corners, east)
+            py = np.einsum('pkc,pc->pk', corners, north)
+            s, t = _invert_bilinear(px, py)
+            inside = ~found & (s >= -1e-6) & (s <= 1+1e-6) & \
+                     (t >= -1e-6) & (t <= 1+1e-6)
+            cells[inside] = np.stack([j, i], axis=1)[inside]
+            st[inside] = np.stack([s, t], axis=1)[inside]
+            found |= inside
+        if not np.all(found):
+            bad = np.flatnonzero(~found)[0]
+            name = points[bad] if names is None else names[bad]
+            raise ValueError('ERROR: station "{}" is outside the '
+                             'grid!'.format(name))
+        
+        j, i = cells.T
+        s, t = np.clip(st, 0., 1.).T
+        inds = np.stack([j*nx + i, j*nx + i+1, (j+1)*nx + i, (j+1)*nx + i+1], 
+                        axis=1)
+        weights = np.stack([(1-s)*(1-t), s*(1-t), (1-s)*t, s*t], axis=1)
+        self._weights[key] = (inds, weights)
+        return inds, weights
+
+
+
+def _unit_vectors(lats, lons):
+    """
+    Returns the 3-D unit vectors (in an extra last axis) of lat/lon points.
+    """
+    lat, lon = np.radians(lats), np.radians(lons)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), 
+                     np.sin(lat)], axis=-1)
+
+
+
+def _tangent_axes(lats, lons):
+    """
+    Returns the 3-D unit vectors pointing east and north at lat/lon points.
+    """
+    lat, lon = np.radians(lats), np.radians(lons)
+    east = np.stack([-np.sin(lon), np.cos(lon), np.zeros_like(lon)], axis=-1)
+    north = np.stack([-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon),
+                      np.cos(lat)], axis=-1)
+    return east, north
+
+
+
+def _invert_bilinear(px, py, iterations=8):
+    """
+    Finds the fractional position (s, t) of the origin in each quadrilateral 
+    cell with (x, y) corners [px], [py] (2-D (cell, corner) arrays, with the 
+    corners in the order (0,0), (1,0), (0,1), (1,1) of (s, t)), by Newton's 
+    method on the bilinear mapping.
+    """
+    s = np.full(len(px), 0.5)
+    t = np.full(len(px), 0.5)
+    a, b = px.T, py.T
+    for n in range(iterations):
+        # residual of the bilinear mapping, and its Jacobian
+        rx = (1-s)*(1-t)*a[0] + s*(1-t)*a[1] + (1-s)*t*a[2] + s*t*a[3]
+        ry = (1-s)*(1-t)*b[0] + s*(1-t)*b[1] + (1-s)*t*b[2] + s*t*b[3]
+        xs = (1-t)*(a[1]-a[0]) + t*(a[3]-a[2])
+        xt = (1-s)*(a[2]-a[0]) + s*(a[3]-a[1])
+        ys = (1-t)*(b[1]-b[0]) + t*(b[3]-b[2])
+        yt = (1-s)*(b[2]-b[0]) + s*(b[3]-b[1])
+        det = xs*yt - xt*ys
+        det = np.where(det == 0., np.finfo(float).tiny, det)
+        s = s - (yt*rx - xt*ry) / det
+        t = t - (xs*ry - ys*rx) / det
+    return s, t
+
+
+
+def get_meteorogram(stid, dt1, dt2, csvfile=None, compact=False):
     """
     Retrieves ASOS surface station data at the desired station and time range.
     
     Requires:
-        stid --> the ASOS station ID (string; e.g., "ORD")
-        dt1 ---> starting date/time (datetime object)
-        dt2 ---> ending date/time (datetime object)
+        stid ----> the ASOS station ID (string; e.g., "ORD")
+        dt1 -----> starting date/time (datetime object)
+        dt2 -----> ending date/time (datetime object)
+        csvfile -> (optional) full path to an Iowa State ASOS export that 
+                   holds the station's data, e.g. a multi-station archive
+                   (default: data/asos_[stid].txt)
+        compact -> if True, return an ObsTable (float32 columns that are 
+                   views of the loaded data; missing values, including 
+                   missing precipitation, are NaN) instead of a dictionary
         
     Returns:
         datadict -> a dictionary of 1D numpy arrays containing the data in the
                     desired time range. The dictionary has the following keys:
-                    ('dates', )
+                    ('dates', 't', 'td', 'wdir', 'wspd', 'pres', 'prec')
     """
-    # Get the directory that this module is located in
-    thisdir = os.path.dirname(os.path.realpath(__file__))
-    # Get the full path to the sounding data
-    asosfile = os.path.join(thisdir, 'data', 'asos_{}.txt'.format(stid))
+    # Load the parsed columns of the ASOS file (cached after the first call),
+    # or, for a very large file whose sidecar can't be written, stream in 
+    # just the rows around [dt1, dt2]
+    asos = _load_asos(stid, csvfile, whole=False)
+    if asos is None:
+        asosfile, stations = station_file('asos', stid, csvfile)
+        with instrument.stage('asos.stream', stid=stid):
+            asos = _read_csv_window(asosfile, 'asos', stations, dt1, dt2)
+            asos['index'] = TimeIndex(asos['dates'], unit='m')
     
-    # Load the data from the sounding file
-    try:
-        data = np.genfromtxt(asosfile, dtype=str, delimiter=',', 
-                             skip_header=1)
-    except:
-        raise ValueError('ERROR: station "{}" does not exist!'.format(stid))
-        
-    # Convert the date strings to datetime objects
-    dates = np.array([datetime.strptime(dstr, '%Y-%m-%d %H:%M') for \
-                      dstr in data[:,1]])
     # Get the indices for the dates within the desired date range
-    t1 = nearest_ind(dates, dt1)
-    t2 = nearest_ind(dates, dt2) + 1
-    # Now select that subset of the dates (and all other variables)
-    dates = dates[t1:t2]
-    
-    # Now get the other variables
-    t = data[t1:t2, 2].astype(float)  # temperature in Celsius
-    td = data[t1:t2, 3].astype(float)  # dewpoint in Celsius
-    wdir = data[t1:t2, 4].astype(float) # wind direction in degrees
-    wspd = data[t1:t2, 5].astype(float) # wind speed in knots
-    # pressure in hPa:
-    pres = np.array([float(x) if x!='M' else np.nan for x in data[t1:t2, 6]])
-    # 1-hour precipitation in mm
-    # pressure in hPa:
-    prec = np.array([float(x) if x!='M' else 0. for x in data[t1:t2, 7]])
+    subset = asos['index'].slice(dt1, dt2)
+    t1, t2 = subset.start, subset.stop
+    if compact:
+        if 'block' in asos:
+            block = asos['block'][:, t1:t2]
+        else:
+            block = np.stack([asos[var][t1:t2] for var in _ASOS_COLUMNS])
+        return ObsTable(asos['dates'][t1:t2], block, _ASOS_COLUMNS, 
+                        stations=[stid])
+    # Now select that subset of the dates (as datetime objects)
+    dates = asos['dates'][t1:t2].astype(datetime)
+    
+    # Now get the other variables (missing values are already NaNs)
+    t = asos['t'][t1:t2].astype(float)  # temperature in Celsius
+    td = asos['td'][t1:t2].astype(float)  # dewpoint in Celsius
+    wdir = asos['wdir'][t1:t2].astype(float) # wind direction in degrees
+    wspd = asos['wspd'][t1:t2].astype(float) # wind speed in knots
+    pres = asos['pres'][t1:t2].astype(float) # pressure in hPa
+    # 1-hour precipitation in mm (missing = no precipitation)
+    prec = np.nan_to_num(asos['prec'][t1:t2].astype(float), nan=0.)
 
     # Return the data in a dictionary
     datadict = {'dates':dates, 't':t, 'td':td, 'wdir':wdir, 'wspd':wspd, 
@@ -146,69 +834,1042 @@ def get_meteorogram(stid, dt1, dt2):
 
 
 
-def get_sounding(stid, date):
+def load_asos(stid, csvfile=None):
+    """
+    Loads and decodes every observation in the ASOS file for station [stid].
+    The file is only parsed once: the decoded columns are kept in memory and
+    in a memory-mappable sidecar file (in the cache directory) that is keyed
+    by the modification time and size of the original text file.
+    
+    Requires:
+        stid ----> the ASOS station ID (string; e.g., "ORD")
+        csvfile -> (optional) full path to an Iowa State ASOS export that 
+                   holds the station's data (default: data/asos_[stid].txt)
+        
+    Returns:
+        asos ---> a dictionary of 1D numpy arrays for the whole file, with
+                  the keys ('dates', 't', 'td', 'wdir', 'wspd', 'pres', 'prec').
+                  'dates' is datetime64[m] (sorted); all other arrays are
+                  float32 with NaNs where the observation is missing ('M').
+                  'index' holds a TimeIndex of the dates, and 'block' the 2D
+                  (variable, time) array that the variables are rows of.
+    """
+    return _load_asos(stid, csvfile)
+
+
+
+def _load_asos(stid, csvfile=None, whole=True):
+    """
+    Does the work of load_asos(). A file larger than STREAM_MIN_MB is parsed
+    block by block straight into its sidecar, with bounded memory. If that
+    sidecar can't be written, the whole file is parsed in memory, or (if not
+    [whole]) None is returned so that the caller can stream just the rows 
+    it needs.
+    """
+    # Get the full path to the ASOS data
+    asosfile, stations = station_file('asos', stid, csvfile)
+    try:
+        key = file_key(asosfile)
+    except OSError:
+        raise ValueError('ERROR: station "{}" does not exist!'.format(stid))
+    
+    # Already decoded (and unchanged) in this session?
+    cached = _asos_cache.get((asosfile, stid))
+    if cached is not None and cached[0] == key:
+        instrument.count('asos.cache_hits')
+        return cached[1]
+    
+    # Otherwise look for an up-to-date sidecar file, or parse the text file
+    if csvfile is None:
+        prefix = 'asos_{}.'.format(stid)
+    else:
+        prefix = '{}.{}.'.format(os.path.basename(csvfile), stid)
+    stem = os.path.join(get_cachedir(), prefix + '{}-{}'.format(*key))
+    try:
+        dates = np.load(stem + '.dates.npy', mmap_mode='r')
+        block = np.load(stem + '.vars.npy', mmap_mode='r')
+        instrument.count('asos.sidecar_hits')
+    except (OSError, ValueError):
+        dates = None
+        if _is_large(asosfile):
+            with instrument.stage('asos.parse', stid=stid, streamed=True):
+                _write_asos_sidecar(asosfile, stations, stem, prefix)
+            try:
+                dates = np.load(stem + '.dates.npy', mmap_mode='r')
+                block = np.load(stem + '.vars.npy', mmap_mode='r')
+            except (OSError, ValueError):
+                if not whole:
+                    return None
+        if dates is None:
+            with instrument.stage('asos.parse', stid=stid):
+                dates, block = _parse_asos(asosfile, stations)
+            write_sidecar(stem, prefix, 
+                          [('.vars.npy', block), ('.dates.npy', dates)])
+        
+    asos = {'dates':dates, 'index':TimeIndex(dates, unit='m'), 'block':block}
+    for k, var in enumerate(_ASOS_COLUMNS):
+        asos[var] = block[k]
+    _asos_cache[(asosfile, stid)] = (key, asos)
+    return asos
+
+
+
+def _parse_asos(asosfile, stations=None):
+    """
+    Parses an ASOS text file (only the rows of [stations], if given) into an
+    array of datetime64 observation times and a 2D (variable, time) float32
+    array holding the columns in _ASOS_COLUMNS.
+    """
+    columns = _read_csv(asosfile, 'asos', stations)
+    # Sort the observations by time (they normally already are)
+    order = np.argsort(columns['dates'], kind='stable')
+    block = np.empty((len(_ASOS_COLUMNS), len(order)), dtype=np.float32)
+    for k, var in enumerate(_ASOS_COLUMNS):
+        block[k] = columns[var][order]
+    return columns['dates'][order], block
+
+
+
+def _write_asos_sidecar(asosfile, stations, stem, prefix):
+    """
+    Parses an ASOS text file (only the rows of [stations], if given) block by
+    block into its sidecar files (see load_asos) at [stem], without holding
+    the whole file in memory. Errors are ignored (see write_sidecar).
+    """
+    try:
+        with _spooled_csv(asosfile, 'asos', stations, stem) as columns:
+            dates = columns['dates']
+            # (the observations normally are already sorted by time)
+            order = None
+            if np.any(dates[1:] < dates[:-1]):
+                order = np.argsort(dates, kind='stable')
+            def sort(column):
+                return column if order is None else column[order]
+            write_sidecar(stem, prefix, 
+                          [('.vars.npy', [sort(columns[var]) for var in 
+                                          _ASOS_COLUMNS]),
+                           ('.dates.npy', sort(dates))])
+    except OSError:
+        pass
+
+
+
+def _decode_floats(strs):
+    """
+    Converts an array of number strings to float32, turning the 'M' (missing)
+    flag into NaN.
+    """
+    strs = np.char.strip(strs)
+    return np.where(strs=='M', 'nan', strs).astype(np.float32)
+
+
+
+def get_sounding(stid, date, csvfile=None, compact=False):
     """
     Retrieves sounding data (temperature and dewpoint) at the desired 
     station and time.
     
     Requires:
-        stid --> the radiosonde station ID (string; e.g., "KILX")
-        date --> the desired sounding date/time (datetime object)
+        stid ----> the radiosonde station ID (string; e.g., "KILX")
+        date ----> the desired sounding date/time (datetime object)
+        csvfile -> (optional) full path to an Iowa State RAOB export that 
+                   holds the station's data, e.g. a multi-station archive
+                   (default: data/soundings_[stid].txt)
+        compact -> if True, return an ObsTable (float32 columns, with the 
+                   launch time in table['date']) instead of a dictionary
         
     Returns:
         datadict -> a dictionary of 1D numpy arrays containing the data in the
                     desired time range. The dictionary has the following keys:
                     ('date', 'p', 'z', 't', 'td')
     """
-    # Get the directory that this module is located in
-    thisdir = os.path.dirname(os.path.realpath(__file__))
-    # Get the full path to the sounding data
-    soundingfile = os.path.join(thisdir, 'data', 'soundings_{}.txt'.format(stid))
+    # Load the indexed soundings for this station (cached after the first call)
+    store = _sounding_store_for(stid, date, date, csvfile)
+    # Find the launch that is *closest* to the given date [date]
+    i = store['index'].nearest(date)
+    return _sounding_profile(store, i, stid=stid if compact else None)
+
+
+
+def get_soundings(stid, dates, csvfile=None, compact=False):
+    """
+    Retrieves sounding data (temperature and dewpoint) at the desired station
+    for many times at once, without re-reading the sounding file.
     
-    # Load the data from the sounding file
+    Requires:
+        stid ----> the radiosonde station ID (string; e.g., "KILX")
+        dates ---> a list of the desired sounding date/times (datetime objects)
+        csvfile -> (optional) full path to an Iowa State RAOB export that 
+                   holds the station's data (see get_sounding)
+        compact -> if True, return ObsTables (see get_sounding)
+        
+    Returns:
+        soundings -> a list with one dictionary (as returned by get_sounding)
+                     per date in [dates]
+    """
+    store = _sounding_store_for(stid, min(dates), max(dates), csvfile)
+    inds = store['index'].nearest_many(dates)
+    return [_sounding_profile(store, int(i), stid=stid if compact else None) 
+            for i in inds]
+
+
+
+def load_soundings(stid, csvfile=None):
+    """
+    Loads every sounding in the RAOB file for station [stid] into a store that
+    is indexed by launch time. The levels of each launch are stored as one 
+    contiguous range of the data arrays, already sorted by height. Like 
+    load_asos, the store is kept in memory and in memory-mappable sidecar 
+    files keyed by the version of the text file, and is only rebuilt if the
+    file changes.
+    
+    Requires:
+        stid ----> the radiosonde station ID (string; e.g., "KILX")
+        csvfile -> (optional) full path to an Iowa State RAOB export that 
+                   holds the station's data (see get_sounding)
+        
+    Returns:
+        store --> a dictionary with the keys:
+                  'launches' : sorted launch times (datetime64[s])
+                  'index'    : a TimeIndex of the launch times
+                  'offsets'  : index of the first level of each launch
+                  'lengths'  : number of levels in each launch
+                  'p', 'z', 't', 'td' : float32 arrays of all levels (NaN 
+                                        where missing)
+    """
+    return _load_soundings(stid, csvfile)
+
+
+
+def _load_soundings(stid, csvfile=None, whole=True):
+    """
+    Does the work of load_soundings(). A file larger than STREAM_MIN_MB is 
+    parsed block by block (see _spooled_csv) into its sidecar. If that 
+    sidecar can't be written, the whole file is parsed in memory, or (if not
+    [whole]) None is returned so that the caller can stream just the 
+    launches it needs.
+    """
+    # Get the full path to the sounding data
+    soundingfile, stations = station_file('sounding', stid, csvfile)
     try:
-        data = np.genfromtxt(soundingfile, dtype=str, delimiter=',', 
-                             skip_header=1, usecols=(1,2,4,5,6))
-    except:
+        key = file_key(soundingfile)
+    except OSError:
         raise ValueError('ERROR: station "{}" does not exist!'.format(stid))
-        
-    # Get the dates for all the soundings
-    dates = np.array([datetime.strptime(dstr, '%Y-%m-%d %H:00:00') for \
-                      dstr in data[:,0]])
-    # Find the date that is *closest* to the given date [date]
-    diffs = np.abs(dates-date)
-    d_inds = np.where(diffs==np.min(diffs))[0] #indices for the matching sounding
-    sdate = dates[d_inds[0]] # the date of this sounding
-    # Now get the other variables
-    p = data[d_inds,1].astype(float)  # pressure in hPa
-    z = data[d_inds,2].astype(float)  # height in meters
-    # temperature in Celsius:
-    t = np.array([float(x) if x!='M' else np.nan for x in data[d_inds,3]])
-    # dew point in Celsius:
-    td = np.array([float(x) if x!='M' else np.nan for x in data[d_inds,4]])
-    
-    # Reorder so that z is always increasing
-    p = np.array([x for _,x in sorted(zip(z,p))])
-    t = np.array([x for _,x in sorted(zip(z,t))])
-    td = np.array([x for _,x in sorted(zip(z,td))])
-    z = np.array([x for _,x in sorted(zip(z,z))])
-    
-    # Return only the data where T and Td aren't missing
-    good = ~np.isnan(t) * ~np.isnan(td)
-    datadict = {'date':sdate, 'p':p[good], 'z':z[good], 
-                't':t[good], 'td':td[good]}
+    
+    cached = _sounding_cache.get((soundingfile, stid))
+    if cached is not None and cached[0] == key:
+        instrument.count('sounding.cache_hits')
+        return cached[1]
+    
+    # Otherwise look for an up-to-date sidecar file, or parse the text file
+    # (unlike load_asos, [csvfile]'s prefix starts with "soundings_", so that
+    # the ASOS and RAOB sidecars of a file never count as each other's stale
+    # copies)
+    if csvfile is None:
+        prefix = 'soundings_{}.'.format(stid)
+    else:
+        prefix = 'soundings_{}.{}.'.format(os.path.basename(csvfile), stid)
+    stem = os.path.join(get_cachedir(), prefix + '{}-{}'.format(*key))
+    try:
+        store = _read_sounding_sidecar(stem)
+        instrument.count('sounding.sidecar_hits')
+    except (OSError, ValueError):
+        store = None
+        if _is_large(soundingfile):
+            with instrument.stage('sounding.parse', stid=stid, streamed=True):
+                try:
+                    with _spooled_csv(soundingfile, 'sounding', stations, 
+                                      stem) as columns:
+                        _write_sounding_sidecar(_sounding_store(columns), 
+                                                stem, prefix)
+                except OSError:
+                    pass
+            try:
+                store = _read_sounding_sidecar(stem)
+            except (OSError, ValueError):
+                if not whole:
+                    return None
+        if store is None:
+            with instrument.stage('sounding.parse', stid=stid):
+                store = _sounding_store(_read_csv(soundingfile, 'sounding', 
+                                                  stations))
+            _write_sounding_sidecar(store, stem, prefix)
+    _sounding_cache[(soundingfile, stid)] = (key, store)
+    return store
+
+
+
+def _sounding_store_for(stid, dt1, dt2, csvfile=None):
+    """
+    Returns the sounding store (see load_soundings) of station [stid], or, for
+    a very large file whose sidecar can't be written, a store of only the 
+    launches nearest to [dt1, dt2].
+    """
+    store = _load_soundings(stid, csvfile, whole=False)
+    if store is None:
+        soundingfile, stations = station_file('sounding', stid, csvfile)
+        with instrument.stage('sounding.stream', stid=stid):
+            store = _sounding_store(_read_csv_window(soundingfile, 'sounding', 
+                                                     stations, dt1, dt2))
+    return store
+
+
+
+def _sounding_store(columns):
+    """
+    Builds a sounding store (see load_soundings) from the columns of a RAOB 
+    file (see iter_csv_blocks).
+    """
+    dates, z = columns['dates'], columns['z']
+    
+    # Sort by launch time, then by height within each launch
+    order = np.lexsort((z, dates))
+    dates = dates[order]
+    launches, offsets, lengths = np.unique(dates, return_index=True, 
+                                           return_counts=True)
+    store = {'launches':launches, 'index':TimeIndex(launches),
+             'offsets':offsets, 'lengths':lengths}
+    for var in ('p', 'z', 't', 'td'):
+        store[var] = columns[var][order]
+    return store
+
+
+
+def _write_sounding_sidecar(store, stem, prefix):
+    """
+    Saves a sounding store (see load_soundings) as sidecar files at [stem]
+    (see write_sidecar). Errors are ignored.
+    """
+    write_sidecar(stem, prefix, 
+                  [('.levels.npy', [store[var] for var in ('p', 'z', 't', 
+                                                             'td')]),
+                   ('.launches.npy', store['launches']),
+                   ('.offsets.npy', store['offsets']),
+                   ('.lengths.npy', store['lengths'])])
+
+
+
+def _read_sounding_sidecar(stem):
+    """
+    Returns the sounding store (see load_soundings) saved at [stem] (see 
+    _write_sounding_sidecar), with its arrays memory-mapped. Raises OSError 
+    or ValueError if it is missing or unreadable.
+    """
+    levels = np.load(stem + '.levels.npy', mmap_mode='r')
+    launches = np.load(stem + '.launches.npy', mmap_mode='r')
+    store = {'launches':launches, 'index':TimeIndex(launches),
+             'offsets':np.load(stem + '.offsets.npy', mmap_mode='r'),
+             'lengths':np.load(stem + '.lengths.npy', mmap_mode='r')}
+    for k, var in enumerate(('p', 'z', 't', 'td')):
+        store[var] = levels[k]
+    return store
+
+
+
+def _sounding_profile(store, i, stid=None):
+    """
+    Returns the datadict (see get_sounding) for launch number [i] in [store],
+    keeping only the levels where T and Td aren't missing. With [stid], it is
+    returned as an ObsTable of station [stid] instead.
+    """
+    start = store['offsets'][i]
+    levels = slice(start, start + store['lengths'][i])
+    t = store['t'][levels]
+    td = store['td'][levels]
+    good = ~np.isnan(t) & ~np.isnan(td)
+    if stid is not None:
+        block = np.stack([store[var][levels][good] for var in ('p', 'z', 't', 
+                                                               'td')])
+        times = np.full(block.shape[1], store['launches'][i], 
+                        dtype='datetime64[s]')
+        return ObsTable(times, block, ('p', 'z', 't', 'td'), stations=[stid],
+                        attrs={'date':store['launches'][i].astype(datetime)})
+    datadict = {'date':store['launches'][i].astype(datetime)}
+    for var in ('p', 'z', 't', 'td'):
+        datadict[var] = store[var][levels][good].astype(float)
     return datadict
 
+
+
+def regrid_soundings(stids=None, coord='p', levels=None, dt1=None, dt2=None,
+                     csvfile=None):
+    """
+    Interpolates every sounding of one or more stations onto common vertical
+    levels, giving (launch x level) arrays that statistics can be computed on
+    directly (see sounding_climatology). The interpolation is linear in
+    log(pressure) for pressure levels and linear in height for height levels,
+    without extrapolation. All of the launches of a station are interpolated
+    at once, and the result is cached for each station file (and reused until
+    the file changes).
+    
+    Requires:
+        stids ---> the radiosonde station ID(s) (string or list of strings; 
+                   default: every station with a data/soundings_*.txt file)
+        coord ---> the vertical coordinate: 'p' (pressure) or 'z' (height)
+        levels --> (optional) the levels, in hPa or m (default: 
+                   SOUNDING_LEVELS[coord])
+        dt1, dt2 > (optional) only keep the launches from [dt1] through [dt2]
+                   (datetime objects)
+        csvfile -> (optional) full path to an Iowa State RAOB export that 
+                   holds the stations' data (see get_sounding)
+        
+    Returns:
+        grid ----> a dictionary with the keys:
+                   'stations' : the station ID of each launch (array)
+                   'dates'    : the time of each launch (datetime64[s])
+                   'levels'   : the levels (1D float array)
+                   'coord'    : [coord]
+                   and the 2D (launch, level) float32 arrays of the other 
+                   variables, 't', 'td' and 'z' (or 'p'), with NaNs where a 
+                   level is outside a sounding (or the data are missing).
+                   Without any launches (no stations, or none in the time
+                   range), the arrays are empty: (0, level) in 2D.
+    """
+    if coord not in SOUNDING_LEVELS:
+        raise ValueError('ERROR: unknown vertical coordinate "{}"!'.format(
+                         coord))
+    if levels is None:
+        levels = SOUNDING_LEVELS[coord]
+    levels = np.asarray(levels, dtype=float)
+    if stids is None:
+        stids = sorted(fname[10:-4] for fname in os.listdir(get_datadir()) if 
+                       fname.startswith('soundings_') and 
+                       fname.endswith('.txt'))
+    elif isinstance(stids, str):
+        stids = [stids]
+    
+    grids = [_regrid_station(stid, coord, levels, csvfile) for stid in stids]
+    if not grids:
+        # (no stations: no launches)
+        grids = [{'stations':np.array([], dtype=str), 
+                  'dates':np.array([], dtype='datetime64[s]')}]
+        for var in ('p', 'z', 't', 'td'):
+            if var != coord:
+                grids[0][var] = np.empty((0, len(levels)), dtype=np.float32)
+    grid = {'levels':levels, 'coord':coord}
+    for var in grids[0]:
+        grid[var] = np.concatenate([g[var] for g in grids])
+    if dt1 is not None or dt2 is not None:
+        keep = np.ones(len(grid['dates']), dtype=bool)
+        if dt1 is not None:
+            keep &= grid['dates'] >= np.datetime64(dt1, 's')
+        if dt2 is not None:
+            keep &= grid['dates'] <= np.datetime64(dt2, 's')
+        for var in grids[0]:
+            grid[var] = grid[var][keep]
+    return grid
+
+
+
+def _regrid_station(stid, coord, levels, csvfile=None):
+    """
+    Returns the soundings of station [stid] interpolated to [levels] of 
+    [coord] (see regrid_soundings), from the cache or newly computed.
+    """
+    soundingfile, _ = station_file('sounding', stid, csvfile)
+    store = load_soundings(stid, csvfile=csvfile)
+    key = file_key(soundingfile)
+    cached = _regrid_cache.get((soundingfile, stid))
+    if cached is None or cached[0] != key:
+        cached = (key, {})
+        _regrid_cache[(soundingfile, stid)] = cached
+    params = (coord, levels.tobytes())
+    if params in cached[1]:
+        instrument.count('sounding.regrid_hits')
+        return cached[1][params]
+    
+    with instrument.stage('sounding.regrid', stid=stid):
+        # The launch # of each level, and its vertical coordinate: -log(p) or
+        # z, which both increase upward
+        nlaunch = len(store['launches'])
+        launch = np.repeat(np.arange(nlaunch), store['lengths'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = -np.log(store['p'].astype(float)) if coord == 'p' else \
+                store['z'].astype(float)
+            targets = -np.log(levels) if coord == 'p' else levels
+        grid = {'stations':np.full(nlaunch, stid), 'dates':store['launches']}
+        for var in ('p', 'z', 't', 'td'):
+            if var != coord:
+                grid[var] = _interp_segments(launch, x, store[var], targets, 
+                                             nlaunch)
+    cached[1][params] = grid
+    return grid
+
+
+
+def _interp_segments(segment, x, values, targets, nsegments):
+    """
+    Linearly interpolates many profiles at once: the points of profile k are
+    ([x], [values]) where [segment] == k, and each profile is interpolated to
+    every one of the [targets]. Missing (NaN) points are skipped, and targets
+    outside a profile's range of x are NaN.
+    
+    Returns:
+        grid --> a 2D (profile, target) float32 array
+    """
+    good = np.isfinite(x) & ~np.isnan(values)
+    segment, x, values = segment[good], x[good], values[good].astype(float)
+    if len(x) == 0:
+        return np.full((nsegments, len(targets)), np.nan, dtype=np.float32)
+    
+    # Sort by profile, then by x, and shift each profile's x by a multiple of
+    # a span that is wider than any profile, so that every profile can be
+    # searched in one sorted array
+    order = np.lexsort((x, segment))
+    segment, x, values = segment[order], x[order], values[order]
+    low = min(x.min(), np.min(targets))
+    span = max(x.max(), np.max(targets)) - low + 1.
+    xs = (x - low) + segment * span
+    ts = ((targets - low)[None, :] + 
+          np.arange(nsegments)[:, None] * span).ravel()
+    owner = np.repeat(np.arange(nsegments), len(targets))
+    
+    # The points below (j) and above (k) each target: xs[j] <= ts < xs[k]
+    k = np.searchsorted(xs, ts, side='right')
+    j = k - 1
+    kk = np.minimum(k, len(xs) - 1)
+    inside = (j >= 0) & (segment[np.maximum(j, 0)] == owner)
+    between = inside & (k < len(xs)) & (segment[kk] == owner)
+    exact = inside & (xs[np.maximum(j, 0)] == ts)
+    
+    result = np.full(len(ts), np.nan)
+    j, kk = j[between], kk[between]
+    weight = (ts[between] - xs[j]) / (xs[kk] - xs[j])
+    result[between] = values[j] + weight * (values[kk] - values[j])
+    result[exact] = values[np.maximum(k - 1, 0)[exact]]
+    return result.reshape(nsegments, len(targets)).astype(np.float32)
+
+
+
+def sounding_climatology(grid, percentiles=(10, 50, 90), by_station=False):
+    """
+    Computes statistics of regridded soundings at each level.
+    
+    Requires:
+        grid --------> soundings on common levels (see regrid_soundings)
+        percentiles -> the percentiles to compute (list of numbers)
+        by_station --> if True, the statistics are computed separately for 
+                       each station
+                       
+    Returns:
+        clim --------> a dictionary with the keys 'levels', 'coord' and, for
+                       each variable [var] in [grid], '[var]_count' (number 
+                       of launches with data), '[var]_mean', '[var]_std' and 
+                       '[var]_p[N]' for each percentile N: 1D (level) arrays,
+                       or 2D (station, level) arrays with [by_station] (and 
+                       then the key 'stations' lists the stations)
+    """
+    import warnings
+    clim = {'levels':grid['levels'], 'coord':grid['coord']}
+    variables = [var for var in ('p', 'z', 't', 'td') if var in grid]
+    if by_station:
+        clim['stations'] = sorted(set(grid['stations'].tolist()))
+        groups = [grid['stations'] == stid for stid in clim['stations']]
+    else:
+        groups = [slice(None)]
         
+    for var in variables:
+        data = [grid[var][group] for group in groups]
+        # (levels without any data give NaN, without warnings)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            stats = {'count':[np.sum(~np.isnan(d), axis=0) for d in data],
+                     'mean':[np.nanmean(d, axis=0) for d in data],
+                     'std':[np.nanstd(d, axis=0) for d in data]}
+            for q in percentiles:
+                stats['p{:g}'.format(q)] = [np.nanpercentile(d, q, axis=0) for
+                                            d in data]
+        for stat, values in stats.items():
+            values = np.array(values)
+            clim['{}_{}'.format(var, stat)] = values if by_station else \
+                                              values[0]
+    return clim
+
+
+
+class ObsTable(object):
+    """
+    A compact table of station observations: datetime64[s] times, and float32
+    variables stored as the rows of one 2D (variable, time) block, with NaN 
+    where an observation is missing. The rows of several stations can be 
+    held in one table (see concat); each station's rows are contiguous and
+    sorted by time.
+    
+    Columns are returned as views of the block (no copies), and the table 
+    also indexes like the dictionaries returned by get_meteorogram and 
+    get_sounding: table['t'], table['dates'] (datetime objects), 'dates' in 
+    table, table.keys(), ...
+    
+    Requires:
+        times ----> 1D array of the observation times (datetime64 or datetime
+                    objects)
+        block ----> 2D (variable, time) array of the observations
+        columns --> the variable names, in the order of the block's rows
+        stations -> (optional) the station IDs of the table's rows, in order
+        offsets --> (optional) the first row of each station (default: one
+                    station)
+        attrs ----> (optional) a dictionary of other (scalar) values to 
+                    return by key, e.g. {'date': launch time}
+    """
+    def __init__(self, times, block, columns, stations=None, offsets=None,
+                 attrs=None):
+        self.times = np.asarray(times, dtype='datetime64[s]')
+        self.block = np.asarray(block, dtype=np.float32)
+        self.columns = tuple(columns)
+        if self.block.shape != (len(self.columns), len(self.times)):
+            raise ValueError('ERROR: ObsTable block must be (variable, time)!')
+        self.stations = [] if stations is None else list(stations)
+        self.offsets = np.zeros(len(self.stations), dtype=np.intp) if \
+                       offsets is None else np.asarray(offsets, dtype=np.intp)
+        self.attrs = {} if attrs is None else dict(attrs)
+        self._rows = {var:k for k, var in enumerate(self.columns)}
+        
+    @classmethod
+    def from_columns(cls, times, columns, **kwargs):
+        """
+        Builds a table from a dictionary of 1D variable arrays, {name: array}.
+        """
+        names = list(columns.keys())
+        block = np.empty((len(names), len(times)), dtype=np.float32)
+        for k, var in enumerate(names):
+            block[k] = columns[var]
+        return cls(times, block, names, **kwargs)
+    
+    @classmethod
+    def concat(cls, tables):
+        """
+        Concatenates [tables] (e.g., of different stations) into one table
+        with one contiguous block.
+        """
+        columns = tables[0].columns
+        if any(table.columns != columns for table in tables):
+            raise ValueError('ERROR: ObsTables must have the same columns!')
+        stations, offsets = [], []
+        n = 0
+        for table in tables:
+            stations += table.stations
+            offsets += list(table.offsets + n)
+            n += len(table)
+        return cls(np.concatenate([table.times for table in tables]),
+                   np.concatenate([table.block for table in tables], axis=1),
+                   columns, stations=stations, offsets=offsets)
+    
+    def __len__(self):
+        return len(self.times)
+    
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.block.nbytes
+    
+    def column(self, name):
+        """
+        Returns variable [name] (a view of the table's block).
+        """
+        return self.block[self._rows[name]]
+    
+    def _bounds(self):
+        # (start, stop) rows of each station
+        stops = list(self.offsets[1:]) + [len(self)]
+        return list(zip(self.offsets, stops)) if len(self.stations) else \
+               [(0, len(self))]
+    
+    def _take(self, rows, stations=None, offsets=None):
+        return ObsTable(self.times[rows], self.block[:, rows], self.columns,
+                        stations=stations, offsets=offsets, attrs=self.attrs)
+    
+    def station(self, stid):
+        """
+        Returns the rows of station [stid] (as a view of this table).
+        """
+        if stid not in self.stations:
+            raise ValueError('ERROR: station "{}" is not in the table!'.format(
+                             stid))
+        k = self.stations.index(stid)
+        start, stop = self._bounds()[k]
+        return self._take(slice(start, stop), stations=[stid])
+    
+    def between(self, dt1, dt2):
+        """
+        Returns the rows (of each station) with times from [dt1] through 
+        [dt2] (inclusive). For a one-station table this is a view.
+        """
+        t1, t2 = np.datetime64(dt1, 's'), np.datetime64(dt2, 's')
+        ranges = []
+        for start, stop in self._bounds():
+            times = self.times[start:stop]
+            ranges.append((start + np.searchsorted(times, t1, 'left'),
+                           start + np.searchsorted(times, t2, 'right')))
+        if len(ranges) == 1:
+            return self._take(slice(*ranges[0]), stations=self.stations)
+        rows = np.concatenate([np.arange(a, b) for a, b in ranges])
+        offsets = np.cumsum([0] + [b - a for a, b in ranges[:-1]])
+        return self._take(rows, stations=self.stations, offsets=offsets)
+    
+    # Dictionary-style access (as for the get_meteorogram/get_sounding dicts)
+    def keys(self):
+        return ['dates'] + list(self.columns) + list(self.attrs.keys())
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __contains__(self, key):
+        return key == 'dates' or key in self._rows or key in self.attrs
+    
+    def __getitem__(self, key):
+        if key in self._rows:
+            return self.column(key)
+        if key == 'dates':
+            return self.times.astype(datetime)
+        if key in self.attrs:
+            return self.attrs[key]
+        raise KeyError(key)
+    
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+    
+    def to_dict(self):
+        """
+        Returns the table as a dictionary of arrays (float64 variables and 
+        datetime objects, like get_meteorogram and get_sounding return).
+        """
+        datadict = {key:self[key] for key in self.keys()}
+        for var in self.columns:
+            datadict[var] = datadict[var].astype(float)
+        return datadict
+
+
+
+def iter_csv_blocks(csvfile, kind, stations=None, dt2=None, block_mb=4.,
+                    time_sorted=False):
+    """
+    Streams an Iowa State ASOS or RAOB CSV export (in the same layout as the
+    data/asos_*.txt or data/soundings_*.txt files) in blocks of about 
+    [block_mb] megabytes, so that files of any size can be read with bounded
+    memory. Multi-station files are split by the "station" column. The rows
+    of each station must be sorted by time.
+    
+    Requires:
+        csvfile --> full path to the CSV file (string)
+        kind -----> the type of file: 'asos' or 'sounding' (string)
+        stations -> (optional) only read the rows of these station IDs (list
+                    of strings)
+        dt2 ------> (optional) skip the rows of each station after the first
+                    time after [dt2], and stop reading once every station in
+                    [stations] has passed [dt2] (datetime object). If 
+                    [stations] is None, the whole file is still read (the 
+                    rows of another station may come later), unless 
+                    [time_sorted] is True.
+        block_mb -> approximate size of each block, in MB (float)
+        time_sorted -> if True, all of the file's rows (not only those of
+                       each station) are sorted by time, e.g. it holds one
+                       station, so reading stops at the first time after 
+                       [dt2] even if [stations] is None (bool)
+        
+    Yields:
+        (stid, columns) tuples for each station in each block, where columns
+        is a dictionary of 1D arrays of the block's rows for station [stid]:
+        'dates' (datetime64) and the float32 variables (with NaN where the 
+        observation is missing), i.e.
+            'asos' -------> ('t', 'td', 'wdir', 'wspd', 'pres', 'prec')
+            'sounding' ---> ('p', 'z', 't', 'td')
+    """
+    timetype, columns = _CSV_LAYOUTS[kind]
+    ncols = max(k for k, _ in columns) + 1
+    wanted = None if stations is None else set(stations)
+    limit = None if dt2 is None else np.datetime64(dt2)
+    after = {}    # {stid: the first time after [dt2]}
+    seen = set()
+    done = set()
+    
+    try:
+        f = open(csvfile, 'r')
+    except OSError:
+        raise ValueError('ERROR: could not read "{}"!'.format(csvfile))
+    with f:
+        f.readline() # skip the header
+        while True:
+            with instrument.stage('csv.read'):
+                lines = f.readlines(int(block_mb * 1e6))
+            if not lines:
+                break
+            with instrument.stage('csv.split', rows=len(lines)):
+                fields = [line.split(',', ncols)[:ncols] for line in lines]
+                data = np.array([row for row in fields if len(row) == ncols], 
+                                dtype=str)
+            if instrument.is_enabled():
+                instrument.count('csv.bytes_read', sum(map(len, lines)))
+                instrument.count('csv.rows_parsed', len(data))
+            if len(data) == 0:
+                continue
+            
+            stids = np.char.strip(data[:,0])
+            single = np.all(stids == stids[0])
+            # (each station, in order of appearance)
+            for stid in dict.fromkeys(stids.tolist()):
+                if (wanted is not None and stid not in wanted) or stid in done:
+                    continue
+                seen.add(stid)
+                rows = data if single else data[stids==stid]
+                with instrument.stage('csv.dates', rows=len(rows)):
+                    dates = np.char.strip(rows[:,1]).astype(timetype)
+                keep = slice(None)
+                if limit is not None:
+                    # Rows beyond the first time after [dt2] aren't needed
+                    if stid not in after and np.any(dates > limit):
+                        after[stid] = dates[dates > limit].min()
+                    if stid in after and np.any(dates > after[stid]):
+                        done.add(stid)
+                        keep = dates <= after[stid]
+                chunk = {'dates':dates[keep]}
+                with instrument.stage('csv.floats', rows=len(chunk['dates'])):
+                    for k, var in columns:
+                        chunk[var] = _decode_floats(rows[keep,k])
+                yield stid, chunk
+                
+            if wanted is not None and done >= wanted:
+                break
+            if wanted is None and time_sorted and done and done >= seen:
+                break
+
+
+
+def _read_csv(csvfile, kind, stations=None):
+    """
+    Reads all of the rows (of [stations], if given) in an ASOS or RAOB CSV 
+    file (see iter_csv_blocks) into one dictionary of 1D arrays.
+    """
+    chunks = [columns for _, columns in iter_csv_blocks(csvfile, kind, 
+                                                        stations=stations)]
+    return _concat_columns(chunks, kind)
+
+
+
+def _read_csv_window(csvfile, kind, stations, dt1, dt2):
+    """
+    Streams the rows (of [stations], if given) in an ASOS or RAOB CSV file 
+    (see iter_csv_blocks) that are needed to find the times nearest to [dt1]
+    and [dt2]: those from the last time before [dt1] through the first time
+    after [dt2]. Memory use is bounded by the size of that window, and reading
+    stops after it (for a multi-station file, once each of [stations] has 
+    passed it).
+    
+    Returns:
+        columns -> a dictionary of 1D arrays (as yielded by iter_csv_blocks)
+    """
+    start = np.datetime64(dt1)
+    before = [] # the rows at the latest time before [dt1]
+    inside = [] # the rows from [dt1] on
+    # (the station files in the data directory, for which [stations] is None,
+    # hold one station, so their rows are sorted by time)
+    blocks = iter_csv_blocks(csvfile, kind, stations=stations, dt2=dt2,
+                             time_sorted=stations is None)
+    for _, columns in blocks:
+        dates = columns['dates']
+        early = dates < start
+        if np.any(early):
+            last = dates[early].max()
+            if before and last == before[0]['dates'][0]:
+                before.append({k:v[dates==last] for k, v in columns.items()})
+            elif not before or last > before[0]['dates'][0]:
+                before = [{k:v[dates==last] for k, v in columns.items()}]
+        if not np.all(early):
+            inside.append({k:v[~early] for k, v in columns.items()})
+    return _concat_columns(before + inside, kind)
+
+
+
+def _concat_columns(chunks, kind):
+    """
+    Concatenates a list of column dictionaries (see iter_csv_blocks).
+    """
+    timetype, columns = _CSV_LAYOUTS[kind]
+    names = ['dates'] + [var for _, var in columns]
+    if not chunks:
+        return {var:np.empty(0, dtype=timetype if var=='dates' else np.float32)
+                for var in names}
+    return {var:np.concatenate([chunk[var] for chunk in chunks]) 
+            for var in names}
+
+
+
+def station_file(kind, stid, csvfile=None):
+    """
+    Finds the ASOS ('asos') or RAOB ('sounding') data file of station [stid].
+    
+    Requires:
+        kind ----> 'asos' or 'sounding' (string)
+        stid ----> station ID (string)
+        csvfile -> (optional) a multi-station CSV file to use instead of the
+                   station's own file (string)
+    
+    Returns:
+        path -----> [csvfile] if it is given, otherwise the full path to the
+                    station's file in the "data" directory
+        stations -> the station IDs to read from that file: [stid] for 
+                    [csvfile] (which may hold many stations), otherwise None
+                    (all of the rows)
+    """
+    if csvfile is not None:
+        return csvfile, [stid]
+    fname = '{}_{}.txt'.format('asos' if kind=='asos' else 'soundings', stid)
+    return os.path.join(get_datadir(), fname), None
+
+
+
+def _is_large(path):
+    """
+    Returns True if the station file [path] is too large to parse in memory
+    (see STREAM_MIN_MB).
+    """
+    try:
+        return os.path.getsize(path) > STREAM_MIN_MB * 1e6
+    except OSError:
+        return False
+
+
+
+@contextmanager
+def _spooled_csv(csvfile, kind, stations, stem):
+    """
+    Parses a whole ASOS or RAOB CSV file (the rows of [stations], if given)
+    block by block (see iter_csv_blocks), appending each column to a raw 
+    temporary file ("[stem].[column].[pid].spool") as it goes, so that memory
+    use is bounded by the block size instead of the file size. Yields the 
+    columns (see iter_csv_blocks) as read-only memory maps of those files, 
+    which are removed afterwards. Raises OSError if they can't be written.
+    """
+    timetype, columns = _CSV_LAYOUTS[kind]
+    dtypes = {'dates':np.dtype(timetype)}
+    dtypes.update((var, np.dtype(np.float32)) for _, var in columns)
+    paths = {name:'{}.{}.{}.spool'.format(stem, name, os.getpid()) for name 
+             in dtypes}
+    files = []
+    try:
+        for name in dtypes:
+            files.append(open(paths[name], 'wb'))
+        n = 0
+        for _, chunk in iter_csv_blocks(csvfile, kind, stations=stations):
+            for f, name in zip(files, dtypes):
+                chunk[name].astype(dtypes[name], copy=False).tofile(f)
+            n += len(chunk['dates'])
+        for f in files:
+            f.close()
+        # (a zero-length file can't be memory-mapped)
+        yield {name:np.memmap(paths[name], dtype=dtype, mode='r', shape=(n,))
+               if n else np.empty(0, dtype=dtype) for name, dtype in 
+               dtypes.items()}
+    finally:
+        for f in files:
+            f.close()
+        for path in paths.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
 
 def nearest_ind(array,value):
     """
     Finds the nearest index of the given value in the given array.
+    (For sorted arrays of times, a TimeIndex is much faster.)
     """
     return int((np.abs(array-value)).argmin())
 
 
 
+def parse_time(value):
+    """
+    Converts a time string to a datetime object.
+
+    Requires:
+        value --> "YYYYMMDDHH", or an ISO string (e.g. "2010-10-25T12:00" or
+                  "2010-10-25 12:00"); a datetime object is returned as is
+
+    Returns:
+        date ---> a datetime object
+    """
+    if isinstance(value, datetime):
+        return value
+    value = str(value)
+    formats = ['%Y%m%d%H'] if value.isdigit() and len(value) == 10 else \
+              ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M',
+               '%Y-%m-%dT%H']
+    for fmt in formats:
+        try:
+            return datetime.strptime(value[:19], fmt)
+        except ValueError:
+            pass
+    raise ValueError('ERROR: invalid time "{}"!'.format(value))
+
+
+
+class TimeIndex(object):
+    """
+    A sorted array of times, stored as int64 datetime64 values, with binary-
+    search (O(log n)) lookups. Lookups give the same indices as nearest_ind():
+    the index of the nearest time, with ties going to the earliest index.
+    
+    Requires:
+        times --> a sorted 1D array of datetime64 values or datetime objects
+        unit ---> the datetime64 unit to store the times in (string; 's' for
+                  seconds, 'm' for minutes, ...)
+    """
+    def __init__(self, times, unit='s'):
+        self.unit = unit
+        self.times = np.asarray(times, dtype='datetime64[{}]'.format(unit))
+        self._ints = self.times.view(np.int64)
+        if np.any(self._ints[1:] < self._ints[:-1]):
+            raise ValueError('ERROR: TimeIndex times must be sorted!')
+        
+    def __len__(self):
+        return len(self._ints)
+    
+    def _convert(self, values):
+        """
+        Converts datetime(64) value(s) to int64s in this index's unit.
+        """
+        dtype = 'datetime64[{}]'.format(self.unit)
+        return np.asarray(values, dtype=dtype).view(np.int64)
+    
+    def _nearest(self, values):
+        ints = self._ints
+        if len(ints) == 0:
+            raise IndexError('ERROR: TimeIndex is empty!')
+        if len(ints) == 1:
+            return np.zeros(np.shape(values), dtype=np.intp)
+        i = np.clip(np.searchsorted(ints, values), 1, len(ints) - 1)
+        lower = (values - ints[i-1]) <= (ints[i] - values)
+        i = np.where(lower, i - 1, i)
+        # (if the nearest time is repeated, use its first occurrence)
+        return np.searchsorted(ints, ints[i])
+    
+    def nearest(self, value):
+        """
+        Returns the index (int) of the time that is nearest to [value].
+        """
+        return int(self._nearest(self._convert(value)))
+    
+    def nearest_many(self, values):
+        """
+        Returns an array with the index of the time that is nearest to each
+        of the times in [values], all at once.
+        """
+        return self._nearest(self._convert(values))
+    
+    def slice(self, dt1, dt2):
+        """
+        Returns the slice from the time nearest to [dt1] through the time 
+        nearest to [dt2].
+        """
+        t1, t2 = self._nearest(self._convert([dt1, dt2]))
+        return slice(int(t1), int(t2) + 1)
+
+
+
 def get_figdir():
     """
     Returns the full path to the "figures" directory in the same directory
@@ -226,6 +1887,278 @@ def get_figdir():
     return figdir
 
 
+def get_manifest_file():
+    """
+    Returns the full path to the render manifest (see RenderManifest), which
+    is kept next to the "figures" directory.
+    """
+    # Get the directory that this module is located in
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(thisdir, 'figures_manifest.json')
+
+
+
+class RenderManifest(object):
+    """
+    A record of what each figure in the "figures" directory was rendered 
+    from: for each figure file, a hash of its input data, a hash of its plot
+    parameters, and the version of the plotting code. A figure only needs to
+    be rendered again if it is missing or any of these have changed.
+    
+    Requires:
+        path --> (optional) the manifest file (default: get_manifest_file())
+    """
+    def __init__(self, path=None):
+        self.path = get_manifest_file() if path is None else path
+        self.entries = self._read()
+        self._changed = {}
+        
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    @staticmethod
+    def key(data, params, code):
+        """
+        Returns the manifest entry for a figure rendered from [data] (arrays,
+        or dicts/lists of them) with plot parameters [params] by plotting
+        code version [code] (string).
+        """
+        return {'data':data_hash(data), 'params':data_hash(params), 
+                'code':code}
+    
+    def is_current(self, savefile, key):
+        """
+        Returns True if [savefile] exists and was rendered from [key].
+        """
+        return os.path.isfile(savefile) and \
+               self.entries.get(os.path.basename(savefile)) == key
+    
+    def record(self, savefile, key):
+        """
+        Records that [savefile] was just rendered from [key].
+        """
+        self.entries[os.path.basename(savefile)] = key
+        self._changed[os.path.basename(savefile)] = key
+        
+    def save(self):
+        """
+        Writes the recorded entries to the manifest file (merging them with
+        any entries that other runs have written in the meantime). The file
+        is locked while it is re-read, merged and rewritten, so that the 
+        processes of a pool can save at the same time without losing each 
+        other's entries.
+        """
+        if not self._changed:
+            return
+        with self._lock():
+            entries = self._read()
+            entries.update(self._changed)
+            tmpfile = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmpfile, 'w') as f:
+                json.dump(entries, f, indent=0, sort_keys=True)
+            os.replace(tmpfile, self.path)
+        self.entries = entries
+        self._changed = {}
+        
+    @contextmanager
+    def _lock(self):
+        """
+        Holds an exclusive lock on the manifest's lock file ([path].lock).
+        (Without the fcntl module, i.e. on Windows, nothing is locked.)
+        """
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+
+def data_hash(data):
+    """
+    Returns a hash (hex string) of the contents of [data]: a numpy (masked)
+    array, a dictionary or list/tuple of them, or any other object with a 
+    stable repr() (numbers, strings, datetimes, ...).
+    """
+    digest = hashlib.sha1()
+    _update_hash(digest, data)
+    return digest.hexdigest()
+
+
+
+def _update_hash(digest, data):
+    """
+    Adds [data] (see data_hash) to the hashlib object [digest].
+    """
+    if isinstance(data, dict):
+        digest.update(b'{')
+        for key in sorted(data, key=str):
+            _update_hash(digest, key)
+            _update_hash(digest, data[key])
+        digest.update(b'}')
+    elif isinstance(data, (list, tuple)):
+        digest.update(b'[')
+        for item in data:
+            _update_hash(digest, item)
+        digest.update(b']')
+    elif isinstance(data, np.ndarray) and data.dtype != object:
+        digest.update(repr((data.dtype.str, data.shape)).encode())
+        digest.update(np.ascontiguousarray(np.ma.getdata(data)).tobytes())
+        mask = np.ma.getmask(data)
+        if mask is not np.ma.nomask:
+            digest.update(np.ascontiguousarray(mask).tobytes())
+    elif isinstance(data, np.ndarray):
+        _update_hash(digest, data.tolist())
+    else:
+        digest.update(repr(data).encode())
+        
+        
+        
+def _nbytes(array):
+    """
+    Returns the memory used by a (possibly masked) numpy array, in bytes.
+    """
+    mask = np.ma.getmask(array)
+    return array.nbytes + (0 if mask is np.ma.nomask else mask.nbytes)
+
+
+
+def get_datadir():
+    """
+    Returns the full path to the "data" directory in the same directory
+    as this module.
+    """
+    # Get the directory that this module is located in
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(thisdir, 'data')
+
+
+
+def get_cachedir():
+    """
+    Returns the full path to the ".cache" directory inside the "data"
+    directory, which holds decoded copies of the data files. If ".cache" does
+    not exist, it is created.
+    """
+    cachedir = os.path.join(get_datadir(), '.cache')
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir, exist_ok=True)
+    return cachedir
+
+
+
+def file_key(path):
+    """
+    Identifies the current version of a file, to tell whether a cached copy
+    of (or something computed from) that file is still up to date.
+    
+    Requires:
+        path -> full path to the file (string)
+        
+    Returns:
+        key --> a (modification time [ns], size [bytes]) tuple
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+
+def clear_caches(path=None):
+    """
+    Empties the in-memory caches of the data loaders, as in a new session. If
+    [path] is given, the sidecar files of that data file (in the cache
+    directory) are deleted too, so that it is parsed again from scratch.
+
+    Requires:
+        path -> (optional) full path to a data file (an ASOS or RAOB export,
+                or a NARR file)
+    """
+    for cache in (_asos_cache, _sounding_cache, _regrid_cache,
+                  _locator_cache, _window_cache):
+        cache.clear()
+    if path is None:
+        return
+    # (see the prefixes in _load_asos, _load_soundings & derive_narr_fields)
+    name = os.path.basename(path)
+    cachedir = get_cachedir()
+    for fname in os.listdir(cachedir):
+        if fname.startswith((name + '.', 'soundings_' + name + '.')):
+            os.remove(os.path.join(cachedir, fname))
+
+
+
+def write_sidecar(stem, prefix, parts):
+    """
+    Saves arrays computed from a data file as .npy "sidecar" files in the 
+    cache directory (see get_cachedir), each via a temporary file so that 
+    readers never see a half-written file, then removes any stale sidecars
+    (those of older versions of the data file). Errors are ignored: the 
+    sidecar is only an optimization.
+    
+    Requires:
+        stem ---> full path of the sidecar without its suffix, e.g.
+                  [cachedir]/[name].[a key of the data file's version]
+        prefix -> the file name prefix that all sidecars of this kind share
+                  (e.g., "[name]."); the other files that start with it are
+                  removed (string). None keeps them: use it for caches that
+                  are keyed by their contents, which are never stale.
+        parts --> (suffix, array) pairs; each array is saved as 
+                  "[stem][suffix]". The array can also be a list of 1D 
+                  arrays of the same length (e.g., memory maps), saved one 
+                  at a time as the rows of a 2D array, without stacking 
+                  them in memory.
+        
+    Returns:
+        Nothing
+    """
+    try:
+        for suffix, array in parts:
+            tmpfile = '{}.{}.tmp'.format(stem + suffix, os.getpid())
+            if isinstance(array, list) and array and len(array[0]):
+                rows = np.lib.format.open_memmap(tmpfile, mode='w+', 
+                       dtype=array[0].dtype, shape=(len(array), len(array[0])))
+                for k, row in enumerate(array):
+                    rows[k] = row
+                rows.flush()
+                del rows
+            else:
+                with open(tmpfile, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(array))
+            os.replace(tmpfile, stem + suffix)
+    except OSError:
+        return
+    if prefix is not None:
+        _remove_stale(stem, prefix)
+
+
+
+def _remove_stale(stem, prefix):
+    """
+    Removes the files in the directory of [stem] that start with [prefix] but
+    are not "[stem]" or "[stem].*" (i.e., older sidecars of the same file).
+    Errors are ignored.
+    """
+    cachedir, name = os.path.split(stem)
+    try:
+        for fname in os.listdir(cachedir):
+            if fname.startswith(prefix) and fname != name and \
+               not fname.startswith(name + '.'):
+                os.remove(os.path.join(cachedir, fname))
+    except OSError:
+        pass
+
+
+
 # Any code within the following block with be executed if this module is run
 # as a script! FEEL FREE TO ADD CODE FOR TESTING.
 if __name__ == '__main__':